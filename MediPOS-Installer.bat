@@ -203,7 +203,7 @@ echo timeout /t 5 > nul
 echo.
 echo Starting Backend Server...
 echo cd /d "%MEDIPOS_DIR%\backend"
-echo start "MediPOS Backend" cmd /k "call venv\Scripts\activate && uvicorn server:app --host 0.0.0.0 --port 8001"
+echo start "MediPOS Backend" cmd /k "call venv\Scripts\activate && python server.py --host 0.0.0.0 --port 8001"
 echo timeout /t 5 > nul
 echo.
 echo Starting Frontend...
@@ -1,4 +1,5 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -6,10 +7,10 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Union
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import ClassVar, List, Optional, Union
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 import subprocess
 import json
@@ -17,17 +18,319 @@ import shutil
 import tarfile
 import tempfile
 import hashlib
+import html
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from functools import wraps
+from functools import wraps, lru_cache
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pymongo import monitoring
+import orjson
+import numpy as np
+from fastapi.responses import ORJSONResponse
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics (exposed in Prometheus text format at /metrics)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Fixed-bucket latency histogram; bucket counts are made cumulative when rendered"""
+    __slots__ = ("bucket_counts", "total", "count")
+    
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+def format_labels(labels: dict) -> str:
+    return ",".join(
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels.items()
+    )
+
+def render_histogram(lines: list, name: str, histograms: dict, label_names: tuple):
+    for key, histogram in histograms.items():
+        labels = dict(zip(label_names, key))
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{format_labels({**labels, "le": bound})}}} {cumulative}')
+        lines.append(f"{name}_sum{{{format_labels(labels)}}} {histogram.total}")
+        lines.append(f"{name}_count{{{format_labels(labels)}}} {histogram.count}")
+
+class RequestMetrics:
+    """Per-route HTTP metrics, updated from the event loop thread only"""
+    
+    def __init__(self):
+        self.requests = defaultdict(int)      # (method, route, status) -> count
+        self.errors = defaultdict(int)        # (method, route) -> count of 5xx/unhandled
+        self.latency = defaultdict(Histogram) # (method, route) -> histogram
+        self.in_flight = defaultdict(int)     # method -> active requests
+    
+    def observe(self, method: str, route: str, status_code: int, duration: float):
+        self.requests[(method, route, status_code)] += 1
+        self.latency[(method, route)].observe(duration)
+        if status_code >= 500:
+            self.errors[(method, route)] += 1
+    
+    def render(self, lines: list):
+        lines.append("# HELP medipos_http_requests_total HTTP requests by route and status")
+        lines.append("# TYPE medipos_http_requests_total counter")
+        for (method, route, status_code), count in self.requests.items():
+            lines.append(f"medipos_http_requests_total{{{format_labels({'method': method, 'route': route, 'status': status_code})}}} {count}")
+        lines.append("# HELP medipos_http_request_errors_total HTTP requests that failed with a 5xx status")
+        lines.append("# TYPE medipos_http_request_errors_total counter")
+        for (method, route), count in self.errors.items():
+            lines.append(f"medipos_http_request_errors_total{{{format_labels({'method': method, 'route': route})}}} {count}")
+        lines.append("# HELP medipos_http_request_duration_seconds HTTP request latency")
+        lines.append("# TYPE medipos_http_request_duration_seconds histogram")
+        render_histogram(lines, "medipos_http_request_duration_seconds", self.latency, ("method", "route"))
+        lines.append("# HELP medipos_http_requests_in_flight HTTP requests currently being served")
+        lines.append("# TYPE medipos_http_requests_in_flight gauge")
+        for method, count in self.in_flight.items():
+            lines.append(f"medipos_http_requests_in_flight{{{format_labels({'method': method})}}} {count}")
+
+MONGO_WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """PyMongo command listener recording counts and durations per command and collection.
+
+    Motor runs PyMongo on executor threads, so updates are guarded by a lock.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.commands = defaultdict(int)      # (command, collection) -> count
+        self.failures = defaultdict(int)      # (command, collection) -> count
+        self.latency = defaultdict(Histogram) # (command, collection) -> histogram
+        self.write_listeners = []             # callables notified with the collection after each write
+    
+    @staticmethod
+    def _collection(event) -> str:
+        target = event.command.get(event.command_name)
+        if isinstance(target, str):
+            return target
+        return event.command.get("collection") or "none"
+    
+    def started(self, event):
+        collection = self._collection(event)
+        # Motor copies the caller's context onto its executor thread, so this sees the request's recorder
+        recorder = db_command_recorder.get()
+        if recorder is not None:
+            recorder.record(event.command_name, collection)
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection
+    
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            collection = self._pending.pop((event.connection_id, event.request_id), "none")
+            key = (event.command_name, collection)
+            self.commands[key] += 1
+            self.latency[key].observe(event.duration_micros / 1_000_000)
+            if failed:
+                self.failures[key] += 1
+        # Failed writes may still have applied partially, so notify on both outcomes
+        if event.command_name in MONGO_WRITE_COMMANDS:
+            for listener in self.write_listeners:
+                listener(collection)
+    
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+    
+    def failed(self, event):
+        self._finish(event, failed=True)
+    
+    def render(self, lines: list):
+        with self._lock:
+            commands = dict(self.commands)
+            failures = dict(self.failures)
+            latency = dict(self.latency)
+        lines.append("# HELP medipos_mongo_commands_total MongoDB commands by command and collection")
+        lines.append("# TYPE medipos_mongo_commands_total counter")
+        for (command, collection), count in commands.items():
+            lines.append(f"medipos_mongo_commands_total{{{format_labels({'command': command, 'collection': collection})}}} {count}")
+        lines.append("# HELP medipos_mongo_command_failures_total MongoDB commands that failed")
+        lines.append("# TYPE medipos_mongo_command_failures_total counter")
+        for (command, collection), count in failures.items():
+            lines.append(f"medipos_mongo_command_failures_total{{{format_labels({'command': command, 'collection': collection})}}} {count}")
+        lines.append("# HELP medipos_mongo_command_duration_seconds MongoDB command latency")
+        lines.append("# TYPE medipos_mongo_command_duration_seconds histogram")
+        render_histogram(lines, "medipos_mongo_command_duration_seconds", latency, ("command", "collection"))
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no BaseHTTPMiddleware overhead) that times every HTTP request"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        method = scope["method"]
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        request_metrics.in_flight[method] += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception:
+            status_code = 500
+            raise
+        finally:
+            request_metrics.in_flight[method] -= 1
+            # The router stores the matched route in the scope; use its template to bound label cardinality
+            route = scope.get("route")
+            request_metrics.observe(
+                method,
+                getattr(route, "path", None) or "unmatched",
+                status_code,
+                time.perf_counter() - started
+            )
+
+request_metrics = RequestMetrics()
+mongo_command_metrics = MongoCommandMetrics()
+
+# Database command budgets
+# Endpoints declare the maximum number of Mongo round-trips they may issue with
+# @db_command_budget(n); tests under backend/tests assert the caps against a fake
+# database. Set DB_COMMAND_BUDGETS=report to log and expose the count in an
+# X-DB-Commands header, or =enforce to also answer over-budget requests with a 500
+# error instead of their response. Enforcement happens once the handler has
+# returned, so its writes are kept: it flags regressions in smoke runs, it does
+# not guard data.
+DB_COMMAND_BUDGETS = os.environ.get("DB_COMMAND_BUDGETS", "off").lower()
+
+class DBCommandBudgetExceeded(AssertionError):
+    pass
+
+class DBCommandRecorder:
+    """Collects every database command issued while it is active"""
+    
+    def __init__(self):
+        self.commands = []
+        self._lock = threading.Lock()
+    
+    def record(self, command_name: str, collection: str):
+        with self._lock:
+            self.commands.append((command_name, collection))
+    
+    @property
+    def count(self) -> int:
+        return len(self.commands)
+    
+    def assert_at_most(self, max_commands: int, label: str = "block"):
+        if self.count > max_commands:
+            issued = ", ".join(f"{command}:{collection}" for command, collection in self.commands)
+            raise DBCommandBudgetExceeded(
+                f"{label} issued {self.count} database commands (budget {max_commands}): {issued}"
+            )
+
+db_command_recorder: ContextVar[Optional[DBCommandRecorder]] = ContextVar("db_command_recorder", default=None)
+
+@contextmanager
+def record_db_commands():
+    """Capture database commands issued inside the block, e.g. in a test:
+
+        with record_db_commands() as recorder:
+            await create_sale(sale)
+        recorder.assert_at_most(4, "POST /sales")
+    """
+    recorder = DBCommandRecorder()
+    token = db_command_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        db_command_recorder.reset(token)
+
+def db_command_budget(max_commands: int):
+    """Declare the maximum database round-trips an endpoint may issue per call.
+
+    Apply below the router decorator so the budget is on the registered endpoint.
+    """
+    def decorator(func):
+        func.db_command_budget = max_commands
+        return func
+    return decorator
+
+class DBCommandBudgetMiddleware:
+    """Counts database commands per request and checks them against the endpoint's budget"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        with record_db_commands() as recorder:
+            rejected = None
+            
+            async def send_with_count(message):
+                nonlocal rejected
+                if message["type"] == "http.response.body" and rejected is not None:
+                    # Replace the handler's response body with the budget error
+                    if rejected:
+                        await send({"type": "http.response.body", "body": rejected})
+                        rejected = b""
+                    return
+                if message["type"] == "http.response.start":
+                    route = scope.get("route")
+                    budget = getattr(getattr(route, "endpoint", None), "db_command_budget", None)
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-db-commands", str(recorder.count).encode()))
+                    if budget is not None and recorder.count > budget:
+                        label = f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+                        logger.warning(
+                            f"{label} issued {recorder.count} database commands (budget {budget}): "
+                            + ", ".join(f"{command}:{collection}" for command, collection in recorder.commands)
+                        )
+                        headers.append((b"x-db-command-budget-exceeded", str(budget).encode()))
+                        if DB_COMMAND_BUDGETS == "enforce":
+                            rejected = dump_json({
+                                "detail": f"{label} issued {recorder.count} database commands (budget {budget})"
+                            })
+                            headers = [
+                                (name, value) for name, value in headers
+                                if name.lower() not in (b"content-length", b"content-type", b"etag")
+                            ] + [
+                                (b"content-length", str(len(rejected)).encode()),
+                                (b"content-type", b"application/json")
+                            ]
+                            message = {**message, "status": 500}
+                    message = {**message, "headers": headers}
+                await send(message)
+            
+            await self.app(scope, receive, send_with_count)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[mongo_command_metrics])
 db = client[os.environ['DB_NAME']]
 
 # Authentication configuration
@@ -39,8 +342,102 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# Fast JSON serialization
+def orjson_default(value):
+    """Fallback for types orjson does not serialize natively (datetime, UUID, Enum and numpy are native)"""
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    # ObjectId, Decimal128 and similar BSON types
+    return str(value)
+
+def dump_json(content) -> bytes:
+    return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+class FastJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+# Document hydration
+# Documents the app writes from a validated model are stamped with the model's
+# schema version and served back as-is instead of being validated into a model
+# and dumped again. Anything else (older data, spreadsheet imports) still goes
+# through full pydantic validation. When a stored model changes shape, give it a
+# higher `schema_version: ClassVar[int]` and a data migration that re-stamps it.
+SCHEMA_VERSION = 1
+
+def model_schema_version(model) -> int:
+    return getattr(model, "schema_version", SCHEMA_VERSION)
+
+def to_document(obj: BaseModel) -> dict:
+    """Document for storing a validated model, stamped as trusted for hydration"""
+    document = obj.dict()
+    document["schema_version"] = model_schema_version(type(obj))
+    return document
+
+@lru_cache(maxsize=None)
+def list_type_adapter(model) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+@lru_cache(maxsize=None)
+def model_read_shape(model):
+    """Projection and field defaults that make a raw document look like `model` once serialized"""
+    projection = {"_id": 0, "schema_version": 1, **{name: 1 for name in model.model_fields}}
+    defaults = {
+        name: field.default
+        for name, field in model.model_fields.items()
+        if not field.is_required() and field.default_factory is None
+    }
+    return projection, defaults
+
+def shape_documents(model, documents: list) -> list:
+    """Make documents read with model_read_shape's projection serialize like `model`.
+
+    Documents stamped with the model's current schema version are trusted:
+    missing optional fields get the model defaults and nothing is validated.
+    Others are validated in one batch so legacy or imported data is still coerced.
+    """
+    _, defaults = model_read_shape(model)
+    schema_version = model_schema_version(model)
+    legacy_positions = []
+    for position, document in enumerate(documents):
+        if document.pop("schema_version", None) != schema_version:
+            legacy_positions.append(position)
+            continue
+        for name, default in defaults.items():
+            if name not in document:
+                document[name] = default
+    
+    if legacy_positions:
+        adapter = list_type_adapter(model)
+        validated = adapter.validate_python([documents[position] for position in legacy_positions])
+        for position, document in zip(legacy_positions, adapter.dump_python(validated)):
+            documents[position] = document
+    return documents
+
+async def trusted_find(collection, model, query: Optional[dict] = None, sort=None, limit: int = 1000) -> FastJSONResponse:
+    """Serve documents as `model` JSON straight from Mongo, without building model instances"""
+    projection, _ = model_read_shape(model)
+    cursor = collection.find(query or {}, projection)
+    if sort:
+        cursor = cursor.sort(*sort)
+    documents = await cursor.to_list(limit)
+    return FastJSONResponse(shape_documents(model, documents))
+
+async def trusted_find_one(collection, model, query: dict) -> Optional[FastJSONResponse]:
+    projection, _ = model_read_shape(model)
+    document = await collection.find_one(query, projection)
+    if document is None:
+        return None
+    return FastJSONResponse(shape_documents(model, [document])[0])
+
 # Create the main app without a prefix
-app = FastAPI(title="MediPOS API", description="Comprehensive Pharmacy Management System")
+app = FastAPI(
+    title="MediPOS API",
+    description="Comprehensive Pharmacy Management System",
+    default_response_class=FastJSONResponse
+)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -97,6 +494,10 @@ class Medicine(BaseModel):
     stock_quantity: int = 0
     minimum_stock_level: int = 10
     description: Optional[str] = None
+    # Maintained by the demand classification job
+    abc_class: Optional[str] = None
+    xyz_class: Optional[str] = None
+    classified_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -164,11 +565,20 @@ class SaleItem(BaseModel):
     unit_price: float
     total_price: float
 
+class SaleLineItem(SaleItem):
+    returned_quantity: int = 0  # Maintained by returns; never taken from the client
+    # Snapshot of the medicine at sale time, so profit does not depend on later price changes
+    unit_cost: float = 0.0
+    manufacturer: Optional[str] = None
+    generic_name: Optional[str] = None
+
 class Sale(BaseModel):
+    schema_version: ClassVar[int] = 3  # 2: items carry returned_quantity; 3: items carry unit_cost
+    
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     patient_id: Optional[str] = None
     patient_name: Optional[str] = None
-    items: List[SaleItem]
+    items: List[SaleLineItem]
     subtotal: float
     tax_amount: float = 0.0
     discount_amount: float = 0.0
@@ -186,7 +596,31 @@ class SaleCreate(BaseModel):
     total_amount: float
     payment_method: PaymentMethod
 
+class BatchSaleCreate(SaleCreate):
+    id: str  # Generated by the till so replays of the same sale are recognised
+    created_at: Optional[datetime] = None  # When the till recorded the sale
+
+class SaleBatchRequest(BaseModel):
+    sales: List[BatchSaleCreate]
+
+class SaleBatchStatus(str, Enum):
+    CREATED = "created"
+    DUPLICATE = "duplicate"
+    REJECTED = "rejected"
+
+class SaleBatchResult(BaseModel):
+    id: str
+    status: SaleBatchStatus
+    detail: Optional[str] = None
+
+class SaleBatchResponse(BaseModel):
+    created: int
+    duplicates: int
+    rejected: int
+    results: List[SaleBatchResult]
+
 class StockMovement(BaseModel):
+    schema_version: ClassVar[int] = 2  # 2: carries recorded_at
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     medicine_id: str
     medicine_name: str
@@ -197,6 +631,8 @@ class StockMovement(BaseModel):
     reference_id: Optional[str] = None  # Sale ID, Purchase ID, etc.
     notes: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    # When the server wrote the movement; differs from created_at for back-dated offline sales
+    recorded_at: datetime = Field(default_factory=datetime.utcnow)
 
 # Permission definitions
 class Permission(BaseModel):
@@ -381,6 +817,8 @@ class OPDPrescription(BaseModel):
     patient_id: str
     date: datetime = Field(default_factory=datetime.utcnow)
     consultation_fee: Optional[float] = None
+    symptoms: Optional[str] = None
+    diagnosis: Optional[str] = None
     prescription_notes: Optional[str] = None  # Handwritten prescription area
     next_visit_date: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -389,6 +827,8 @@ class OPDPrescriptionCreate(BaseModel):
     doctor_id: str
     patient_id: str
     consultation_fee: Optional[float] = None
+    symptoms: Optional[str] = None
+    diagnosis: Optional[str] = None
     prescription_notes: Optional[str] = None
     next_visit_date: Optional[datetime] = None
 
@@ -874,41 +1314,82 @@ async def create_medicine(medicine: MedicineCreate, current_user: UserInDB = Dep
     if medicine_dict.get("updated_at"):
         medicine_dict["updated_at"] = medicine_dict["updated_at"].isoformat()
         
+    medicine_dict["schema_version"] = SCHEMA_VERSION
     await db.medicines.insert_one(medicine_dict)
+    if medicine_obj.stock_quantity:
+        # Opening stock enters the ledger so point-in-time queries see it
+        await db.stock_movements.insert_one(to_document(StockMovement(
+            medicine_id=medicine_obj.id,
+            medicine_name=medicine_obj.name,
+            transaction_type=TransactionType.ADJUSTMENT,
+            quantity=medicine_obj.stock_quantity,
+            unit_price=medicine_obj.purchase_price,
+            total_value=medicine_obj.stock_quantity * medicine_obj.purchase_price,
+            notes="Opening stock",
+            created_at=medicine_obj.created_at
+        )))
     return medicine_obj
 
 @api_router.get("/medicines", response_model=List[Medicine])
 @require_permission("medicines_view")
-async def get_medicines(current_user: UserInDB = Depends(get_current_active_user)):
-    medicines = await db.medicines.find().to_list(1000)
-    return [Medicine(**medicine) for medicine in medicines]
+async def get_medicines(
+    abc_class: Optional[str] = None,
+    xyz_class: Optional[str] = None,
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    """All medicines, optionally filtered by demand class, e.g. ?abc_class=A,B&xyz_class=Z"""
+    query = {}
+    for field, requested, allowed in (("abc_class", abc_class, "ABC"), ("xyz_class", xyz_class, "XYZ")):
+        if requested:
+            classes = [value.strip().upper() for value in requested.split(",") if value.strip()]
+            if any(value not in allowed for value in classes):
+                raise HTTPException(status_code=400, detail=f"{field} takes a comma-separated list of {', '.join(allowed)}")
+            query[field] = {"$in": classes}
+    return await trusted_find(db.medicines, Medicine, query)
 
 @api_router.get("/medicines/low-stock")
 async def get_low_stock_medicines():
-    medicines = await db.medicines.find({
+    return await trusted_find(db.medicines, Medicine, {
         "$expr": {"$lt": ["$stock_quantity", "$minimum_stock_level"]}
-    }).to_list(1000)
-    return [Medicine(**medicine) for medicine in medicines]
+    })
 
 @api_router.get("/medicines/{medicine_id}", response_model=Medicine)
 async def get_medicine(medicine_id: str):
-    medicine = await db.medicines.find_one({"id": medicine_id})
-    if not medicine:
+    medicine = await trusted_find_one(db.medicines, Medicine, {"id": medicine_id})
+    if medicine is None:
         raise HTTPException(status_code=404, detail="Medicine not found")
-    return Medicine(**medicine)
+    return medicine
 
 @api_router.put("/medicines/{medicine_id}", response_model=Medicine)
 @require_permission("medicines_edit")
 async def update_medicine(medicine_id: str, medicine_update: MedicineUpdate, current_user: UserInDB = Depends(get_current_active_user)):
-    medicine = await db.medicines.find_one({"id": medicine_id})
-    if not medicine:
-        raise HTTPException(status_code=404, detail="Medicine not found")
+    from pymongo import ReturnDocument
     
     update_data = {k: v for k, v in medicine_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.medicines.update_one({"id": medicine_id}, {"$set": update_data})
-    updated_medicine = await db.medicines.find_one({"id": medicine_id})
+    # Read the previous document atomically with the write so a stock edit is
+    # recorded in the ledger with its exact delta
+    previous = await db.medicines.find_one_and_update(
+        {"id": medicine_id}, {"$set": update_data}, return_document=ReturnDocument.BEFORE
+    )
+    if not previous:
+        raise HTTPException(status_code=404, detail="Medicine not found")
+    updated_medicine = {**previous, **update_data}
+    
+    stock_delta = update_data.get("stock_quantity", previous.get("stock_quantity", 0)) - previous.get("stock_quantity", 0)
+    if stock_delta:
+        await db.stock_movements.insert_one(to_document(StockMovement(
+            medicine_id=medicine_id,
+            medicine_name=updated_medicine["name"],
+            transaction_type=TransactionType.ADJUSTMENT,
+            quantity=stock_delta,
+            unit_price=updated_medicine.get("purchase_price", 0),
+            total_value=stock_delta * updated_medicine.get("purchase_price", 0),
+            notes="Manual stock adjustment",
+            created_at=update_data["updated_at"]
+        )))
+    dashboard_broker.publish({"type": "medicine", "id": medicine_id})
     return Medicine(**updated_medicine)
 
 @api_router.delete("/medicines/{medicine_id}")
@@ -925,20 +1406,19 @@ async def delete_medicine(medicine_id: str, current_user: UserInDB = Depends(get
 async def create_patient(patient: PatientCreate):
     patient_dict = patient.dict()
     patient_obj = Patient(**patient_dict)
-    await db.patients.insert_one(patient_obj.dict())
+    await db.patients.insert_one(to_document(patient_obj))
     return patient_obj
 
 @api_router.get("/patients", response_model=List[Patient])
 async def get_patients():
-    patients = await db.patients.find().to_list(1000)
-    return [Patient(**patient) for patient in patients]
+    return await trusted_find(db.patients, Patient)
 
 @api_router.get("/patients/{patient_id}", response_model=Patient)
 async def get_patient(patient_id: str):
-    patient = await db.patients.find_one({"id": patient_id})
-    if not patient:
+    patient = await trusted_find_one(db.patients, Patient, {"id": patient_id})
+    if patient is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    return Patient(**patient)
+    return patient
 
 @api_router.put("/patients/{patient_id}", response_model=Patient)
 async def update_patient(patient_id: str, patient_update: PatientUpdate):
@@ -962,26 +1442,70 @@ async def delete_patient(patient_id: str):
 
 @api_router.get("/patients/search/{query}")
 async def search_patients(query: str):
-    patients = await db.patients.find({
+    return await trusted_find(db.patients, Patient, {
         "$or": [
             {"name": {"$regex": query, "$options": "i"}},
             {"phone": {"$regex": query, "$options": "i"}},
             {"email": {"$regex": query, "$options": "i"}}
         ]
-    }).to_list(100)
-    return [Patient(**patient) for patient in patients]
+    }, limit=100)
 
 
 # Sales Management APIs
+async def fetch_medicines_by_id(medicine_ids, projection: Optional[dict] = None) -> dict:
+    """Load several medicines with one query, keyed by id"""
+    medicines = await db.medicines.find(
+        {"id": {"$in": list(medicine_ids)}},
+        projection
+    ).to_list(None)
+    return {medicine["id"]: medicine for medicine in medicines}
+
+def snapshot_line_costs(sale_obj: Sale, medicines: dict):
+    """Copy each line's purchase cost and manufacturer from the medicine as it is now"""
+    for item in sale_obj.items:
+        medicine = medicines[item.medicine_id]
+        item.unit_cost = medicine.get("purchase_price", 0)
+        item.manufacturer = medicine.get("manufacturer")
+        item.generic_name = medicine.get("generic_name")
+
+SALE_COST_FIELDS = {"purchase_price": 1, "manufacturer": 1, "generic_name": 1}
+
+SALE_BATCH_MAX_SIZE = 1000
+# A batch sale still marked stock_pending_since after this long was stored by a request that
+# died before applying its stock; the next replay of the sale applies it
+SALE_STOCK_RECOVERY_SECONDS = 60
+
+def sale_stock_movements(sale_obj: Sale, created_at: Optional[datetime] = None) -> List[dict]:
+    return [
+        to_document(StockMovement(
+            medicine_id=item.medicine_id,
+            medicine_name=item.medicine_name,
+            transaction_type=TransactionType.SALE,
+            quantity=-item.quantity,  # Negative for sale (stock reduction)
+            unit_price=item.unit_price,
+            total_value=-item.total_price,  # Negative for sale
+            reference_id=sale_obj.id,
+            notes=f"Sale to {sale_obj.patient_name or 'Walk-in Customer'}",
+            created_at=created_at or datetime.utcnow()
+        ))
+        for item in sale_obj.items
+    ]
+
 @api_router.post("/sales", response_model=Sale)
+@db_command_budget(4)
 async def create_sale(sale: SaleCreate):
-    # Validate and update stock quantities
+    from pymongo import UpdateOne
+    
+    # Validate stock quantities for the whole basket with one query
+    medicines = await fetch_medicines_by_id({item.medicine_id for item in sale.items})
+    requested_quantities = defaultdict(int)
     for item in sale.items:
-        medicine = await db.medicines.find_one({"id": item.medicine_id})
+        medicine = medicines.get(item.medicine_id)
         if not medicine:
             raise HTTPException(status_code=404, detail=f"Medicine {item.medicine_name} not found")
         
-        if medicine["stock_quantity"] < item.quantity:
+        requested_quantities[item.medicine_id] += item.quantity
+        if medicine["stock_quantity"] < requested_quantities[item.medicine_id]:
             raise HTTPException(
                 status_code=400, 
                 detail=f"Insufficient stock for {item.medicine_name}. Available: {medicine['stock_quantity']}"
@@ -990,95 +1514,291 @@ async def create_sale(sale: SaleCreate):
     # Create sale record
     sale_dict = sale.dict()
     sale_obj = Sale(**sale_dict)
-    await db.sales.insert_one(sale_obj.dict())
+    snapshot_line_costs(sale_obj, medicines)
+    await db.sales.insert_one(to_document(sale_obj))
     
-    # Update stock quantities and create stock movements
-    for item in sale.items:
-        # Update medicine stock
-        await db.medicines.update_one(
-            {"id": item.medicine_id},
-            {"$inc": {"stock_quantity": -item.quantity}}
+    # Update stock quantities
+    await db.medicines.bulk_write([
+        UpdateOne({"id": medicine_id}, {"$inc": {"stock_quantity": -quantity}})
+        for medicine_id, quantity in requested_quantities.items()
+    ], ordered=False)
+    
+    # Create stock movement records
+    await db.stock_movements.insert_many(sale_stock_movements(sale_obj))
+    
+    dashboard_broker.publish({"type": "sale", "id": sale_obj.id, "total_amount": sale_obj.total_amount})
+    return sale_obj
+
+@api_router.post("/sales/batch", response_model=SaleBatchResponse)
+@db_command_budget(8)
+async def create_sales_batch(batch: SaleBatchRequest):
+    """Ingest sales queued by offline tills.
+
+    Idempotent on the client-generated sale id: replaying a batch reports the
+    already stored sales as duplicates and applies no stock change for them.
+    Sales are checked against stock in order; a sale that would oversell is
+    rejected without affecting the rest of the batch.
+
+    Sales are stored marked stock_pending_since and unmarked once their stock is
+    decremented. A replay finishes stored sales whose marker is older than
+    SALE_STOCK_RECOVERY_SECONDS, so a request that died in between loses no stock change.
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+    
+    if len(batch.sales) > SALE_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {SALE_BATCH_MAX_SIZE} sales")
+    
+    results = {}
+    now = datetime.utcnow()
+    stalled_before = now - timedelta(seconds=SALE_STOCK_RECOVERY_SECONDS)
+    sale_ids = [sale.id for sale in batch.sales]
+    medicine_ids = {item.medicine_id for sale in batch.sales for item in sale.items}
+    existing_sales, medicines = await asyncio.gather(
+        db.sales.find({"id": {"$in": sale_ids}}, {"_id": 0, "id": 1, "stock_pending_since": 1}).to_list(None),
+        fetch_medicines_by_id(medicine_ids, {"_id": 0, "id": 1, "stock_quantity": 1, **SALE_COST_FIELDS})
+    )
+    stalled_ids = []
+    for existing in existing_sales:
+        results[existing["id"]] = SaleBatchResult(id=existing["id"], status=SaleBatchStatus.DUPLICATE)
+        pending_since = existing.get("stock_pending_since")
+        if pending_since is not None and pending_since < stalled_before:
+            stalled_ids.append(existing["id"])
+    
+    available = {medicine_id: medicine["stock_quantity"] for medicine_id, medicine in medicines.items()}
+    applied = []
+    if stalled_ids:
+        # Claim the stalled sales first so concurrent replays cannot both apply their stock
+        claim = str(uuid.uuid4())
+        await db.sales.update_many(
+            {"id": {"$in": stalled_ids}, "stock_pending_since": {"$lt": stalled_before}},
+            {"$set": {"stock_pending_since": now, "stock_claim": claim}}
         )
+        for stored in await db.sales.find({"id": {"$in": stalled_ids}, "stock_claim": claim}, {"_id": 0}).to_list(None):
+            sale_obj = Sale(**stored)
+            requested_quantities = defaultdict(int)
+            for item in sale_obj.items:
+                requested_quantities[item.medicine_id] += item.quantity
+                if item.medicine_id in available:
+                    available[item.medicine_id] -= item.quantity
+            applied.append((sale_obj, requested_quantities))
+            results[sale_obj.id] = SaleBatchResult(
+                id=sale_obj.id, status=SaleBatchStatus.DUPLICATE, detail="Stock change applied on replay"
+            )
+    
+    # Validate stock in batch order against a running balance
+    accepted = []
+    for sale in batch.sales:
+        if sale.id in results:
+            # Already stored, or repeated within this batch
+            continue
         
-        # Create stock movement record
-        stock_movement = StockMovement(
-            medicine_id=item.medicine_id,
-            medicine_name=item.medicine_name,
-            transaction_type=TransactionType.SALE,
-            quantity=-item.quantity,  # Negative for sale (stock reduction)
-            unit_price=item.unit_price,
-            total_value=-item.total_price,  # Negative for sale
-            reference_id=sale_obj.id,
-            notes=f"Sale to {sale.patient_name or 'Walk-in Customer'}"
+        requested_quantities = defaultdict(int)
+        for item in sale.items:
+            requested_quantities[item.medicine_id] += item.quantity
+        problem = None
+        for item in sale.items:
+            if item.medicine_id not in available:
+                problem = f"Medicine {item.medicine_name} not found"
+                break
+            if available[item.medicine_id] < requested_quantities[item.medicine_id]:
+                problem = f"Insufficient stock for {item.medicine_name}. Available: {available[item.medicine_id]}"
+                break
+        if problem:
+            results[sale.id] = SaleBatchResult(id=sale.id, status=SaleBatchStatus.REJECTED, detail=problem)
+            continue
+        
+        for medicine_id, quantity in requested_quantities.items():
+            available[medicine_id] -= quantity
+        sale_obj = Sale(**sale.dict(exclude={"created_at"}), created_at=sale.created_at or now)
+        snapshot_line_costs(sale_obj, medicines)
+        accepted.append((sale_obj, requested_quantities))
+        results[sale.id] = SaleBatchResult(id=sale.id, status=SaleBatchStatus.CREATED)
+    
+    inserted = []
+    if accepted:
+        # The unique index on sales.id makes a concurrent replay of the same sale fail here
+        inserted = accepted
+        try:
+            await db.sales.insert_many(
+                [{**to_document(sale_obj), "stock_pending_since": now} for sale_obj, _ in accepted],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+            for index in failed_indexes:
+                sale_obj = accepted[index][0]
+                duplicate = any(
+                    error["index"] == index and error.get("code") == 11000
+                    for error in e.details["writeErrors"]
+                )
+                results[sale_obj.id] = SaleBatchResult(
+                    id=sale_obj.id,
+                    status=SaleBatchStatus.DUPLICATE if duplicate else SaleBatchStatus.REJECTED,
+                    detail=None if duplicate else "Failed to store sale"
+                )
+            inserted = [entry for index, entry in enumerate(accepted) if index not in failed_indexes]
+    
+    applied.extend(inserted)
+    if applied:
+        total_quantities = defaultdict(int)
+        for _, requested_quantities in applied:
+            for medicine_id, quantity in requested_quantities.items():
+                total_quantities[medicine_id] += quantity
+        await db.medicines.bulk_write([
+            UpdateOne({"id": medicine_id}, {"$inc": {"stock_quantity": -quantity}})
+            for medicine_id, quantity in total_quantities.items()
+        ], ordered=False)
+        # Unmarked right after the decrement: a failure between the two is the only way to apply stock twice
+        await db.sales.update_many(
+            {"id": {"$in": [sale_obj.id for sale_obj, _ in applied]}},
+            {"$unset": {"stock_pending_since": "", "stock_claim": ""}}
         )
-        await db.stock_movements.insert_one(stock_movement.dict())
-    
-    return sale_obj
+        await db.stock_movements.insert_many([
+            movement
+            for sale_obj, _ in applied
+            for movement in sale_stock_movements(sale_obj, sale_obj.created_at)
+        ])
+        dashboard_broker.publish({"type": "sale_batch", "count": len(applied)})
+    
+    ordered_results = []
+    reported = set()
+    for sale in batch.sales:
+        if sale.id in reported:
+            ordered_results.append(SaleBatchResult(id=sale.id, status=SaleBatchStatus.DUPLICATE, detail="Repeated in batch"))
+            continue
+        reported.add(sale.id)
+        ordered_results.append(results[sale.id])
+    
+    return SaleBatchResponse(
+        created=sum(result.status == SaleBatchStatus.CREATED for result in ordered_results),
+        duplicates=sum(result.status == SaleBatchStatus.DUPLICATE for result in ordered_results),
+        rejected=sum(result.status == SaleBatchStatus.REJECTED for result in ordered_results),
+        results=ordered_results
+    )
 
 @api_router.get("/sales", response_model=List[Sale])
 async def get_sales():
-    sales = await db.sales.find().sort("created_at", -1).to_list(1000)
-    return [Sale(**sale) for sale in sales]
+    return await trusted_find(db.sales, Sale, sort=("created_at", -1))
 
 @api_router.get("/sales/today")
 async def get_today_sales():
     today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     today_end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999)
     
-    sales = await db.sales.find({
-        "created_at": {"$gte": today_start, "$lte": today_end}
-    }).sort("created_at", -1).to_list(1000)
+    sales = await db.sales.find(
+        {"created_at": {"$gte": today_start, "$lte": today_end}},
+        model_read_shape(Sale)[0]
+    ).sort("created_at", -1).to_list(1000)
     
     total_sales = sum(sale["total_amount"] for sale in sales)
     
     return {
-        "sales": [Sale(**sale) for sale in sales],
+        "sales": shape_documents(Sale, sales),
         "total_amount": total_sales,
         "total_transactions": len(sales)
     }
 
 @api_router.get("/sales/{sale_id}", response_model=Sale)
 async def get_sale(sale_id: str):
-    sale = await db.sales.find_one({"id": sale_id})
-    if not sale:
+    sale = await trusted_find_one(db.sales, Sale, {"id": sale_id})
+    if sale is None:
         raise HTTPException(status_code=404, detail="Sale not found")
-    return Sale(**sale)
+    return sale
 
 
 # Return/Refund Management APIs
+def sale_line_has_room(line_index: int, quantity: int) -> dict:
+    """$expr condition: the sale line can take `quantity` more returned units"""
+    return {"$let": {
+        "vars": {"line": {"$arrayElemAt": ["$items", line_index]}},
+        "in": {"$lte": [
+            {"$add": [{"$ifNull": ["$$line.returned_quantity", 0]}, quantity]},
+            "$$line.quantity"
+        ]}
+    }}
+
 @api_router.post("/returns", response_model=Return)
+@db_command_budget(5)
 async def create_return(return_data: ReturnCreate):
+    from pymongo import UpdateOne
+    
+    # An empty return would leave nothing to $inc, which the server rejects
+    if not return_data.items:
+        raise HTTPException(status_code=400, detail="Return must include at least one item")
+    
     # Validate original sale exists
-    original_sale = await db.sales.find_one({"id": return_data.original_sale_id})
+    original_sale = await db.sales.find_one({"id": return_data.original_sale_id}, {"_id": 0, "items": 1})
     if not original_sale:
         raise HTTPException(status_code=404, detail="Original sale not found")
     
-    # Validate return items against original sale
+    # Allocate returned quantities to the sale's lines for each medicine that still have room
+    lines_by_medicine = defaultdict(list)
+    remaining = []
+    for line_index, item in enumerate(original_sale["items"]):
+        lines_by_medicine[item["medicine_id"]].append(line_index)
+        remaining.append(item["quantity"] - item.get("returned_quantity", 0))
+    
+    line_increments = defaultdict(int)
     for return_item in return_data.items:
-        original_item = next((item for item in original_sale["items"] if item["medicine_id"] == return_item.medicine_id), None)
-        if not original_item:
+        line_indexes = lines_by_medicine.get(return_item.medicine_id)
+        if not line_indexes:
             raise HTTPException(status_code=400, detail=f"Medicine {return_item.medicine_name} was not in original sale")
+        if return_item.quantity <= 0:
+            raise HTTPException(status_code=400, detail=f"Return quantity for {return_item.medicine_name} must be positive")
         
-        if return_item.quantity > original_item["quantity"]:
+        quantity = return_item.quantity
+        for line_index in line_indexes:
+            allocated = min(quantity, remaining[line_index])
+            if allocated > 0:
+                remaining[line_index] -= allocated
+                line_increments[line_index] += allocated
+                quantity -= allocated
+        if quantity > 0:
             raise HTTPException(
                 status_code=400, 
                 detail=f"Cannot return more {return_item.medicine_name} than originally purchased"
             )
     
+    # Record the returned quantities only if every line still has room, in one atomic update,
+    # so concurrent partial returns cannot together exceed what was sold
+    increments = {f"items.{line_index}.returned_quantity": quantity for line_index, quantity in line_increments.items()}
+    result = await db.sales.update_one(
+        {
+            "id": return_data.original_sale_id,
+            "$expr": {"$and": [sale_line_has_room(line_index, quantity) for line_index, quantity in line_increments.items()]}
+        },
+        {"$inc": increments}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(
+            status_code=409,
+            detail="Another return for this sale was recorded meanwhile; the requested quantities are no longer returnable"
+        )
+    
     # Create return record
     return_obj = Return(**return_data.dict())
-    await db.returns.insert_one(return_obj.dict())
+    try:
+        await db.returns.insert_one(to_document(return_obj))
+    except Exception:
+        await db.sales.update_one(
+            {"id": return_data.original_sale_id},
+            {"$inc": {path: -quantity for path, quantity in increments.items()}}
+        )
+        raise
     
-    # Update stock quantities and create stock movements
+    # Update stock quantities (add back returned quantity)
+    returned_quantities = defaultdict(int)
     for item in return_data.items:
-        # Update medicine stock (add back returned quantity)
-        await db.medicines.update_one(
-            {"id": item.medicine_id},
-            {"$inc": {"stock_quantity": item.quantity}}
-        )
-        
-        # Create stock movement record
-        stock_movement = StockMovement(
+        returned_quantities[item.medicine_id] += item.quantity
+    await db.medicines.bulk_write([
+        UpdateOne({"id": medicine_id}, {"$inc": {"stock_quantity": quantity}})
+        for medicine_id, quantity in returned_quantities.items()
+    ], ordered=False)
+    
+    # Create stock movement records
+    stock_movements = [
+        to_document(StockMovement(
             medicine_id=item.medicine_id,
             medicine_name=item.medicine_name,
             transaction_type=TransactionType.REFUND,
@@ -1087,57 +1807,413 @@ async def create_return(return_data: ReturnCreate):
             total_value=item.total_price,  # Positive for return
             reference_id=return_obj.id,
             notes=f"Return from sale #{return_data.original_sale_id[-8:]} - Reason: {return_data.reason or 'No reason provided'}"
-        )
-        await db.stock_movements.insert_one(stock_movement.dict())
+        ))
+        for item in return_data.items
+    ]
+    await db.stock_movements.insert_many(stock_movements)
     
+    dashboard_broker.publish({"type": "return", "id": return_obj.id, "total_amount": return_obj.total_amount})
     return return_obj
 
 @api_router.get("/returns", response_model=List[Return])
 async def get_returns():
-    returns = await db.returns.find().sort("created_at", -1).to_list(1000)
-    return [Return(**return_record) for return_record in returns]
+    return await trusted_find(db.returns, Return, sort=("created_at", -1))
 
 @api_router.get("/returns/{return_id}", response_model=Return)
 async def get_return(return_id: str):
-    return_record = await db.returns.find_one({"id": return_id})
-    if not return_record:
+    return_record = await trusted_find_one(db.returns, Return, {"id": return_id})
+    if return_record is None:
         raise HTTPException(status_code=404, detail="Return not found")
-    return Return(**return_record)
+    return return_record
 
 @api_router.get("/sales/patient/{patient_id}")
 async def get_patient_sales(patient_id: str):
-    sales = await db.sales.find({"patient_id": patient_id}).sort("created_at", -1).to_list(100)
-    return [Sale(**sale) for sale in sales]
+    return await trusted_find(db.sales, Sale, {"patient_id": patient_id}, sort=("created_at", -1), limit=100)
 
 @api_router.get("/returns/sale/{sale_id}")
 async def get_sale_returns(sale_id: str):
-    returns = await db.returns.find({"original_sale_id": sale_id}).sort("created_at", -1).to_list(1000)
-    return [Return(**return_record) for return_record in returns]
+    return await trusted_find(db.returns, Return, {"original_sale_id": sale_id}, sort=("created_at", -1))
 
 
 # Stock Movement APIs
 @api_router.get("/stock-movements", response_model=List[StockMovement])
 async def get_stock_movements():
-    movements = await db.stock_movements.find().sort("created_at", -1).to_list(1000)
-    return [StockMovement(**movement) for movement in movements]
+    return await trusted_find(db.stock_movements, StockMovement, sort=("created_at", -1))
 
 @api_router.get("/stock-movements/{medicine_id}")
 async def get_medicine_stock_movements(medicine_id: str):
-    movements = await db.stock_movements.find({"medicine_id": medicine_id}).sort("created_at", -1).to_list(1000)
-    return [StockMovement(**movement) for movement in movements]
+    return await trusted_find(db.stock_movements, StockMovement, {"medicine_id": medicine_id}, sort=("created_at", -1))
+
+# Stock Ledger Checkpoints
+class StockCheckpoint(BaseModel):
+    """Snapshot of every medicine's stock, the starting point for replaying the movement ledger"""
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    as_of: datetime
+    balances: dict  # medicine_id -> stock_quantity
+    medicine_count: int
+    created_at: datetime = Field(default_factory=datetime.utcnow)
 
+async def write_stock_checkpoint() -> StockCheckpoint:
+    medicines = await db.medicines.find({}, {"_id": 0, "id": 1, "stock_quantity": 1}).to_list(None)
+    # Taken after reading: stock changes write their movement after the $inc, so a
+    # movement recorded before this instant is already in the balances read above
+    as_of = datetime.utcnow()
+    checkpoint = StockCheckpoint(
+        as_of=as_of,
+        balances={medicine["id"]: medicine.get("stock_quantity", 0) for medicine in medicines},
+        medicine_count=len(medicines)
+    )
+    await db.stock_checkpoints.insert_one(checkpoint.dict())
+    return checkpoint
 
-# Advanced Analytics APIs
-@api_router.get("/analytics/comprehensive")
-async def get_comprehensive_analytics(
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    date_range: Optional[str] = None  # today, yesterday, this_week, this_month, custom
-):
-    """Get comprehensive analytics with date range filtering"""
-    from datetime import datetime, timedelta
+def parse_as_of(value: str) -> datetime:
+    """Naive UTC instant for an ISO date or datetime; a bare date means the end of that day"""
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be an ISO date or datetime, e.g. 2026-03-31")
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if len(value) == 10:
+        parsed = parsed.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return parsed
+
+@api_router.get("/stock/as-of")
+@db_command_budget(4)
+async def get_stock_as_of(date: str, medicine_id: Optional[str] = None):
+    """Stock on hand at a past instant.
+
+    Starts from the nearest checkpoint at or before `date` and adds the movements
+    recorded since. Dates older than the first checkpoint are answered backward from
+    it by subtracting the movements in between, which is only as complete as the
+    ledger for that period. Movements are placed by recorded_at, when they changed
+    stock, not by the sale time a back-dated offline sale carries.
+    """
+    as_of = parse_as_of(date)
+    
+    checkpoint = await db.stock_checkpoints.find_one({"as_of": {"$lte": as_of}}, sort=[("as_of", -1)])
+    direction = 1
+    if checkpoint is None:
+        checkpoint = await db.stock_checkpoints.find_one({"as_of": {"$gt": as_of}}, sort=[("as_of", 1)])
+        direction = -1
+    if checkpoint is None:
+        raise HTTPException(status_code=404, detail="No stock checkpoint has been recorded yet")
+    
+    if direction == 1:
+        window = {"$gt": checkpoint["as_of"], "$lte": as_of}
+    else:
+        window = {"$gt": as_of, "$lte": checkpoint["as_of"]}
+    movement_match = {"recorded_at": window}
+    medicine_query = {}
+    if medicine_id:
+        movement_match["medicine_id"] = medicine_id
+        medicine_query["id"] = medicine_id
+    
+    movement_totals, medicines = await asyncio.gather(
+        db.stock_movements.aggregate([
+            {"$match": movement_match},
+            {"$group": {"_id": "$medicine_id", "quantity": {"$sum": "$quantity"}, "movements": {"$sum": 1}}}
+        ]).to_list(None),
+        db.medicines.find(medicine_query, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    )
+    
+    balances = {
+        key: quantity for key, quantity in checkpoint["balances"].items()
+        if not medicine_id or key == medicine_id
+    }
+    for total in movement_totals:
+        balances[total["_id"]] = balances.get(total["_id"], 0) + direction * total["quantity"]
+    names = {medicine["id"]: medicine["name"] for medicine in medicines}
+    
+    items = [
+        {"medicine_id": key, "medicine_name": names.get(key), "stock_quantity": quantity}
+        for key, quantity in balances.items()
+    ]
+    items.sort(key=lambda item: (item["medicine_name"] or "").lower())
+    return {
+        "as_of": as_of,
+        "checkpoint": {"id": checkpoint["id"], "as_of": checkpoint["as_of"]},
+        "direction": "forward" if direction == 1 else "backward",
+        "movements_applied": sum(total["movements"] for total in movement_totals),
+        "items": items
+    }
+
+
+# Analytics Response Cache
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Set by the launcher when running several workers: generations are then also shared through Mongo
+CACHE_SHARED_GENERATIONS = os.environ.get("CACHE_SHARED_GENERATIONS", "false").lower() == "true"
+CACHE_SYNC_SECONDS = float(os.environ.get("CACHE_SYNC_SECONDS", "1"))
+CACHE_GENERATIONS_COLLECTION = "cache_generations"
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    etag: str
+    generations: tuple
+    expires_at: float
+
+class ResponseCache:
+    """LRU cache of rendered JSON responses with a TTL and a total byte cap.
+
+    Every entry records the write generation of the collections it was computed
+    from; a write to any of them (seen by the Mongo command listener) bumps the
+    generation and makes the entry stale. Only collections registered with track()
+    have generations, so writes elsewhere, e.g. scheduler lock heartbeats, cost
+    nothing. Listener callbacks arrive on Motor's executor threads, hence the lock.
+
+    With several worker processes each worker only sees its own writes, so in
+    shared mode local writes are also counted in a Mongo document that every
+    worker polls; other workers' counts become part of the generation.
+    """
+    
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        from collections import OrderedDict
+        
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._tracked = set()
+        self._generations = defaultdict(int)
+        self._remote_generations = {}         # collection -> writes made by other workers
+        self._own_shared_writes = defaultdict(int)
+        self._dirty = set()
+        self._sync_task = None
+        self.shared = False
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def track(self, collections):
+        """Register collections that cached responses are computed from"""
+        self._tracked.update(collections)
+    
+    def invalidate(self, collection: str):
+        if collection not in self._tracked:
+            return
+        with self._lock:
+            self._generations[collection] += 1
+            self.invalidations += 1
+            if self.shared:
+                self._dirty.add(collection)
+    
+    def _current(self, collections) -> tuple:
+        return tuple(
+            (self._generations[collection], self._remote_generations.get(collection, 0))
+            for collection in collections
+        )
+    
+    def generations(self, collections) -> tuple:
+        with self._lock:
+            return self._current(collections)
+    
+    async def _sync_shared_generations(self):
+        while True:
+            try:
+                with self._lock:
+                    dirty, self._dirty = self._dirty, set()
+                if dirty:
+                    try:
+                        await db[CACHE_GENERATIONS_COLLECTION].update_one(
+                            {"_id": "response_cache"},
+                            {"$inc": {collection: 1 for collection in dirty}},
+                            upsert=True
+                        )
+                    except Exception:
+                        with self._lock:
+                            self._dirty |= dirty
+                        raise
+                    with self._lock:
+                        for collection in dirty:
+                            self._own_shared_writes[collection] += 1
+                shared = await db[CACHE_GENERATIONS_COLLECTION].find_one({"_id": "response_cache"}) or {}
+                shared.pop("_id", None)
+                with self._lock:
+                    # Discount this worker's own increments; those were already applied locally
+                    remote = {
+                        collection: count - self._own_shared_writes[collection]
+                        for collection, count in shared.items()
+                    }
+                    changed = [
+                        collection for collection, count in remote.items()
+                        if self._remote_generations.get(collection, 0) != count
+                    ]
+                    self._remote_generations = remote
+                if changed:
+                    dashboard_broker.publish({"type": "remote", "collections": changed})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Response cache generation sync failed: {str(e)}")
+            await asyncio.sleep(CACHE_SYNC_SECONDS)
+    
+    def start_shared_sync(self):
+        self.shared = True
+        self._sync_task = asyncio.ensure_future(self._sync_shared_generations())
+    
+    def stop_shared_sync(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+    
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self.size_bytes -= len(entry.body)
+    
+    def get(self, key, collections) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            current = self._current(collections)
+            if entry is None or entry.generations != current or entry.expires_at < time.monotonic():
+                if entry is not None:
+                    self._pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def set(self, key, body: bytes, generations: tuple) -> CachedResponse:
+        entry = CachedResponse(
+            body=body,
+            etag='"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"',
+            generations=generations,
+            expires_at=time.monotonic() + self.ttl_seconds
+        )
+        if len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = entry
+            self.size_bytes += len(body)
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+    
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+    
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "shared": self.shared,
+                "generations": dict(self._generations),
+                "remote_generations": dict(self._remote_generations)
+            }
+
+class SingleFlight:
+    """Coalesces concurrent identical calls into one in-flight computation.
+
+    The first caller for a key starts the work as a task; callers arriving while
+    it runs await the same task. Callers await through asyncio.shield so one
+    client disconnecting does not cancel the work the others are waiting on.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+    
+    async def do(self, key, compute):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._calls[key] = task
+            self.executed += 1
+            
+            def forget(finished, key=key):
+                if self._calls.get(key) is finished:
+                    del self._calls[key]
+                if not finished.cancelled():
+                    finished.exception()  # mark retrieved when every waiter has gone away
+            
+            task.add_done_callback(forget)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+    
+    def stats(self) -> dict:
+        calls = self.executed + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "coalesced_rate": round(self.coalesced / calls, 4) if calls else 0.0
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS)
+analytics_flights = SingleFlight()
+mongo_command_metrics.write_listeners.append(response_cache.invalidate)
+
+ANALYTICS_CACHE_COLLECTIONS = ("sales", "returns", "opd_prescriptions", "medicines")
+response_cache.track(ANALYTICS_CACHE_COLLECTIONS)
+
+async def get_cached_entry(key: tuple, collections, compute):
+    """Return (entry, "HIT"/"MISS") for compute() rendered as JSON through the response cache"""
+    entry = response_cache.get(key, collections)
+    cache_status = "HIT"
+    if entry is None:
+        # Capture generations before computing so a write landing mid-computation invalidates the result
+        generations = response_cache.generations(collections)
+        
+        async def compute_and_store():
+            result = await compute()
+            return response_cache.set(key, dump_json(result), generations)
+        
+        # Concurrent misses for the same key and data generation share one computation
+        entry = await analytics_flights.do((key, generations), compute_and_store)
+        cache_status = "MISS"
+    return entry, cache_status
+
+async def cached_json_response(request: Request, key: tuple, collections, compute):
+    """Serve compute() through the response cache, answering If-None-Match with 304"""
+    from fastapi.responses import Response
+    
+    entry, cache_status = await get_cached_entry(key, collections, compute)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache", "X-Cache": cache_status}
+    if request.headers.get("if-none-match") == entry.etag:
+        response_cache.record_not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+def resolve_date_range(start_date: Optional[str], end_date: Optional[str], date_range: Optional[str]):
+    """Turn the analytics date filter (today, yesterday, this_week, this_month, custom) into
+    (start, end, applied_range): naive UTC datetimes and the name of the range actually used.
+
+    These three values are all a response depends on, so they also form its cache key.
+    """
+    def parse(value: str) -> datetime:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
     
-    # Parse date range
     now = datetime.utcnow()
     
     if date_range == "today":
@@ -1155,89 +2231,117 @@ async def get_comprehensive_analytics(
         start_dt = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         end_dt = now.replace(hour=23, minute=59, second=59, microsecond=999999)
     elif date_range == "custom" and start_date and end_date:
-        start_dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-        end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+        try:
+            start_dt, end_dt = parse(start_date), parse(end_date)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="start_date and end_date must be ISO dates")
     else:
         # Default to this month
+        date_range = "this_month"
         start_dt = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         end_dt = now.replace(hour=23, minute=59, second=59, microsecond=999999)
     
-    # Get sales data for the period
-    sales = await db.sales.find({
-        "created_at": {"$gte": start_dt, "$lte": end_dt}
-    }).to_list(10000)
-    
-    # Get consultation data for the period
-    consultations = await db.opd_prescriptions.find({
-        "created_at": {"$gte": start_dt, "$lte": end_dt},
-        "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
-    }).to_list(10000)
+    return start_dt, end_dt, date_range
+
+@api_router.get("/cache/stats")
+async def get_cache_stats():
+    """Analytics response cache, request coalescing and document render cache statistics for this worker"""
+    return {
+        **response_cache.stats(),
+        "single_flight": analytics_flights.stats(),
+        "render": {**render_cache.stats(), "compiled_templates": template_compiler.compiled}
+    }
+
+# Advanced Analytics APIs
+@api_router.get("/analytics/comprehensive")
+@db_command_budget(2)
+async def get_comprehensive_analytics(
+    request: Request,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    date_range: Optional[str] = None  # today, yesterday, this_week, this_month, custom
+):
+    """Get comprehensive analytics with date range filtering"""
+    start_dt, end_dt, date_range = resolve_date_range(start_date, end_date, date_range)
+    return await cached_json_response(
+        request,
+        ("analytics/comprehensive", date_range, start_dt, end_dt),
+        ANALYTICS_CACHE_COLLECTIONS,
+        lambda: compute_comprehensive_analytics(start_dt, end_dt, date_range)
+    )
+
+async def compute_comprehensive_analytics(start_dt: datetime, end_dt: datetime, date_range: str):
+    # Sales are summarised in Mongo from the costs snapshotted on each line; no medicine lookups
+    sales_summary, consultation_totals = await asyncio.gather(
+        db.sales.aggregate([
+            {"$match": {"created_at": {"$gte": start_dt, "$lte": end_dt}}},
+            {"$facet": {
+                "totals": [{"$group": {
+                    "_id": None,
+                    "revenue": {"$sum": "$total_amount"},
+                    "transactions": {"$sum": 1}
+                }}],
+                "payments": [{"$group": {
+                    "_id": "$payment_method",
+                    "count": {"$sum": 1},
+                    "amount": {"$sum": "$total_amount"}
+                }}],
+                "medicines": [
+                    {"$unwind": "$items"},
+                    {"$group": {
+                        "_id": "$items.medicine_id",
+                        "medicine_name": {"$last": "$items.medicine_name"},
+                        "manufacturer": {"$last": "$items.manufacturer"},
+                        "generic_name": {"$last": "$items.generic_name"},
+                        "quantity": {"$sum": "$items.quantity"},
+                        "revenue": {"$sum": "$items.total_price"},
+                        "cost": {"$sum": {"$multiply": ["$items.quantity", {"$ifNull": ["$items.unit_cost", 0]}]}}
+                    }}
+                ]
+            }}
+        ]).to_list(1),
+        consultation_totals_between(start_dt, end_dt)
+    )
+    facets = sales_summary[0] if sales_summary else {}
+    totals = (facets.get("totals") or [{}])[0]
     
     # Calculate totals
-    medicine_revenue = sum(sale["total_amount"] for sale in sales)
-    consultation_revenue = sum(consultation.get("consultation_fee", 0) for consultation in consultations)
+    medicine_revenue = totals.get("revenue", 0)
+    consultation_revenue = consultation_totals["revenue"]
     total_revenue = medicine_revenue + consultation_revenue
     
     # Medicine analysis with profit margins
-    medicine_analysis = {}
+    medicine_analysis = []
     total_cost = 0
-    
-    for sale in sales:
-        for item in sale["items"]:
-            med_id = item["medicine_id"]
-            
-            # Get medicine details for cost calculation
-            medicine = await db.medicines.find_one({"id": med_id})
-            if medicine:
-                purchase_price = medicine.get("purchase_price", 0)
-                cost = purchase_price * item["quantity"]
-                profit = item["total_price"] - cost
-                profit_margin = (profit / item["total_price"] * 100) if item["total_price"] > 0 else 0
-                
-                if med_id in medicine_analysis:
-                    medicine_analysis[med_id]["quantity"] += item["quantity"]
-                    medicine_analysis[med_id]["revenue"] += item["total_price"]
-                    medicine_analysis[med_id]["cost"] += cost
-                    medicine_analysis[med_id]["profit"] += profit
-                else:
-                    medicine_analysis[med_id] = {
-                        "medicine_name": item["medicine_name"],
-                        "manufacturer": medicine.get("manufacturer", "N/A"),
-                        "generic_name": medicine.get("generic_name", "N/A"),
-                        "quantity": item["quantity"],
-                        "revenue": item["total_price"],
-                        "cost": cost,
-                        "profit": profit,
-                        "purchase_price": purchase_price,
-                        "selling_price": medicine.get("selling_price", 0)
-                    }
-                
-                total_cost += cost
-    
-    # Calculate profit margins for each medicine
-    for med_id in medicine_analysis:
-        med = medicine_analysis[med_id]
-        med["profit_margin"] = (med["profit"] / med["revenue"] * 100) if med["revenue"] > 0 else 0
+    for med in facets.get("medicines", []):
+        profit = med["revenue"] - med["cost"]
+        medicine_analysis.append({
+            "medicine_name": med["medicine_name"],
+            "manufacturer": med.get("manufacturer") or "N/A",
+            "generic_name": med.get("generic_name") or "N/A",
+            "quantity": med["quantity"],
+            "revenue": med["revenue"],
+            "cost": med["cost"],
+            "profit": profit,
+            "profit_margin": (profit / med["revenue"] * 100) if med["revenue"] > 0 else 0,
+            # Averages over the period's lines
+            "purchase_price": med["cost"] / med["quantity"] if med["quantity"] else 0,
+            "selling_price": med["revenue"] / med["quantity"] if med["quantity"] else 0
+        })
+        total_cost += med["cost"]
     
     # Sort medicines by revenue
-    top_medicines = sorted(medicine_analysis.values(), key=lambda x: x["revenue"], reverse=True)
+    top_medicines = sorted(medicine_analysis, key=lambda x: x["revenue"], reverse=True)
     
     # Payment method breakdown
-    payment_breakdown = {}
-    for sale in sales:
-        payment_method = sale.get("payment_method", "unknown")
-        if payment_method in payment_breakdown:
-            payment_breakdown[payment_method]["count"] += 1
-            payment_breakdown[payment_method]["amount"] += sale["total_amount"]
-        else:
-            payment_breakdown[payment_method] = {
-                "count": 1,
-                "amount": sale["total_amount"]
-            }
+    payment_breakdown = {
+        (payment["_id"] or "unknown"): {"count": payment["count"], "amount": payment["amount"]}
+        for payment in facets.get("payments", [])
+    }
     
     # Manufacturer/Category breakdown
     manufacturer_breakdown = {}
-    for med_data in medicine_analysis.values():
+    for med_data in medicine_analysis:
         manufacturer = med_data["manufacturer"]
         if manufacturer in manufacturer_breakdown:
             manufacturer_breakdown[manufacturer]["quantity"] += med_data["quantity"]
@@ -1254,7 +2358,7 @@ async def get_comprehensive_analytics(
         "period": {
             "start_date": start_dt.isoformat(),
             "end_date": end_dt.isoformat(),
-            "date_range": date_range or "custom"
+            "date_range": date_range
         },
         "summary": {
             "total_revenue": total_revenue,
@@ -1263,66 +2367,111 @@ async def get_comprehensive_analytics(
             "total_cost": total_cost,
             "total_profit": medicine_revenue - total_cost,
             "profit_margin": ((medicine_revenue - total_cost) / medicine_revenue * 100) if medicine_revenue > 0 else 0,
-            "total_transactions": len(sales),
-            "total_consultations": len(consultations)
+            "total_transactions": totals.get("transactions", 0),
+            "total_consultations": consultation_totals["count"]
         },
         "medicine_analysis": top_medicines,
         "payment_breakdown": payment_breakdown,
         "manufacturer_breakdown": manufacturer_breakdown
     }
 
+async def consultation_totals_between(start_dt: datetime, end_dt: datetime) -> dict:
+    """Paid consultation count and revenue for the period"""
+    result = await db.opd_prescriptions.aggregate([
+        {"$match": {
+            "created_at": {"$gte": start_dt, "$lte": end_dt},
+            "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
+        }},
+        {"$group": {"_id": None, "revenue": {"$sum": "$consultation_fee"}, "count": {"$sum": 1}}}
+    ]).to_list(1)
+    return result[0] if result else {"revenue": 0, "count": 0}
+
+# Cost of a sale from its snapshotted line costs
+SALE_COST_EXPRESSION = {"$reduce": {
+    "input": "$items",
+    "initialValue": 0,
+    "in": {"$add": ["$$value", {"$multiply": ["$$this.quantity", {"$ifNull": ["$$this.unit_cost", 0]}]}]}
+}}
+
+async def revenue_by_period(start_dt: datetime, end_dt: datetime, period_format: str) -> dict:
+    """Sales and consultation totals grouped by created_at formatted with `period_format`.
+
+    Two aggregations cover the whole range however many periods it spans.
+    """
+    period = {"$dateToString": {"format": period_format, "date": "$created_at"}}
+    sales, consultations = await asyncio.gather(
+        db.sales.aggregate([
+            {"$match": {"created_at": {"$gte": start_dt, "$lte": end_dt}}},
+            {"$group": {
+                "_id": period,
+                "medicine_revenue": {"$sum": "$total_amount"},
+                "total_cost": {"$sum": SALE_COST_EXPRESSION},
+                "transaction_count": {"$sum": 1}
+            }}
+        ]).to_list(None),
+        db.opd_prescriptions.aggregate([
+            {"$match": {
+                "created_at": {"$gte": start_dt, "$lte": end_dt},
+                "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
+            }},
+            {"$group": {
+                "_id": period,
+                "consultation_revenue": {"$sum": "$consultation_fee"},
+                "consultation_count": {"$sum": 1}
+            }}
+        ]).to_list(None)
+    )
+    
+    periods = defaultdict(lambda: {
+        "medicine_revenue": 0,
+        "consultation_revenue": 0,
+        "total_cost": 0,
+        "transaction_count": 0,
+        "consultation_count": 0
+    })
+    for row in sales + consultations:
+        periods[row.pop("_id")].update(row)
+    return periods
+
+def period_comparison_row(totals: dict) -> dict:
+    return {
+        "medicine_revenue": totals["medicine_revenue"],
+        "consultation_revenue": totals["consultation_revenue"],
+        "total_revenue": totals["medicine_revenue"] + totals["consultation_revenue"],
+        "total_cost": totals["total_cost"],
+        "profit": totals["medicine_revenue"] - totals["total_cost"],
+        "transaction_count": totals["transaction_count"],
+        "consultation_count": totals["consultation_count"]
+    }
+
 @api_router.get("/analytics/monthly-comparison")
+@db_command_budget(2)
 async def get_monthly_comparison(months: int = 12):
     """Get month-over-month sales comparison"""
-    from datetime import datetime, timedelta
     import calendar
     
     now = datetime.utcnow()
-    monthly_data = []
-    
+    month_starts = []
     for i in range(months):
-        # Calculate month start and end
         month_date = now.replace(day=1) - timedelta(days=i*30)
-        month_start = month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        # Get last day of month
-        last_day = calendar.monthrange(month_start.year, month_start.month)[1]
-        month_end = month_start.replace(day=last_day, hour=23, minute=59, second=59, microsecond=999999)
-        
-        # Get sales for this month
-        sales = await db.sales.find({
-            "created_at": {"$gte": month_start, "$lte": month_end}
-        }).to_list(10000)
-        
-        # Get consultations for this month
-        consultations = await db.opd_prescriptions.find({
-            "created_at": {"$gte": month_start, "$lte": month_end},
-            "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
-        }).to_list(10000)
-        
-        medicine_revenue = sum(sale["total_amount"] for sale in sales)
-        consultation_revenue = sum(consultation.get("consultation_fee", 0) for consultation in consultations)
-        
-        # Calculate costs and profits
-        total_cost = 0
-        for sale in sales:
-            for item in sale["items"]:
-                medicine = await db.medicines.find_one({"id": item["medicine_id"]})
-                if medicine:
-                    cost = medicine.get("purchase_price", 0) * item["quantity"]
-                    total_cost += cost
-        
-        monthly_data.append({
+        month_starts.append(month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+    if not month_starts:
+        return {"monthly_data": []}
+    
+    # Get last day of the newest month
+    newest = max(month_starts)
+    last_day = calendar.monthrange(newest.year, newest.month)[1]
+    range_end = newest.replace(day=last_day, hour=23, minute=59, second=59, microsecond=999999)
+    periods = await revenue_by_period(min(month_starts), range_end, "%Y-%m")
+    
+    monthly_data = [
+        {
             "month": month_start.strftime("%Y-%m"),
             "month_name": month_start.strftime("%B %Y"),
-            "medicine_revenue": medicine_revenue,
-            "consultation_revenue": consultation_revenue,
-            "total_revenue": medicine_revenue + consultation_revenue,
-            "total_cost": total_cost,
-            "profit": medicine_revenue - total_cost,
-            "transaction_count": len(sales),
-            "consultation_count": len(consultations)
-        })
+            **period_comparison_row(periods[month_start.strftime("%Y-%m")])
+        }
+        for month_start in month_starts
+    ]
     
     # Sort by month (newest first)
     monthly_data.sort(key=lambda x: x["month"], reverse=True)
@@ -1330,110 +2479,141 @@ async def get_monthly_comparison(months: int = 12):
     return {"monthly_data": monthly_data}
 
 @api_router.get("/analytics/yearly-comparison")
+@db_command_budget(2)
 async def get_yearly_comparison(years: int = 3):
     """Get year-over-year sales comparison"""
-    from datetime import datetime
-    
     now = datetime.utcnow()
-    yearly_data = []
+    if years < 1:
+        return {"yearly_data": []}
     
-    for i in range(years):
-        year = now.year - i
-        year_start = datetime(year, 1, 1, 0, 0, 0, 0)
-        year_end = datetime(year, 12, 31, 23, 59, 59, 999999)
-        
-        # Get sales for this year
-        sales = await db.sales.find({
-            "created_at": {"$gte": year_start, "$lte": year_end}
-        }).to_list(10000)
-        
-        # Get consultations for this year
-        consultations = await db.opd_prescriptions.find({
-            "created_at": {"$gte": year_start, "$lte": year_end},
-            "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
-        }).to_list(10000)
-        
-        medicine_revenue = sum(sale["total_amount"] for sale in sales)
-        consultation_revenue = sum(consultation.get("consultation_fee", 0) for consultation in consultations)
-        
-        # Calculate costs and profits
-        total_cost = 0
-        for sale in sales:
-            for item in sale["items"]:
-                medicine = await db.medicines.find_one({"id": item["medicine_id"]})
-                if medicine:
-                    cost = medicine.get("purchase_price", 0) * item["quantity"]
-                    total_cost += cost
-        
-        yearly_data.append({
-            "year": year,
-            "medicine_revenue": medicine_revenue,
-            "consultation_revenue": consultation_revenue,
-            "total_revenue": medicine_revenue + consultation_revenue,
-            "total_cost": total_cost,
-            "profit": medicine_revenue - total_cost,
-            "transaction_count": len(sales),
-            "consultation_count": len(consultations)
-        })
+    periods = await revenue_by_period(
+        datetime(now.year - years + 1, 1, 1, 0, 0, 0, 0),
+        datetime(now.year, 12, 31, 23, 59, 59, 999999),
+        "%Y"
+    )
+    yearly_data = [
+        {"year": year, **period_comparison_row(periods[str(year)])}
+        for year in range(now.year, now.year - years, -1)
+    ]
     
     return {"yearly_data": yearly_data}
 
+async def inventory_summary() -> dict:
+    """Medicine count, low stock count and stock valuation at purchase price in one round-trip"""
+    result = await db.medicines.aggregate([
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "total_medicines": {"$sum": 1},
+                "inventory_value": {"$sum": {"$multiply": [
+                    {"$max": [{"$ifNull": ["$stock_quantity", 0]}, 0]},
+                    {"$ifNull": ["$purchase_price", 0]}
+                ]}}
+            }}],
+            "low_stock": [
+                {"$match": {"$expr": {"$lt": ["$stock_quantity", "$minimum_stock_level"]}}},
+                {"$count": "count"}
+            ]
+        }}
+    ]).to_list(1)
+    facets = result[0] if result else {}
+    totals = facets.get("totals") or [{}]
+    low_stock = facets.get("low_stock") or [{}]
+    return {
+        "total_medicines": totals[0].get("total_medicines", 0),
+        "low_stock_items": low_stock[0].get("count", 0),
+        "inventory_value": totals[0].get("inventory_value", 0)
+    }
+
+async def cost_of_goods_sold_between(start_dt: datetime, end_dt: datetime) -> float:
+    """Snapshotted cost of the units sold in the period and not returned"""
+    result = await db.sales.aggregate([
+        {"$match": {"created_at": {"$gte": start_dt, "$lte": end_dt}}},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": None,
+            "cost": {"$sum": {"$multiply": [
+                {"$subtract": ["$items.quantity", {"$ifNull": ["$items.returned_quantity", 0]}]},
+                {"$ifNull": ["$items.unit_cost", 0]}
+            ]}}
+        }}
+    ]).to_list(1)
+    return result[0]["cost"] if result else 0
+
+async def repeat_patients_between(prev_start: datetime, start_dt: datetime, end_dt: datetime) -> dict:
+    """Patients who bought in the previous period, and how many of them bought again in this one"""
+    result = await db.sales.aggregate([
+        {"$match": {
+            "created_at": {"$gte": prev_start, "$lte": end_dt},
+            "patient_id": {"$nin": [None, ""]}
+        }},
+        {"$group": {
+            "_id": None,
+            "previous": {"$addToSet": {"$cond": [{"$lt": ["$created_at", start_dt]}, "$patient_id", None]}},
+            "current": {"$addToSet": {"$cond": [{"$gte": ["$created_at", start_dt]}, "$patient_id", None]}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "previous": {"$size": {"$setDifference": ["$previous", [None]]}},
+            "returning": {"$size": {"$setDifference": [{"$setIntersection": ["$previous", "$current"]}, [None]]}}
+        }}
+    ]).to_list(1)
+    return result[0] if result else {"previous": 0, "returning": 0}
+
 @api_router.get("/analytics/kpis")
+@db_command_budget(7)
 async def get_analytics_kpis(
+    request: Request,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     date_range: Optional[str] = None
 ):
     """Get Key Performance Indicators"""
-    from datetime import datetime, timedelta
+    start_dt, end_dt, date_range = resolve_date_range(start_date, end_date, date_range)
+    return await cached_json_response(
+        request,
+        ("analytics/kpis", date_range, start_dt, end_dt),
+        ANALYTICS_CACHE_COLLECTIONS,
+        lambda: compute_analytics_kpis(start_dt, end_dt, date_range)
+    )
+
+async def compute_analytics_kpis(start_dt: datetime, end_dt: datetime, date_range: str):
+    # Previous period for comparison
+    period_length = end_dt - start_dt
+    prev_start = start_dt - period_length
+    prev_end = start_dt
     
-    # Parse date range (same logic as comprehensive analytics)
-    now = datetime.utcnow()
-    
-    if date_range == "today":
-        start_dt = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_dt = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-    elif date_range == "yesterday":
-        yesterday = now - timedelta(days=1)
-        start_dt = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_dt = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-    elif date_range == "this_week":
-        start_dt = now - timedelta(days=now.weekday())
-        start_dt = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_dt = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-    elif date_range == "this_month":
-        start_dt = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        end_dt = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-    elif date_range == "custom" and start_date and end_date:
-        start_dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-        end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-    else:
-        start_dt = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        end_dt = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-    
-    # Current period data
-    current_sales = await db.sales.find({
-        "created_at": {"$gte": start_dt, "$lte": end_dt}
-    }).to_list(10000)
-    
-    current_consultations = await db.opd_prescriptions.find({
-        "created_at": {"$gte": start_dt, "$lte": end_dt},
-        "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
-    }).to_list(10000)
-    
-    # Previous period for comparison
-    period_length = end_dt - start_dt
-    prev_start = start_dt - period_length
-    prev_end = start_dt
-    
-    prev_sales = await db.sales.find({
-        "created_at": {"$gte": prev_start, "$lte": prev_end}
-    }).to_list(10000)
-    
-    prev_consultations = await db.opd_prescriptions.find({
-        "created_at": {"$gte": prev_start, "$lte": prev_end},
-        "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
-    }).to_list(10000)
+    # Current and previous period data plus inventory, COGS and retention, queried concurrently
+    (
+        current_sales,
+        current_consultations,
+        prev_sales,
+        prev_consultations,
+        inventory,
+        cost_of_goods_sold,
+        retention
+    ) = await asyncio.gather(
+        db.sales.find({
+            "created_at": {"$gte": start_dt, "$lte": end_dt}
+        }).to_list(10000),
+        db.opd_prescriptions.find({
+            "created_at": {"$gte": start_dt, "$lte": end_dt},
+            "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
+        }).to_list(10000),
+        db.sales.find({
+            "created_at": {"$gte": prev_start, "$lte": prev_end}
+        }).to_list(10000),
+        db.opd_prescriptions.find({
+            "created_at": {"$gte": prev_start, "$lte": prev_end},
+            "consultation_fee": {"$exists": True, "$ne": None, "$gt": 0}
+        }).to_list(10000),
+        inventory_summary(),
+        cost_of_goods_sold_between(start_dt, end_dt),
+        repeat_patients_between(prev_start, start_dt, end_dt)
+    )
+    total_medicines = inventory["total_medicines"]
+    low_stock_count = inventory["low_stock_items"]
+    inventory_value = inventory["inventory_value"]
     
     # Calculate current metrics
     current_medicine_revenue = sum(sale["total_amount"] for sale in current_sales)
@@ -1457,18 +2637,21 @@ async def get_analytics_kpis(
     
     # Customer metrics
     unique_patients = len(set(sale.get("patient_id") for sale in current_sales if sale.get("patient_id")))
+    # Share of the previous period's patients who bought again in this one
+    customer_retention = (
+        retention["returning"] / retention["previous"] * 100 if retention["previous"] else 0
+    )
     
-    # Stock metrics
-    total_medicines = await db.medicines.count_documents({})
-    low_stock_count = await db.medicines.count_documents({
-        "$expr": {"$lt": ["$stock_quantity", "$minimum_stock_level"]}
-    })
+    # Turnover against the stock value on hand now; days of inventory at the period's COGS rate
+    stock_turnover = cost_of_goods_sold / inventory_value if inventory_value else 0
+    period_days = max(period_length.total_seconds() / 86400, 1)
+    days_of_inventory = inventory_value / (cost_of_goods_sold / period_days) if cost_of_goods_sold else None
     
     return {
         "period": {
             "start_date": start_dt.isoformat(),
             "end_date": end_dt.isoformat(),
-            "date_range": date_range or "custom"
+            "date_range": date_range
         },
         "revenue_kpis": {
             "total_revenue": {
@@ -1503,13 +2686,900 @@ async def get_analytics_kpis(
         },
         "customer_kpis": {
             "unique_patients": unique_patients,
-            "customer_retention": 0  # Can be enhanced later
+            "returning_patients": retention["returning"],
+            "customer_retention": customer_retention
         },
         "inventory_kpis": {
             "total_medicines": total_medicines,
             "low_stock_items": low_stock_count,
-            "stock_turnover": 0  # Can be enhanced later
+            "inventory_value": inventory_value,
+            "cost_of_goods_sold": cost_of_goods_sold,
+            "stock_turnover": stock_turnover,
+            "days_of_inventory": days_of_inventory
+        }
+    }
+
+# Sales Cube
+SALES_CUBE_LOAD_BATCH = int(os.environ.get("SALES_CUBE_LOAD_BATCH", "5000"))
+# ObjectIds from several workers are only ordered to the second, so each refresh re-reads this window
+SALES_CUBE_OVERLAP_SECONDS = 5
+# Bumped when sales are replaced wholesale, so every worker's cube reloads from scratch
+SALES_CUBE_EPOCH_ID = "sales_cube_epoch"
+SALES_CUBE_DIMENSIONS = ("medicine", "manufacturer", "payment_method", "hour", "weekday", "day")
+SALES_CUBE_COLUMNS = {
+    "medicine": np.int32,
+    "manufacturer": np.int32,
+    "payment_method": np.int32,
+    "hour": np.int8,
+    "weekday": np.int8,
+    "day": np.int32,       # days since 1970-01-01 (UTC)
+    "timestamp": np.int64, # seconds since epoch (UTC)
+    "quantity": np.int64,
+    "revenue": np.float64,
+    "cost": np.float64
+}
+
+def parse_stored_datetime(value: str) -> Optional[datetime]:
+    """Naive UTC datetime for a date stored as text, as restores from JSON backups used to leave them"""
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+class CubeDimension:
+    """Dictionary encoding of a string dimension: value -> code, plus a display label per code"""
+    
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+        self.labels = []
+    
+    def encode(self, value, label=None) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            self.labels.append(label if label is not None else value)
+        elif label is not None:
+            self.labels[code] = label  # latest name wins, e.g. after a rename
+        return code
+
+class SalesCube:
+    """Sale lines held as NumPy columns for group-by and filter queries.
+
+    String dimensions are dictionary encoded. The cube loads lazily on first use
+    and then extends from sales inserted since the last load, tracked by _id; it
+    refreshes only when the response cache has seen a write to sales. Lines are
+    gross sales as recorded at sale time, so later returns do not change them.
+    """
+    
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._epoch = None
+        self._clear()
+    
+    async def reset(self):
+        """Reload from scratch on next use in every worker; call before sales are replaced, e.g. by a restore"""
+        await db[CACHE_GENERATIONS_COLLECTION].update_one({"_id": SALES_CUBE_EPOCH_ID}, {"$inc": {"epoch": 1}}, upsert=True)
+        self._reset_requested = True
+    
+    def _clear(self):
+        self._reset_requested = False
+        self.size = 0
+        self.columns = {name: np.empty(0, dtype=dtype) for name, dtype in SALES_CUBE_COLUMNS.items()}
+        self.dimensions = {name: CubeDimension() for name in ("medicine", "manufacturer", "payment_method")}
+        self.sales = 0
+        self._watermark = None       # generation time of the newest ingested _id
+        self._recent_ids = {}        # _id -> generation time, within the overlap window
+        self._generations = None
+        self.loaded_at = None
+    
+    def _append(self, batch: dict):
+        count = len(batch["quantity"])
+        if not count:
+            return
+        needed = self.size + count
+        capacity = len(self.columns["quantity"])
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, 1024)
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.columns[name] = grown
+        for name, values in batch.items():
+            self.columns[name][self.size:needed] = values
+        self.size = needed
+    
+    def _encode_sales(self, sales: list) -> dict:
+        batch = {name: [] for name in SALES_CUBE_COLUMNS}
+        medicines = self.dimensions["medicine"]
+        manufacturers = self.dimensions["manufacturer"]
+        payment_methods = self.dimensions["payment_method"]
+        for sale in sales:
+            created_at = sale["created_at"]
+            timestamp = int(created_at.replace(tzinfo=timezone.utc).timestamp())
+            payment_code = payment_methods.encode(sale.get("payment_method") or "unknown")
+            for item in sale.get("items", []):
+                quantity = item.get("quantity", 0)
+                batch["medicine"].append(medicines.encode(item["medicine_id"], item.get("medicine_name")))
+                batch["manufacturer"].append(manufacturers.encode(item.get("manufacturer") or "N/A"))
+                batch["payment_method"].append(payment_code)
+                batch["hour"].append(created_at.hour)
+                batch["weekday"].append(created_at.weekday())
+                batch["day"].append(timestamp // 86400)
+                batch["timestamp"].append(timestamp)
+                batch["quantity"].append(quantity)
+                batch["revenue"].append(item.get("total_price", 0))
+                batch["cost"].append(quantity * (item.get("unit_cost") or 0))
+        return {name: np.asarray(values, dtype=SALES_CUBE_COLUMNS[name]) for name, values in batch.items()}
+    
+    async def refresh(self):
+        """Ingest sales inserted since the last refresh"""
+        from bson import ObjectId
+        
+        async with self._lock:
+            if self._reset_requested:
+                self._clear()
+            generations = response_cache.generations(("sales",))
+            if self.loaded_at is not None and generations == self._generations:
+                return
+            
+            # Another worker may have replaced the sales since this cube loaded
+            epoch = (await db[CACHE_GENERATIONS_COLLECTION].find_one({"_id": SALES_CUBE_EPOCH_ID}) or {}).get("epoch", 0)
+            if self._epoch is not None and epoch != self._epoch:
+                self._clear()
+            self._epoch = epoch
+            
+            query = {}
+            if self._watermark is not None:
+                since = self._watermark - timedelta(seconds=SALES_CUBE_OVERLAP_SECONDS)
+                query["_id"] = {"$gte": ObjectId.from_datetime(since)}
+            cursor = db.sales.find(query, {
+                "_id": 1, "created_at": 1, "payment_method": 1,
+                "items.medicine_id": 1, "items.medicine_name": 1, "items.manufacturer": 1,
+                "items.quantity": 1, "items.total_price": 1, "items.unit_cost": 1
+            }).sort("_id", 1).batch_size(SALES_CUBE_LOAD_BATCH)
+            
+            pending = []
+            async for sale in cursor:
+                if isinstance(sale.get("created_at"), str):
+                    sale["created_at"] = parse_stored_datetime(sale["created_at"])
+                if sale["_id"] in self._recent_ids or not isinstance(sale.get("created_at"), datetime):
+                    continue
+                generated_at = sale["_id"].generation_time.replace(tzinfo=None)
+                self._recent_ids[sale["_id"]] = generated_at
+                self._watermark = max(self._watermark or generated_at, generated_at)
+                pending.append(sale)
+                if len(pending) >= SALES_CUBE_LOAD_BATCH:
+                    self._append(await asyncio.to_thread(self._encode_sales, pending))
+                    self.sales += len(pending)
+                    pending = []
+            if pending:
+                self._append(await asyncio.to_thread(self._encode_sales, pending))
+                self.sales += len(pending)
+            
+            if self._watermark is not None:
+                horizon = self._watermark - timedelta(seconds=SALES_CUBE_OVERLAP_SECONDS)
+                self._recent_ids = {key: at for key, at in self._recent_ids.items() if at >= horizon}
+            self._generations = generations
+            self.loaded_at = datetime.utcnow()
+    
+    async def snapshot(self) -> tuple:
+        """Refreshed column views, dimension labels and keys (per code) and codes (per key)
+        that later appends will not disturb"""
+        await self.refresh()
+        async with self._lock:
+            columns = {name: column[:self.size] for name, column in self.columns.items()}
+            labels = {name: list(dimension.labels) for name, dimension in self.dimensions.items()}
+            keys = {name: list(dimension.values) for name, dimension in self.dimensions.items()}
+            values = {name: dict(dimension.codes) for name, dimension in self.dimensions.items()}
+        return columns, labels, keys, values
+    
+    def stats(self) -> dict:
+        return {
+            "lines": self.size,
+            "sales": self.sales,
+            "memory_bytes": sum(column.nbytes for column in self.columns.values()),
+            "loaded_at": self.loaded_at
+        }
+
+def query_sales_cube(columns: dict, labels: dict, dimension_keys: dict, group_by: List[str], mask, limit: int) -> List[dict]:
+    """Sum the measures of the masked lines per combination of the group_by dimensions.
+
+    Medicine rows carry the medicine's name and, as medicine_id, its id.
+    """
+    selected = {name: column[mask] for name, column in columns.items()} if mask is not None else columns
+    count = len(selected["quantity"])
+    
+    if group_by and count:
+        keys, sizes, offsets = [], [], {}
+        for name in group_by:
+            codes = selected[name].astype(np.int64)
+            if name == "day":
+                offsets[name] = int(codes.min())
+                codes = codes - offsets[name]
+            keys.append(codes)
+            sizes.append(int(codes.max()) + 1)
+        combined = np.ravel_multi_index(keys, sizes)
+        key_space = int(np.prod(sizes))
+        if key_space <= max(count, 1 << 20):
+            # Dense key space: bucket directly, no sort needed
+            groups = np.flatnonzero(np.bincount(combined, minlength=key_space))
+            inverse, buckets = combined, key_space
+        else:
+            groups, inverse = np.unique(combined, return_inverse=True)
+            buckets = len(groups)
+        group_codes = np.unravel_index(groups, sizes)
+    else:
+        groups = np.zeros(1 if count else 0, dtype=np.int64)
+        inverse, buckets = np.zeros(count, dtype=np.int64), len(groups)
+        group_codes = []
+    
+    def total(weights=None):
+        sums = np.bincount(inverse, weights=weights, minlength=buckets)
+        return sums[groups] if buckets != len(groups) else sums
+    
+    measures = {
+        "lines": total(),
+        "quantity": total(selected["quantity"]),
+        "revenue": total(selected["revenue"]),
+        "cost": total(selected["cost"])
+    }
+    order = np.argsort(-measures["revenue"], kind="stable")[:limit]
+    
+    rows = []
+    for position in order.tolist():
+        row = {}
+        for name, codes in zip(group_by, group_codes):
+            code = int(codes[position])
+            if name in labels:
+                row[name] = labels[name][code]
+                if name == "medicine":
+                    row["medicine_id"] = dimension_keys[name][code]
+            elif name == "day":
+                row[name] = (datetime(1970, 1, 1) + timedelta(days=code + offsets[name])).date().isoformat()
+            else:
+                row[name] = code
+        revenue = float(measures["revenue"][position])
+        cost = float(measures["cost"][position])
+        row.update({
+            "lines": int(measures["lines"][position]),
+            "quantity": int(measures["quantity"][position]),
+            "revenue": revenue,
+            "cost": cost,
+            "profit": revenue - cost,
+            "profit_margin": (revenue - cost) / revenue * 100 if revenue > 0 else 0
+        })
+        rows.append(row)
+    return rows
+
+sales_cube = SalesCube()
+
+def parse_cube_list(value: Optional[str]) -> List[str]:
+    return [part.strip() for part in value.split(",") if part.strip()] if value else []
+
+@api_router.get("/analytics/cube")
+async def get_sales_cube(
+    group_by: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    medicine_id: Optional[str] = None,
+    manufacturer: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    hour: Optional[str] = None,
+    weekday: Optional[str] = None,
+    limit: int = 1000
+):
+    """Revenue and profit of sale lines grouped by any of medicine, manufacturer,
+    payment_method, hour, weekday and day (UTC). Filters take comma-separated values;
+    start_date and end_date are ISO dates or datetimes, a bare end date is inclusive.
+    """
+    dimensions = parse_cube_list(group_by)
+    unknown = [name for name in dimensions if name not in SALES_CUBE_DIMENSIONS]
+    if unknown or len(set(dimensions)) != len(dimensions):
+        raise HTTPException(
+            status_code=400,
+            detail=f"group_by takes distinct values from: {', '.join(SALES_CUBE_DIMENSIONS)}"
+        )
+    
+    columns, labels, keys, values = await sales_cube.snapshot()
+    
+    def compute():
+        started = time.perf_counter()
+        mask = None
+        
+        def narrow(condition):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+        
+        if start_date:
+            start = parse_as_of(start_date + "T00:00:00" if len(start_date) == 10 else start_date)
+            narrow(columns["timestamp"] >= int(start.replace(tzinfo=timezone.utc).timestamp()))
+        if end_date:
+            end = parse_as_of(end_date)
+            narrow(columns["timestamp"] <= int(end.replace(tzinfo=timezone.utc).timestamp()))
+        for name, requested in (("medicine", medicine_id), ("manufacturer", manufacturer), ("payment_method", payment_method)):
+            if requested:
+                codes = [values[name][value] for value in parse_cube_list(requested) if value in values[name]]
+                narrow(np.isin(columns[name], codes))
+        for name, requested in (("hour", hour), ("weekday", weekday)):
+            if requested:
+                try:
+                    narrow(np.isin(columns[name], [int(value) for value in parse_cube_list(requested)]))
+                except ValueError:
+                    raise HTTPException(status_code=400, detail=f"{name} takes comma-separated integers")
+        
+        rows = query_sales_cube(columns, labels, keys, dimensions, mask, limit)
+        return rows, (time.perf_counter() - started) * 1000
+    
+    rows, elapsed_ms = await asyncio.to_thread(compute)
+    return {
+        "group_by": dimensions,
+        "rows": rows,
+        "query_ms": round(elapsed_ms, 3),
+        "cube": sales_cube.stats()
+    }
+
+# Inventory Planning APIs
+REORDER_MAX_LOOKBACK_DAYS = 730
+
+class ForecastMethod(str, Enum):
+    SMA = "sma"
+    EMA = "ema"
+
+def daily_demand_matrix(columns: dict, medicine_codes, first_day: int, days: int):
+    """Units sold per day from sales cube columns, for the medicines in medicine_codes that sold in the window.
+
+    Returns the positions in medicine_codes of those medicines and a float32 matrix with
+    one row per position and one column per day. A code of -1 marks a medicine that never sold.
+    """
+    in_window = (columns["day"] >= first_day) & (columns["day"] < first_day + days)
+    codes = columns["medicine"][in_window].astype(np.int64)
+    offsets = columns["day"][in_window].astype(np.int64) - first_day
+    sold = np.flatnonzero(np.isin(medicine_codes, codes))
+    
+    # Cube code -> output row; lines of medicines not asked for land in a spare last row
+    count = len(sold)
+    row_of_code = np.full(int(max(codes.max(initial=-1), medicine_codes.max(initial=-1))) + 1, count, dtype=np.int64)
+    row_of_code[medicine_codes[sold]] = np.arange(count)
+    
+    demand = np.bincount(
+        row_of_code[codes] * days + offsets,
+        weights=columns["quantity"][in_window],
+        minlength=(count + 1) * days
+    ).reshape(count + 1, days)
+    return sold, demand[:count].astype(np.float32)
+
+def forecast_daily_demand(demand, method: ForecastMethod, window: int, alpha: float):
+    """Next-day demand forecast for every row at once"""
+    if method == ForecastMethod.SMA:
+        return demand[:, -window:].mean(axis=1, dtype=np.float64)
+    # s_T = (1-a)^(T-1) x_0 + sum a (1-a)^(T-1-t) x_t, seeded with the first day, as one matrix-vector product
+    days = demand.shape[1]
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1, dtype=np.float64)
+    weights[0] = (1 - alpha) ** (days - 1)
+    return demand @ weights
+
+def compute_reorder_suggestions(
+    columns: dict,
+    medicine_codes: dict,
+    medicines: list,
+    lookback_days: int,
+    method: ForecastMethod,
+    window: int,
+    alpha: float,
+    lead_time_days: int,
+    cover_days: int,
+    service_level: float,
+    only_reorder: bool
+) -> List[dict]:
+    from statistics import NormalDist
+    
+    today = int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()) // 86400
+    codes = np.array([medicine_codes.get(medicine["id"], -1) for medicine in medicines], dtype=np.int64)
+    # Complete days only: today is still partial
+    sold, demand = daily_demand_matrix(columns, codes, today - lookback_days, lookback_days)
+    
+    # Medicines without sales in the lookback forecast zero demand with no variability
+    forecast = np.zeros(len(medicines))
+    volatility = np.zeros(len(medicines))
+    forecast[sold] = forecast_daily_demand(demand, method, window, alpha)
+    volatility[sold] = demand[:, -window:].std(axis=1, dtype=np.float64)
+    safety_stock = NormalDist().inv_cdf(service_level) * volatility * np.sqrt(lead_time_days)
+    reorder_point = forecast * lead_time_days + safety_stock
+    stock = np.array([medicine.get("stock_quantity", 0) for medicine in medicines], dtype=np.float64)
+    order_up_to = reorder_point + forecast * cover_days
+    suggested = np.where(stock <= reorder_point, np.ceil(np.maximum(order_up_to - stock, 0)), 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_of_cover = np.where(forecast > 0, stock / forecast, np.inf)
+    
+    suggestions = []
+    for position in np.argsort(days_of_cover, kind="stable").tolist():
+        needs_reorder = bool(suggested[position] > 0)
+        if only_reorder and not needs_reorder:
+            continue
+        medicine = medicines[position]
+        suggestions.append({
+            "medicine_id": medicine["id"],
+            "medicine_name": medicine.get("name"),
+            "stock_quantity": medicine.get("stock_quantity", 0),
+            "minimum_stock_level": medicine.get("minimum_stock_level"),
+            "forecast_daily_demand": round(float(forecast[position]), 3),
+            "demand_std": round(float(volatility[position]), 3),
+            "safety_stock": round(float(safety_stock[position]), 1),
+            "reorder_point": round(float(reorder_point[position]), 1),
+            "suggested_order_quantity": int(suggested[position]),
+            "days_of_cover": round(float(days_of_cover[position]), 1) if np.isfinite(days_of_cover[position]) else None,
+            "needs_reorder": needs_reorder
+        })
+    return suggestions
+
+@api_router.get("/inventory/reorder-suggestions")
+async def get_reorder_suggestions(
+    request: Request,
+    method: ForecastMethod = ForecastMethod.EMA,
+    lookback_days: int = 365,
+    window: int = 28,
+    alpha: float = 0.2,
+    lead_time_days: int = 7,
+    cover_days: int = 30,
+    service_level: float = 0.95,
+    only_reorder: bool = True
+):
+    """Reorder points and order quantities from each medicine's daily sales.
+
+    Demand is forecast with a simple (sma, over `window` days) or exponential (ema,
+    smoothing `alpha`) moving average. Safety stock covers demand variability over
+    the last `window` days through the lead time at the given service level; a
+    medicine at or below its reorder point is topped up to `cover_days` of demand
+    beyond it.
+    """
+    if not 1 <= lookback_days <= REORDER_MAX_LOOKBACK_DAYS:
+        raise HTTPException(status_code=400, detail=f"lookback_days must be between 1 and {REORDER_MAX_LOOKBACK_DAYS}")
+    if not 1 <= window <= lookback_days:
+        raise HTTPException(status_code=400, detail="window must be between 1 and lookback_days")
+    if not 0 < alpha <= 1:
+        raise HTTPException(status_code=400, detail="alpha must be in (0, 1]")
+    if not 0.5 <= service_level < 1:
+        raise HTTPException(status_code=400, detail="service_level must be in [0.5, 1)")
+    if lead_time_days < 1 or cover_days < 0:
+        raise HTTPException(status_code=400, detail="lead_time_days must be positive and cover_days not negative")
+    
+    async def compute():
+        (columns, _, _, values), medicines = await asyncio.gather(
+            sales_cube.snapshot(),
+            db.medicines.find({}, {"_id": 0, "id": 1, "name": 1, "stock_quantity": 1, "minimum_stock_level": 1}).to_list(None)
+        )
+        suggestions = await asyncio.to_thread(
+            compute_reorder_suggestions, columns, values["medicine"], medicines, lookback_days, method,
+            window, alpha, lead_time_days, cover_days, service_level, only_reorder
+        )
+        return {
+            "parameters": {
+                "method": method,
+                "lookback_days": lookback_days,
+                "window": window,
+                "alpha": alpha,
+                "lead_time_days": lead_time_days,
+                "cover_days": cover_days,
+                "service_level": service_level
+            },
+            "generated_at": datetime.utcnow(),
+            "count": len(suggestions),
+            "suggestions": suggestions
         }
+    
+    return await cached_json_response(
+        request,
+        ("inventory/reorder-suggestions", datetime.utcnow().date().isoformat(), method.value, lookback_days,
+         window, alpha, lead_time_days, cover_days, service_level, only_reorder),
+        ("sales", "medicines"),
+        compute
+    )
+
+# Daily Rollups and Demand Classification
+CLASSIFICATION_WINDOW_DAYS = int(os.environ.get("CLASSIFICATION_WINDOW_DAYS", "365"))
+ABC_THRESHOLDS = (0.8, 0.95)  # cumulative revenue share closing classes A and B
+XYZ_THRESHOLDS = (0.5, 1.0)   # coefficient of variation of daily demand closing classes X and Y
+MEDICINE_ROLLUP_STATE_ID = "medicine_daily_sales"
+
+async def rollup_medicine_sales_day(day: datetime) -> List[str]:
+    """Store per-medicine totals of the sales made on `day` (UTC) and return the medicine ids"""
+    from pymongo import UpdateOne
+    
+    key = day.strftime("%Y-%m-%d")
+    rows = await db.sales.aggregate([
+        {"$match": {"created_at": {"$gte": day, "$lt": day + timedelta(days=1)}}},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": "$items.medicine_id",
+            "quantity": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": "$items.total_price"},
+            "cost": {"$sum": {"$multiply": ["$items.quantity", {"$ifNull": ["$items.unit_cost", 0]}]}},
+            "lines": {"$sum": 1}
+        }}
+    ]).to_list(None)
+    medicine_ids = [row.pop("_id") for row in rows]
+    if rows:
+        await db.medicine_daily_sales.bulk_write([
+            UpdateOne({"day": key, "medicine_id": medicine_id}, {"$set": row}, upsert=True)
+            for medicine_id, row in zip(medicine_ids, rows)
+        ], ordered=False)
+    return medicine_ids
+
+async def refresh_demand_stats(medicine_ids: Optional[List[str]], window_start: str, window_end: str):
+    """Recompute window totals from the daily rollups for the given medicines (all when None)"""
+    from pymongo import UpdateOne
+    
+    match = {"day": {"$gte": window_start, "$lte": window_end}}
+    if medicine_ids is not None:
+        match["medicine_id"] = {"$in": medicine_ids}
+    totals = await db.medicine_daily_sales.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": "$medicine_id",
+            "quantity": {"$sum": "$quantity"},
+            "quantity_sq": {"$sum": {"$multiply": ["$quantity", "$quantity"]}},
+            "revenue": {"$sum": "$revenue"},
+            "days_sold": {"$sum": 1}
+        }}
+    ]).to_list(None)
+    
+    by_medicine = {row.pop("_id"): row for row in totals}
+    empty = {"quantity": 0, "quantity_sq": 0, "revenue": 0, "days_sold": 0}
+    operations = [
+        UpdateOne(
+            {"medicine_id": medicine_id},
+            {"$set": {**by_medicine.get(medicine_id, empty), "window_start": window_start, "window_end": window_end}},
+            upsert=True
+        )
+        for medicine_id in (medicine_ids if medicine_ids is not None else by_medicine)
+    ]
+    for start in range(0, len(operations), MIGRATION_BATCH_SIZE):
+        await db.medicine_demand_stats.bulk_write(operations[start:start + MIGRATION_BATCH_SIZE], ordered=False)
+    if medicine_ids is None:
+        await db.medicine_demand_stats.delete_many({"medicine_id": {"$nin": list(by_medicine)}})
+
+def classify_demand(revenue, quantity, quantity_sq, window_days: int) -> tuple:
+    """ABC by cumulative revenue share and XYZ by coefficient of variation of daily demand, for all medicines at once"""
+    total = revenue.sum()
+    order = np.argsort(-revenue, kind="stable")
+    share_before = np.empty_like(revenue)
+    if total > 0:
+        # Share of revenue from higher-ranked medicines: the one crossing a threshold still belongs above it
+        share_before[order] = (np.cumsum(revenue[order]) - revenue[order]) / total
+    else:
+        share_before[:] = 1
+    abc = np.where(
+        revenue <= 0, "C",
+        np.where(share_before < ABC_THRESHOLDS[0], "A", np.where(share_before < ABC_THRESHOLDS[1], "B", "C"))
+    )
+    
+    mean = quantity / window_days
+    std = np.sqrt(np.maximum(quantity_sq / window_days - mean ** 2, 0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variation = np.where(mean > 0, std / mean, np.inf)
+    xyz = np.where(variation <= XYZ_THRESHOLDS[0], "X", np.where(variation <= XYZ_THRESHOLDS[1], "Y", "Z"))
+    return abc.tolist(), xyz.tolist()
+
+async def classify_medicines(window_days: int) -> int:
+    """Store ABC/XYZ classes on every medicine whose class changed; returns the number changed"""
+    from pymongo import UpdateOne
+    
+    medicines, stats = await asyncio.gather(
+        db.medicines.find({}, {"_id": 0, "id": 1, "abc_class": 1, "xyz_class": 1}).to_list(None),
+        db.medicine_demand_stats.find({}, {"_id": 0, "medicine_id": 1, "quantity": 1, "quantity_sq": 1, "revenue": 1}).to_list(None)
+    )
+    if not medicines:
+        return 0
+    stats = {row["medicine_id"]: row for row in stats}
+    empty = {"quantity": 0, "quantity_sq": 0, "revenue": 0}
+    rows = [stats.get(medicine["id"], empty) for medicine in medicines]
+    abc, xyz = await asyncio.to_thread(
+        classify_demand,
+        np.array([row["revenue"] for row in rows], dtype=np.float64),
+        np.array([row["quantity"] for row in rows], dtype=np.float64),
+        np.array([row["quantity_sq"] for row in rows], dtype=np.float64),
+        window_days
+    )
+    
+    classified_at = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"id": medicine["id"]},
+            {"$set": {"abc_class": abc_class, "xyz_class": xyz_class, "classified_at": classified_at}}
+        )
+        for medicine, abc_class, xyz_class in zip(medicines, abc, xyz)
+        if (medicine.get("abc_class"), medicine.get("xyz_class")) != (abc_class, xyz_class)
+    ]
+    for start in range(0, len(operations), MIGRATION_BATCH_SIZE):
+        await db.medicines.bulk_write(operations[start:start + MIGRATION_BATCH_SIZE], ordered=False)
+    return len(operations)
+
+async def run_demand_classification(window_days: int = CLASSIFICATION_WINDOW_DAYS) -> str:
+    """Roll up the days completed since the last run, then reclassify.
+
+    Only the new days' sales are read. Window totals are recomputed from the
+    rollups for just the medicines sold on a day entering or leaving the window,
+    so re-running after a failure is safe. The first run, and the first run after
+    window_days changes, rolls up the whole window. Sales back-dated into a day
+    that was already rolled up are not picked up.
+    """
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    last_day = today - timedelta(days=1)
+    window_start = last_day - timedelta(days=window_days - 1)
+    
+    state = await db.rollup_state.find_one({"_id": MEDICINE_ROLLUP_STATE_ID})
+    rolled_through = datetime.strptime(state["through"], "%Y-%m-%d") if state else None
+    window_changed = rolled_through is None or state.get("window_days") != window_days
+    # A wider window reaches days that were never rolled up; rollups are upserts, so redoing the rest is harmless
+    first_day = window_start if window_changed else max(rolled_through + timedelta(days=1), window_start)
+    
+    touched = set()
+    day = first_day
+    while day <= last_day:
+        touched.update(await rollup_medicine_sales_day(day))
+        day += timedelta(days=1)
+    
+    window_start_key, last_day_key = window_start.strftime("%Y-%m-%d"), last_day.strftime("%Y-%m-%d")
+    if window_changed:
+        await refresh_demand_stats(None, window_start_key, last_day_key)
+    else:
+        # Medicines sold on the days that have just left the window
+        previous_start = rolled_through - timedelta(days=window_days - 1)
+        if previous_start < window_start:
+            touched.update(await db.medicine_daily_sales.distinct("medicine_id", {"day": {
+                "$gte": previous_start.strftime("%Y-%m-%d"), "$lt": window_start_key
+            }}))
+        if touched:
+            await refresh_demand_stats(sorted(touched), window_start_key, last_day_key)
+    
+    await db.rollup_state.update_one(
+        {"_id": MEDICINE_ROLLUP_STATE_ID},
+        {"$set": {"through": last_day_key, "window_days": window_days, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    changed = await classify_medicines(window_days)
+    return f"rolled up {(last_day - first_day).days + 1} days, reclassified {changed} medicines"
+
+# Revenue Anomaly Detection
+ANOMALY_WINDOW_DAYS = int(os.environ.get("ANOMALY_WINDOW_DAYS", "28"))
+ANOMALY_MIN_HISTORY_DAYS = 7  # trading days needed in the window before a day is judged
+ANOMALY_THRESHOLD = float(os.environ.get("ANOMALY_THRESHOLD", "3.5"))
+STORE_ROLLUP_STATE_ID = "store_daily_rollups"
+
+class AnomalyKind(str, Enum):
+    REVENUE = "revenue"
+    REFUNDS = "refunds"
+    HOUR = "hour"
+    PAYMENT_MIX = "payment_mix"
+
+class RevenueAnomaly(BaseModel):
+    day: str
+    kind: AnomalyKind
+    key: Optional[str] = None  # hour of day or payment method
+    value: float
+    median: float
+    scale: float
+    score: float
+    direction: str  # high or low
+    detected_at: datetime = Field(default_factory=datetime.utcnow)
+
+async def rollup_store_day(day: datetime) -> dict:
+    """Revenue, refunds, payment split and hourly revenue of `day` (UTC), stored in store_daily_rollups"""
+    window = {"$gte": day, "$lt": day + timedelta(days=1)}
+    sales, refunds = await asyncio.gather(
+        db.sales.aggregate([
+            {"$match": {"created_at": window}},
+            {"$facet": {
+                "totals": [{"$group": {"_id": None, "revenue": {"$sum": "$total_amount"}, "transactions": {"$sum": 1}}}],
+                "payments": [{"$group": {"_id": "$payment_method", "amount": {"$sum": "$total_amount"}}}],
+                "hours": [{"$group": {"_id": {"$hour": "$created_at"}, "revenue": {"$sum": "$total_amount"}}}]
+            }}
+        ]).to_list(1),
+        db.returns.aggregate([
+            {"$match": {"created_at": window}},
+            {"$group": {"_id": None, "refunds": {"$sum": "$total_amount"}, "refund_count": {"$sum": 1}}}
+        ]).to_list(1)
+    )
+    facets = sales[0] if sales else {}
+    totals = (facets.get("totals") or [{}])[0]
+    refund_totals = refunds[0] if refunds else {}
+    hourly_revenue = [0.0] * 24
+    for hour in facets.get("hours", []):
+        hourly_revenue[hour["_id"]] = hour["revenue"]
+    rollup = {
+        "day": day.strftime("%Y-%m-%d"),
+        "revenue": totals.get("revenue", 0),
+        "transactions": totals.get("transactions", 0),
+        "refunds": refund_totals.get("refunds", 0),
+        "refund_count": refund_totals.get("refund_count", 0),
+        "payments": {payment["_id"]: payment["amount"] for payment in facets.get("payments", []) if payment["_id"]},
+        "hourly_revenue": hourly_revenue
+    }
+    await db.store_daily_rollups.update_one({"day": rollup["day"]}, {"$set": rollup}, upsert=True)
+    return rollup
+
+def anomaly_features(rollups: List[dict]) -> tuple:
+    """Day x feature matrix of the series the detector watches, with (kind, key) per column"""
+    methods = [method.value for method in PaymentMethod]
+    columns = [(AnomalyKind.REVENUE, None), (AnomalyKind.REFUNDS, None)]
+    columns += [(AnomalyKind.HOUR, str(hour)) for hour in range(24)]
+    columns += [(AnomalyKind.PAYMENT_MIX, method) for method in methods]
+    matrix = np.zeros((len(rollups), len(columns)))
+    for row, rollup in enumerate(rollups):
+        matrix[row, 0] = rollup["revenue"]
+        matrix[row, 1] = rollup["refunds"]
+        matrix[row, 2:26] = rollup["hourly_revenue"]
+        if rollup["revenue"] > 0:
+            matrix[row, 26:] = [rollup["payments"].get(method, 0) / rollup["revenue"] for method in methods]
+    return matrix, columns
+
+def detect_anomalies(rollups: List[dict], first_target: int, window_days: int, threshold: float) -> List[RevenueAnomaly]:
+    """Robust z-scores of rollups[first_target:] against the median/MAD of the preceding window_days days.
+
+    rollups must be consecutive days. The scale is 1.4826 x MAD, falling back to
+    1.2533 x mean absolute deviation when over half the window shares one value,
+    and never below 1% of median daily revenue (amounts) or one point (shares) so
+    near-constant series such as closed hours do not turn noise into alerts.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+    
+    matrix, columns = anomaly_features(rollups)
+    targets = np.arange(max(first_target, window_days), len(rollups))
+    if not len(targets):
+        return []
+    # windows[i] holds the window_days rows before targets[i]: shape (targets, features, window)
+    windows = sliding_window_view(matrix, window_days, axis=0)[targets - window_days]
+    values = matrix[targets]
+    medians = np.median(windows, axis=-1)
+    deviations = np.abs(windows - medians[..., None])
+    scale = 1.4826 * np.median(deviations, axis=-1)
+    scale = np.where(scale > 0, scale, 1.2533 * deviations.mean(axis=-1))
+    shares = np.array([kind == AnomalyKind.PAYMENT_MIX for kind, _ in columns])
+    floors = np.where(shares, 0.01, 0.01 * medians[:, :1])
+    scale = np.maximum(scale, floors)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.where(scale > 0, (values - medians) / scale, 0)
+    
+    trading_days = np.array([rollup["transactions"] > 0 for rollup in rollups])
+    history = sliding_window_view(trading_days, window_days)[targets - window_days].sum(axis=-1)
+    flagged = (np.abs(scores) > threshold) & (history >= ANOMALY_MIN_HISTORY_DAYS)[:, None]
+    
+    anomalies = []
+    for target_position, column in zip(*np.nonzero(flagged)):
+        kind, key = columns[column]
+        score = float(scores[target_position, column])
+        anomalies.append(RevenueAnomaly(
+            day=rollups[targets[target_position]]["day"],
+            kind=kind,
+            key=key,
+            value=float(values[target_position, column]),
+            median=float(medians[target_position, column]),
+            scale=float(scale[target_position, column]),
+            score=round(score, 2),
+            direction="high" if score > 0 else "low"
+        ))
+    return anomalies
+
+def build_anomaly_alert_message(anomalies: List[RevenueAnomaly], currency_symbol: str) -> str:
+    lines = [f"⚠️ *Unusual activity on {anomalies[0].day}*", ""]
+    for anomaly in sorted(anomalies, key=lambda anomaly: -abs(anomaly.score)):
+        label = anomaly.kind.value.replace("_", " ").title()
+        if anomaly.kind == AnomalyKind.HOUR:
+            label = f"Revenue {int(anomaly.key):02d}:00-{int(anomaly.key):02d}:59"
+        elif anomaly.key:
+            label = f"{label} ({anomaly.key})"
+        if anomaly.kind == AnomalyKind.PAYMENT_MIX:
+            observed = f"{anomaly.value:.0%} vs usual {anomaly.median:.0%}"
+        else:
+            observed = f"{currency_symbol}{anomaly.value:,.2f} vs usual {currency_symbol}{anomaly.median:,.2f}"
+        lines.append(f"• {label}: {observed} ({anomaly.direction}, score {anomaly.score:+.1f})")
+    return "\n".join(lines)
+
+async def run_anomaly_detection(window_days: int = ANOMALY_WINDOW_DAYS, threshold: float = ANOMALY_THRESHOLD) -> str:
+    """Roll up the days completed since the last run and score only those days.
+
+    The first run also rolls up the preceding window so there is history to compare
+    against. Alerts for the latest day go to Telegram when alerts.telegram_alerts is on.
+    """
+    from pymongo import UpdateOne
+    
+    last_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    state = await db.rollup_state.find_one({"_id": STORE_ROLLUP_STATE_ID})
+    first_new = datetime.strptime(state["through"], "%Y-%m-%d") + timedelta(days=1) if state else last_day
+    if first_new > last_day:
+        return "skipped: no completed day since the last run"
+    history_start = first_new - timedelta(days=window_days)
+    
+    stored = {
+        rollup["day"]: rollup for rollup in await db.store_daily_rollups.find(
+            {"day": {"$gte": history_start.strftime("%Y-%m-%d"), "$lt": first_new.strftime("%Y-%m-%d")}},
+            {"_id": 0}
+        ).to_list(None)
+    }
+    rollups = []
+    day = history_start
+    while day <= last_day:
+        key = day.strftime("%Y-%m-%d")
+        rollups.append(stored[key] if day < first_new and key in stored else await rollup_store_day(day))
+        day += timedelta(days=1)
+    
+    anomalies = await asyncio.to_thread(detect_anomalies, rollups, window_days, window_days, threshold)
+    if anomalies:
+        await db.revenue_anomalies.bulk_write([
+            UpdateOne(
+                {"day": anomaly.day, "kind": anomaly.kind.value, "key": anomaly.key},
+                {"$set": anomaly.dict()},
+                upsert=True
+            )
+            for anomaly in anomalies
+        ], ordered=False)
+    await db.rollup_state.update_one(
+        {"_id": STORE_ROLLUP_STATE_ID},
+        {"$set": {"through": last_day.strftime("%Y-%m-%d"), "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    
+    message = f"scored {(last_day - first_new).days + 1} days, {len(anomalies)} anomalies"
+    latest = [anomaly for anomaly in anomalies if anomaly.day == last_day.strftime("%Y-%m-%d")]
+    if latest and (await settings_service.alerts()).telegram_alerts:
+        telegram = await settings_service.telegram()
+        if telegram.enabled and telegram.bot_token and telegram.chat_id:
+            response = await asyncio.to_thread(
+                send_telegram_message, telegram.bot_token, telegram.chat_id,
+                build_anomaly_alert_message(latest, (await settings_service.general()).currency_symbol)
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"{message}; Telegram alert failed: {response.json().get('description', 'unknown error')}")
+            message += ", alert sent"
+    return message
+
+ANOMALY_PAGE_MAX = 1000
+
+def parse_anomaly_day(value: str, name: str) -> str:
+    """YYYY-MM-DD day of an ISO date or datetime, the format anomalies are stored by"""
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO date, e.g. 2026-03-31")
+
+@api_router.get("/analytics/anomalies")
+async def get_revenue_anomalies(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    kind: Optional[AnomalyKind] = None,
+    limit: int = 200,
+    skip: int = 0
+):
+    """Days whose revenue, refunds, hourly revenue or payment mix stood out, newest first (last 30 days by default).
+
+    Paged by skip and limit (at most 1000); has_more tells whether another page follows.
+    """
+    if not 1 <= limit <= ANOMALY_PAGE_MAX or skip < 0:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {ANOMALY_PAGE_MAX} and skip not negative")
+    end = parse_anomaly_day(end_date, "end_date") if end_date else datetime.utcnow().strftime("%Y-%m-%d")
+    start = (
+        parse_anomaly_day(start_date, "start_date") if start_date
+        else (datetime.strptime(end, "%Y-%m-%d") - timedelta(days=30)).strftime("%Y-%m-%d")
+    )
+    query = {"day": {"$gte": start, "$lte": end}}
+    if kind:
+        query["kind"] = kind.value
+    # One extra document tells whether another page follows
+    anomalies, state = await asyncio.gather(
+        db.revenue_anomalies.find(query, {"_id": 0}).sort([("day", -1), ("score", -1)]).skip(skip).limit(limit + 1).to_list(None),
+        db.rollup_state.find_one({"_id": STORE_ROLLUP_STATE_ID})
+    )
+    return {
+        "start_date": start,
+        "end_date": end,
+        "scored_through": state["through"] if state else None,
+        "anomalies": anomalies[:limit],
+        "has_more": len(anomalies) > limit
     }
 
 @api_router.get("/analytics/export-data")
@@ -1520,8 +3590,14 @@ async def get_export_data(
     export_type: str = "comprehensive"  # comprehensive, medicine_analysis, sales_summary
 ):
     """Get data formatted for export (Excel/PDF)"""
-    # Reuse the comprehensive analytics logic
-    analytics_data = await get_comprehensive_analytics(start_date, end_date, date_range)
+    # Reuse the comprehensive analytics response, cached under the same key
+    start_dt, end_dt, date_range = resolve_date_range(start_date, end_date, date_range)
+    entry, _ = await get_cached_entry(
+        ("analytics/comprehensive", date_range, start_dt, end_dt),
+        ANALYTICS_CACHE_COLLECTIONS,
+        lambda: compute_comprehensive_analytics(start_dt, end_dt, date_range)
+    )
+    analytics_data = json.loads(entry.body)
     
     if export_type == "medicine_analysis":
         return {
@@ -1550,8 +3626,13 @@ async def get_export_data(
 @api_router.get("/analytics/daily-sales-report")
 async def get_daily_sales_report():
     """Get today's sales report with detailed payment method breakdown"""
-    from datetime import datetime, timedelta
-    
+    # Terminals opening together share one computation
+    return await analytics_flights.do(
+        ("analytics/daily-sales-report", datetime.utcnow().date().isoformat()),
+        compute_daily_sales_report
+    )
+
+async def compute_daily_sales_report():
     # Get today's date range
     today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     today_end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999)
@@ -1635,36 +3716,48 @@ async def get_daily_sales_report():
         }
     }
 
+DASHBOARD_CACHE_COLLECTIONS = ANALYTICS_CACHE_COLLECTIONS + ("patients",)
+response_cache.track(DASHBOARD_CACHE_COLLECTIONS)
+
+def dashboard_cache_key() -> tuple:
+    # Today's figures change at midnight, so the day is part of the key
+    return ("analytics/dashboard", datetime.utcnow().date().isoformat())
+
 @api_router.get("/analytics/dashboard")
-async def get_dashboard_analytics():
+async def get_dashboard_analytics(request: Request):
+    return await cached_json_response(
+        request,
+        dashboard_cache_key(),
+        DASHBOARD_CACHE_COLLECTIONS,
+        compute_dashboard_analytics
+    )
+
+async def compute_dashboard_analytics():
     # Get today's sales
     today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     today_end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999)
     
-    today_sales = await db.sales.find({
-        "created_at": {"$gte": today_start, "$lte": today_end}
-    }).to_list(1000)
+    # Top selling medicines (last 30 days)
+    thirty_days_ago = datetime.utcnow().replace(day=1)  # Simplified to current month
+    
+    # The counts and both sales windows are independent, so query them concurrently
+    today_sales, total_patients, total_medicines, low_stock_count, sales_last_30_days = await asyncio.gather(
+        db.sales.find({
+            "created_at": {"$gte": today_start, "$lte": today_end}
+        }).to_list(1000),
+        db.patients.count_documents({}),
+        db.medicines.count_documents({}),
+        db.medicines.count_documents({
+            "$expr": {"$lt": ["$stock_quantity", "$minimum_stock_level"]}
+        }),
+        db.sales.find({
+            "created_at": {"$gte": thirty_days_ago}
+        }).to_list(1000)
+    )
     
     today_revenue = sum(sale["total_amount"] for sale in today_sales)
     today_transactions = len(today_sales)
     
-    # Get total patients count
-    total_patients = await db.patients.count_documents({})
-    
-    # Get total medicines count
-    total_medicines = await db.medicines.count_documents({})
-    
-    # Get low stock count
-    low_stock_count = await db.medicines.count_documents({
-        "$expr": {"$lt": ["$stock_quantity", "$minimum_stock_level"]}
-    })
-    
-    # Get top selling medicines (last 30 days)
-    thirty_days_ago = datetime.utcnow().replace(day=1)  # Simplified to current month
-    sales_last_30_days = await db.sales.find({
-        "created_at": {"$gte": thirty_days_ago}
-    }).to_list(1000)
-    
     # Aggregate medicine sales
     medicine_sales = {}
     for sale in sales_last_30_days:
@@ -1693,6 +3786,172 @@ async def get_dashboard_analytics():
     }
 
 
+# Live Dashboard Push
+DASHBOARD_PUSH_DELAY_SECONDS = float(os.environ.get("DASHBOARD_PUSH_DELAY_SECONDS", "0.5"))
+DASHBOARD_REFRESH_SECONDS = float(os.environ.get("DASHBOARD_REFRESH_SECONDS", "60"))
+DASHBOARD_QUEUE_SIZE = 16
+# Enable when running several workers against a replica set so writes on any worker reach every subscriber
+DASHBOARD_CHANGE_STREAMS = os.environ.get("DASHBOARD_CHANGE_STREAMS", "false").lower() == "true"
+DASHBOARD_WATCHED_COLLECTIONS = ["sales", "returns", "medicines", "patients", "opd_prescriptions"]
+
+class DashboardBroker:
+    """In-process pub/sub for the dashboard.
+
+    Writes publish change events; after a short debounce the broker refreshes the
+    dashboard figures once and pushes only the fields that changed to every
+    subscriber. New subscribers get a full snapshot first.
+    """
+    
+    def __init__(self):
+        self._subscribers = set()
+        self._pending_events = []
+        self._flush_task = None
+        self._refresh_task = None
+        self._bridge_task = None
+        self.snapshot = None
+        self.pushes = 0
+    
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+    
+    async def build_snapshot(self) -> dict:
+        entry, _ = await get_cached_entry(dashboard_cache_key(), DASHBOARD_CACHE_COLLECTIONS, compute_dashboard_analytics)
+        daily_sales_report = await get_daily_sales_report()
+        return {"analytics": json.loads(entry.body), "daily_sales_report": daily_sales_report}
+    
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=DASHBOARD_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_loop())
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        if not self._subscribers:
+            self.snapshot = None
+            if self._refresh_task is not None:
+                self._refresh_task.cancel()
+    
+    def publish(self, event: dict):
+        """Record a change; subscribers receive the resulting update after the debounce delay"""
+        if not self._subscribers:
+            return
+        self._pending_events.append(event)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush())
+    
+    async def _flush(self):
+        try:
+            await self._push_changes()
+        finally:
+            # Events published while this flush was refreshing found it still running and scheduled nothing
+            if self._pending_events and self._subscribers:
+                self._flush_task = asyncio.ensure_future(self._flush())
+    
+    async def _push_changes(self):
+        await asyncio.sleep(DASHBOARD_PUSH_DELAY_SECONDS)
+        events, self._pending_events = self._pending_events, []
+        try:
+            snapshot = await self.build_snapshot()
+        except Exception as e:
+            logger.error(f"Dashboard push refresh failed: {str(e)}")
+            return
+        
+        previous = self.snapshot or {}
+        changes = {}
+        for section, values in snapshot.items():
+            changed = {key: value for key, value in values.items() if previous.get(section, {}).get(key) != value}
+            if changed:
+                changes[section] = changed
+        self.snapshot = snapshot
+        if changes:
+            self._broadcast({"type": "delta", "data": changes, "events": events}, snapshot)
+    
+    def _broadcast(self, message: dict, snapshot: dict):
+        self.pushes += 1
+        for queue in list(self._subscribers):
+            if queue.full():
+                # A slow client missed deltas; replace its backlog with the full state
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "snapshot", "data": snapshot})
+            else:
+                queue.put_nowait(message)
+    
+    async def _refresh_loop(self):
+        # Today's figures roll over at midnight without any write, so refresh periodically
+        while self._subscribers:
+            await asyncio.sleep(DASHBOARD_REFRESH_SECONDS)
+            self.publish({"type": "refresh"})
+    
+    async def _change_stream_bridge(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": DASHBOARD_WATCHED_COLLECTIONS}}}]
+        while True:
+            try:
+                async with db.watch(pipeline) as stream:
+                    async for change in stream:
+                        collection = change["ns"]["coll"]
+                        # Writes made by other workers also invalidate this worker's response cache
+                        response_cache.invalidate(collection)
+                        self.publish({"type": change["operationType"], "collection": collection})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Dashboard change stream failed, retrying: {str(e)}")
+                await asyncio.sleep(5)
+    
+    def start_bridge(self):
+        self._bridge_task = asyncio.ensure_future(self._change_stream_bridge())
+    
+    async def stop(self):
+        for task in (self._bridge_task, self._refresh_task, self._flush_task):
+            if task is not None:
+                task.cancel()
+
+dashboard_broker = DashboardBroker()
+
+@api_router.websocket("/ws/dashboard")
+async def dashboard_websocket(websocket: WebSocket):
+    """Pushes dashboard figures: a snapshot on connect, then deltas after sales, returns and stock edits"""
+    await websocket.accept()
+    queue = dashboard_broker.subscribe()
+    
+    async def forward():
+        snapshot = await dashboard_broker.build_snapshot()
+        if dashboard_broker.snapshot is None:
+            dashboard_broker.snapshot = snapshot
+        await websocket.send_json({"type": "snapshot", "data": jsonable_encoder(snapshot)})
+        while True:
+            message = await queue.get()
+            await websocket.send_json(jsonable_encoder(message))
+    
+    async def receive():
+        # Clients do not send anything; receiving just detects the disconnect
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+    
+    sender = asyncio.ensure_future(forward())
+    receiver = asyncio.ensure_future(receive())
+    try:
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        if sender in done:
+            # forward() only returns by failing; close so the client reconnects instead of waiting on a dead socket
+            logger.error(f"Dashboard websocket push failed: {sender.exception()}")
+            try:
+                await websocket.close(code=1011)
+            except Exception:
+                pass
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        dashboard_broker.unsubscribe(queue)
+
+
 # Doctor Management APIs
 @api_router.post("/doctors", response_model=Doctor)
 async def create_doctor(doctor: DoctorCreate):
@@ -1750,30 +4009,27 @@ async def create_opd_prescription(prescription: OPDPrescriptionCreate):
     
     prescription_dict = prescription.dict()
     prescription_obj = OPDPrescription(**prescription_dict)
-    await db.opd_prescriptions.insert_one(prescription_obj.dict())
+    await db.opd_prescriptions.insert_one(to_document(prescription_obj))
     return prescription_obj
 
 @api_router.get("/opd-prescriptions", response_model=List[OPDPrescription])
 async def get_opd_prescriptions():
-    prescriptions = await db.opd_prescriptions.find().sort("created_at", -1).to_list(1000)
-    return [OPDPrescription(**prescription) for prescription in prescriptions]
+    return await trusted_find(db.opd_prescriptions, OPDPrescription, sort=("created_at", -1))
 
 @api_router.get("/opd-prescriptions/{prescription_id}", response_model=OPDPrescription)
 async def get_opd_prescription(prescription_id: str):
-    prescription = await db.opd_prescriptions.find_one({"id": prescription_id})
-    if not prescription:
+    prescription = await trusted_find_one(db.opd_prescriptions, OPDPrescription, {"id": prescription_id})
+    if prescription is None:
         raise HTTPException(status_code=404, detail="Prescription not found")
-    return OPDPrescription(**prescription)
+    return prescription
 
 @api_router.get("/opd-prescriptions/doctor/{doctor_id}")
 async def get_doctor_prescriptions(doctor_id: str):
-    prescriptions = await db.opd_prescriptions.find({"doctor_id": doctor_id}).sort("created_at", -1).to_list(1000)
-    return [OPDPrescription(**prescription) for prescription in prescriptions]
+    return await trusted_find(db.opd_prescriptions, OPDPrescription, {"doctor_id": doctor_id}, sort=("created_at", -1))
 
 @api_router.get("/opd-prescriptions/patient/{patient_id}")
 async def get_patient_prescriptions(patient_id: str):
-    prescriptions = await db.opd_prescriptions.find({"patient_id": patient_id}).sort("created_at", -1).to_list(1000)
-    return [OPDPrescription(**prescription) for prescription in prescriptions]
+    return await trusted_find(db.opd_prescriptions, OPDPrescription, {"patient_id": patient_id}, sort=("created_at", -1))
 
 # Generate OPD Prescription Print Format
 @api_router.get("/opd-prescriptions/{prescription_id}/print")
@@ -1782,8 +4038,10 @@ async def get_prescription_print_data(prescription_id: str):
     if not prescription:
         raise HTTPException(status_code=404, detail="Prescription not found")
     
-    doctor = await db.doctors.find_one({"id": prescription["doctor_id"]})
-    patient = await db.patients.find_one({"id": prescription["patient_id"]})
+    doctor, patient = await asyncio.gather(
+        db.doctors.find_one({"id": prescription["doctor_id"]}),
+        db.patients.find_one({"id": prescription["patient_id"]})
+    )
     
     if not doctor or not patient:
         raise HTTPException(status_code=404, detail="Doctor or Patient not found")
@@ -1974,113 +4232,236 @@ async def init_sample_data():
 
 
 # Settings Management APIs
+# Returned by GET /settings until settings are saved, and the fallback for missing keys
+DEFAULT_SETTINGS = {
+    "general": {
+        "shop_name": "MediPOS Pharmacy",
+        "shop_address": "123 Main Street, City, State, ZIP",
+        "shop_phone": "+1-234-567-8900",
+        "shop_email": "info@medipos.com",
+        "shop_website": "",
+        "shop_license": "PH-2024-001",
+        "owner_name": "Pharmacy Owner",
+        "gst_number": "",
+        "currency": "USD",
+        "currency_symbol": "$",
+        "default_tax_rate": 10.0,
+        "timezone": "UTC",
+        "date_format": "YYYY-MM-DD",
+        "time_format": "24",
+        "decimal_places": 2,
+        "language": "English",
+        "backup_frequency": "daily",
+        "auto_backup": True,
+        "system_version": "1.0.0",
+        "last_backup": None
+    },
+    "opd_paper": {
+        "paper_size": "A4",
+        "margin_top": 20,
+        "margin_bottom": 20,
+        "margin_left": 20,
+        "margin_right": 20,
+        "header_height": 80,
+        "footer_height": 60,
+        "line_height": 24,
+        "font_size": 12,
+        "font_family": "Arial",
+        "show_logo": True,
+        "logo_position": "left",
+        "clinic_name_size": 18,
+        "doctor_name_size": 14,
+        "patient_info_size": 12,
+        "prescription_area_lines": 15,
+        "show_medical_history": True,
+        "show_emergency_contact": False,
+        "watermark_text": "",
+        "print_instructions": "Please follow doctor's instructions carefully",
+        "custom_html_enabled": False,
+        "custom_html": "",
+        "custom_css": ""
+    },
+    "printer": {
+        "default_printer": "",
+        "receipt_width": 80,
+        "receipt_font_size": 10,
+        "receipt_line_spacing": 1.2,
+        "auto_print_receipts": False,
+        "auto_print_prescriptions": False,
+        "print_copies": 1,
+        "paper_cutting": True,
+        "cash_drawer": False,
+        "barcode_format": "CODE128",
+        "receipt_header": "MediPOS Pharmacy",
+        "receipt_footer": "Thank you for your business!",
+        "thermal_printer": False,
+        "print_quality": "normal"
+    },
+    "telegram": {
+        "enabled": False,
+        "bot_token": "",
+        "chat_id": "",
+        "daily_report_time": "18:00",
+        "include_revenue": True,
+        "include_transactions": True,
+        "include_top_medicines": True,
+        "include_low_stock": True,
+        "include_patient_count": True,
+        "report_format": "detailed",
+        "timezone": "UTC"
+    },
+    "alerts": {
+        "low_stock_enabled": True,
+        "low_stock_threshold": 10,
+        "low_stock_check_frequency": "daily",
+        "low_stock_notification_time": "09:00",
+        "expiry_alert_enabled": True,
+        "expiry_alert_days": 30,
+        "expiry_check_frequency": "daily",
+        "expiry_notification_time": "09:30",
+        "telegram_alerts": False,
+        "email_alerts": False,
+        "system_notifications": True,
+        "sound_notifications": False
+    },
+    "custom_templates": {}
+}
+
+SETTINGS_SECTIONS = ("general", "opd_paper", "printer", "telegram", "alerts", "custom_templates")
+# How often a worker checks the settings version for changes saved by other workers
+SETTINGS_REFRESH_SECONDS = float(os.environ.get("SETTINGS_REFRESH_SECONDS", "5"))
+
+class GeneralSettings(BaseModel):
+    shop_name: str = "MediPOS Pharmacy"
+    shop_address: str = ""
+    shop_phone: str = ""
+    shop_email: str = ""
+    shop_website: str = ""
+    gst_number: str = ""
+    currency: str = "USD"
+    currency_symbol: str = "$"
+    default_tax_rate: float = 10.0
+    decimal_places: int = 2
+    timezone: str = "UTC"
+    backup_frequency: str = "daily"
+    auto_backup: bool = True
+
+class TelegramSettings(BaseModel):
+    enabled: bool = False
+    bot_token: str = ""
+    chat_id: str = ""
+    daily_report_time: str = "18:00"
+
+class AlertSettings(BaseModel):
+    low_stock_threshold: int = 10
+    expiry_alert_days: int = 30
+    telegram_alerts: bool = False
+
+class OPDPaperSettings(BaseModel):
+    paper_size: str = "A4"
+    margin_top: float = 20
+    margin_bottom: float = 20
+    margin_left: float = 20
+    margin_right: float = 20
+    font_size: float = 12
+    font_family: str = "Arial"
+    clinic_name_size: float = 18
+    show_medical_history: bool = True
+    watermark_text: str = ""
+    print_instructions: str = ""
+    custom_html_enabled: bool = False
+    custom_html: str = ""
+    custom_css: str = ""
+
+class PrinterSettings(BaseModel):
+    receipt_width: float = 80
+    receipt_font_size: float = 10
+    receipt_header: str = ""
+    receipt_footer: str = ""
+
+class SettingsService:
+    """Process-wide cache of the settings document.
+
+    Loaded on first use and served from memory. Writers call invalidate() and
+    bump the document's version; with several workers each one compares the
+    version at most every SETTINGS_REFRESH_SECONDS and reloads when it changed.
+    Returned documents and sections are shared, so treat them as read-only.
+    """
+    
+    def __init__(self):
+        self._document = None
+        self._sections = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        self.loads = 0
+    
+    async def _load(self):
+        document = await db.settings.find_one({}, {"_id": 0}) or {}
+        self._document = document
+        self._version = document.get("version", 0)
+        self._sections = {}
+        self._checked_at = time.monotonic()
+        self.loads += 1
+    
+    async def document(self) -> dict:
+        """The stored settings document, or {} when nothing has been saved"""
+        if self._document is None:
+            async with self._lock:
+                if self._document is None:
+                    await self._load()
+        elif CACHE_SHARED_GENERATIONS and time.monotonic() - self._checked_at >= SETTINGS_REFRESH_SECONDS:
+            self._checked_at = time.monotonic()
+            current = await db.settings.find_one({}, {"_id": 0, "version": 1}) or {}
+            if current.get("version", 0) != self._version:
+                async with self._lock:
+                    await self._load()
+        return self._document
+    
+    async def api_view(self) -> dict:
+        document = await self.document()
+        if not document:
+            return DEFAULT_SETTINGS
+        return {section: document.get(section, {}) for section in SETTINGS_SECTIONS}
+    
+    async def _section(self, name: str, model):
+        document = await self.document()
+        section = self._sections.get(name)
+        if section is None:
+            try:
+                section = model(**{**DEFAULT_SETTINGS[name], **document.get(name, {})})
+            except ValidationError as e:
+                logger.warning(f"Invalid {name} settings, using defaults: {str(e)}")
+                section = model(**DEFAULT_SETTINGS[name])
+            self._sections[name] = section
+        return section
+    
+    async def general(self) -> GeneralSettings:
+        return await self._section("general", GeneralSettings)
+    
+    async def telegram(self) -> TelegramSettings:
+        return await self._section("telegram", TelegramSettings)
+    
+    async def alerts(self) -> AlertSettings:
+        return await self._section("alerts", AlertSettings)
+    
+    async def opd_paper(self) -> OPDPaperSettings:
+        return await self._section("opd_paper", OPDPaperSettings)
+    
+    async def printer(self) -> PrinterSettings:
+        return await self._section("printer", PrinterSettings)
+    
+    async def version(self) -> int:
+        return (await self.document()).get("version", 0)
+    
+    def invalidate(self):
+        self._document = None
+
+settings_service = SettingsService()
+
 @api_router.get("/settings")
 async def get_settings():
-    settings = await db.settings.find_one({})
-    if not settings:
-        # Return default settings if none exist
-        default_settings = {
-            "general": {
-                "shop_name": "MediPOS Pharmacy",
-                "shop_address": "123 Main Street, City, State, ZIP",
-                "shop_phone": "+1-234-567-8900",
-                "shop_email": "info@medipos.com",
-                "shop_license": "PH-2024-001",
-                "owner_name": "Pharmacy Owner",
-                "gst_number": "",
-                "currency": "USD",
-                "currency_symbol": "$",
-                "default_tax_rate": 10.0,
-                "timezone": "UTC",
-                "date_format": "YYYY-MM-DD",
-                "time_format": "24",
-                "decimal_places": 2,
-                "language": "English",
-                "backup_frequency": "daily",
-                "auto_backup": True,
-                "system_version": "1.0.0",
-                "last_backup": None
-            },
-            "opd_paper": {
-                "paper_size": "A4",
-                "margin_top": 20,
-                "margin_bottom": 20,
-                "margin_left": 20,
-                "margin_right": 20,
-                "header_height": 80,
-                "footer_height": 60,
-                "line_height": 24,
-                "font_size": 12,
-                "font_family": "Arial",
-                "show_logo": True,
-                "logo_position": "left",
-                "clinic_name_size": 18,
-                "doctor_name_size": 14,
-                "patient_info_size": 12,
-                "prescription_area_lines": 15,
-                "show_medical_history": True,
-                "show_emergency_contact": False,
-                "watermark_text": "",
-                "print_instructions": "Please follow doctor's instructions carefully",
-                "custom_html_enabled": False,
-                "custom_html": "",
-                "custom_css": ""
-            },
-            "printer": {
-                "default_printer": "",
-                "receipt_width": 80,
-                "receipt_font_size": 10,
-                "receipt_line_spacing": 1.2,
-                "auto_print_receipts": False,
-                "auto_print_prescriptions": False,
-                "print_copies": 1,
-                "paper_cutting": True,
-                "cash_drawer": False,
-                "barcode_format": "CODE128",
-                "receipt_header": "MediPOS Pharmacy",
-                "receipt_footer": "Thank you for your business!",
-                "thermal_printer": False,
-                "print_quality": "normal"
-            },
-            "telegram": {
-                "enabled": False,
-                "bot_token": "",
-                "chat_id": "",
-                "daily_report_time": "18:00",
-                "include_revenue": True,
-                "include_transactions": True,
-                "include_top_medicines": True,
-                "include_low_stock": True,
-                "include_patient_count": True,
-                "report_format": "detailed",
-                "timezone": "UTC"
-            },
-            "alerts": {
-                "low_stock_enabled": True,
-                "low_stock_threshold": 10,
-                "low_stock_check_frequency": "daily",
-                "low_stock_notification_time": "09:00",
-                "expiry_alert_enabled": True,
-                "expiry_alert_days": 30,
-                "expiry_check_frequency": "daily",
-                "expiry_notification_time": "09:30",
-                "telegram_alerts": False,
-                "email_alerts": False,
-                "system_notifications": True,
-                "sound_notifications": False
-            },
-            "custom_templates": {}
-        }
-        return default_settings
-    
-    return {
-        "general": settings.get("general", {}),
-        "opd_paper": settings.get("opd_paper", {}),
-        "printer": settings.get("printer", {}),
-        "telegram": settings.get("telegram", {}),
-        "alerts": settings.get("alerts", {}),
-        "custom_templates": settings.get("custom_templates", {})
-    }
+    return await settings_service.api_view()
 
 @api_router.post("/settings")
 async def save_settings(settings_data: SettingsUpdate):
@@ -2105,7 +4486,10 @@ async def save_settings(settings_data: SettingsUpdate):
         
         update_data["updated_at"] = datetime.utcnow()
         
-        await db.settings.update_one({"_id": existing_settings["_id"]}, {"$set": update_data})
+        await db.settings.update_one(
+            {"_id": existing_settings["_id"]},
+            {"$set": update_data, "$inc": {"version": 1}}
+        )
     else:
         # Create new settings
         new_settings = Settings(
@@ -2116,7 +4500,11 @@ async def save_settings(settings_data: SettingsUpdate):
             alerts=settings_data.alerts or {},
             custom_templates=settings_data.custom_templates or {}
         )
-        await db.settings.insert_one(new_settings.dict())
+        await db.settings.insert_one({**new_settings.dict(), "version": 1})
+    settings_service.invalidate()
+    
+    # Keep settings-driven job schedules (backup frequency, report time) in step
+    await scheduler.sync_settings_jobs()
     
     return {"message": "Settings saved successfully"}
 
@@ -2192,12 +4580,8 @@ async def get_system_status():
             "percent": (disk.used / disk.total) * 100
         }
         
-        # Get CPU info
-        cpu_info = {
-            "count": psutil.cpu_count(),
-            "percent": psutil.cpu_percent(interval=1),
-            "frequency": psutil.cpu_freq()._asdict() if psutil.cpu_freq() else None
-        }
+        # CPU usage is sampled over one second; do it on a thread while the database is queried
+        cpu_percent_task = asyncio.ensure_future(asyncio.to_thread(psutil.cpu_percent, interval=1))
         
         # Database status
         try:
@@ -2205,20 +4589,25 @@ async def get_system_status():
             await db.command("ping")
             db_status = "Connected"
             
-            # Get collection counts
-            collections_info = {
-                "medicines": await db.medicines.count_documents({}),
-                "patients": await db.patients.count_documents({}),
-                "doctors": await db.doctors.count_documents({}),
-                "sales": await db.sales.count_documents({}),
-                "returns": await db.returns.count_documents({}),
-                "opd_prescriptions": await db.opd_prescriptions.count_documents({}),
-                "stock_movements": await db.stock_movements.count_documents({})
-            }
+            # Get collection counts concurrently
+            counted_collections = [
+                "medicines", "patients", "doctors", "sales", "returns", "opd_prescriptions", "stock_movements"
+            ]
+            counts = await asyncio.gather(*[
+                db[collection_name].count_documents({}) for collection_name in counted_collections
+            ])
+            collections_info = dict(zip(counted_collections, counts))
         except Exception as e:
             db_status = f"Error: {str(e)}"
             collections_info = {}
         
+        # Get CPU info
+        cpu_info = {
+            "count": psutil.cpu_count(),
+            "percent": await cpu_percent_task,
+            "frequency": psutil.cpu_freq()._asdict() if psutil.cpu_freq() else None
+        }
+        
         return {
             "status": "operational",
             "timestamp": datetime.utcnow().isoformat(),
@@ -2247,9 +4636,8 @@ async def generate_comprehensive_report():
     today_end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999)
     
     # Get settings for currency symbol
-    settings = await db.settings.find_one({}) or {}
-    currency_symbol = settings.get("general", {}).get("currency_symbol", "$")
-    expiry_alert_days = settings.get("alerts", {}).get("expiry_alert_days", 30)
+    currency_symbol = (await settings_service.general()).currency_symbol
+    expiry_alert_days = (await settings_service.alerts()).expiry_alert_days
     
     # Get today's sales data
     today_sales = await db.sales.find({
@@ -2333,29 +4721,21 @@ async def generate_comprehensive_report():
         "expiry_alert_days": expiry_alert_days
     }
 
-@api_router.post("/send-test-daily-report")
-async def send_test_daily_report():
-    """Send a comprehensive test daily report"""
+def send_telegram_message(bot_token: str, chat_id: str, text: str):
+    """Send a Markdown message through the Telegram Bot API"""
     import requests
     
-    # Get settings
-    settings = await db.settings.find_one({})
-    if not settings or not settings.get("telegram", {}).get("enabled"):
-        raise HTTPException(status_code=400, detail="Telegram notifications not enabled")
-    
-    telegram_config = settings["telegram"]
-    bot_token = telegram_config.get("bot_token")
-    chat_id = telegram_config.get("chat_id")
-    
-    if not bot_token or not chat_id:
-        raise HTTPException(status_code=400, detail="Telegram bot token or chat ID not configured")
-    
-    try:
-        # Generate comprehensive report data
-        report_data = await generate_comprehensive_report()
-        
-        # Create comprehensive report message
-        report_message = f"""📊 **MediPOS Daily Report - TEST**
+    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    payload = {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "Markdown"
+    }
+    return requests.post(url, json=payload, timeout=10)
+
+def build_daily_report_message(report_data: dict, telegram_config: dict, is_test: bool = False) -> str:
+    """Format comprehensive report data as a Telegram message"""
+    report_message = f"""📊 **MediPOS Daily Report{' - TEST' if is_test else ''}**
 📅 Date: {datetime.utcnow().strftime('%Y-%m-%d')}
 
 💰 **DAILY SALES SUMMARY**
@@ -2372,61 +4752,79 @@ async def send_test_daily_report():
 
 ⚠️ **LOW STOCK ALERT** ({len(report_data['low_stock_medicines'])} items)"""
 
-        # Add low stock details
-        if report_data['low_stock_medicines']:
-            report_message += "\n"
-            for medicine in report_data['low_stock_medicines'][:5]:  # Show first 5
-                stock_qty = medicine.get('stock_quantity', 0)
-                min_level = medicine.get('minimum_stock_level', 0)
-                report_message += f"├─ {medicine['name']}: {stock_qty}/{min_level}\n"
-            
-            if len(report_data['low_stock_medicines']) > 5:
-                report_message += f"└─ ...and {len(report_data['low_stock_medicines']) - 5} more items\n"
-        else:
-            report_message += "\n✅ All medicines are well stocked!\n"
-
-        # Add expiry alerts
-        expired_count = len(report_data['expired_medicines'])
-        expiring_count = len(report_data['expiring_soon_medicines'])
-        
-        report_message += f"\n⏰ **EXPIRY ALERTS**"
-        
-        if expired_count > 0:
-            report_message += f"\n🚨 **EXPIRED**: {expired_count} medicines"
-            for medicine in report_data['expired_medicines'][:3]:  # Show first 3
-                try:
-                    expiry_date = datetime.fromisoformat(medicine["expiry_date"].replace("Z", "+00:00"))
-                    report_message += f"\n├─ {medicine['name']}: {expiry_date.strftime('%Y-%m-%d')}"
-                except:
-                    report_message += f"\n├─ {medicine['name']}: Date parsing error"
-        
-        if expiring_count > 0:
-            report_message += f"\n⚡ **EXPIRING SOON**: {expiring_count} medicines (within {report_data['expiry_alert_days']} days)"
-            for medicine in report_data['expiring_soon_medicines'][:3]:  # Show first 3
-                try:
-                    expiry_date = datetime.fromisoformat(medicine["expiry_date"].replace("Z", "+00:00"))
-                    days_until_expiry = (expiry_date - datetime.utcnow()).days
-                    report_message += f"\n├─ {medicine['name']}: {days_until_expiry} days ({expiry_date.strftime('%Y-%m-%d')})"
-                except:
-                    report_message += f"\n├─ {medicine['name']}: Date parsing error"
+    # Add low stock details
+    if report_data['low_stock_medicines']:
+        report_message += "\n"
+        for medicine in report_data['low_stock_medicines'][:5]:  # Show first 5
+            stock_qty = medicine.get('stock_quantity', 0)
+            min_level = medicine.get('minimum_stock_level', 0)
+            report_message += f"├─ {medicine['name']}: {stock_qty}/{min_level}\n"
         
-        if expired_count == 0 and expiring_count == 0:
-            report_message += "\n✅ No expiry concerns!"
+        if len(report_data['low_stock_medicines']) > 5:
+            report_message += f"└─ ...and {len(report_data['low_stock_medicines']) - 5} more items\n"
+    else:
+        report_message += "\n✅ All medicines are well stocked!\n"
+
+    # Add expiry alerts
+    expired_count = len(report_data['expired_medicines'])
+    expiring_count = len(report_data['expiring_soon_medicines'])
+    
+    report_message += f"\n⏰ **EXPIRY ALERTS**"
+    
+    if expired_count > 0:
+        report_message += f"\n🚨 **EXPIRED**: {expired_count} medicines"
+        for medicine in report_data['expired_medicines'][:3]:  # Show first 3
+            try:
+                expiry_date = datetime.fromisoformat(medicine["expiry_date"].replace("Z", "+00:00"))
+                report_message += f"\n├─ {medicine['name']}: {expiry_date.strftime('%Y-%m-%d')}"
+            except:
+                report_message += f"\n├─ {medicine['name']}: Date parsing error"
+    
+    if expiring_count > 0:
+        report_message += f"\n⚡ **EXPIRING SOON**: {expiring_count} medicines (within {report_data['expiry_alert_days']} days)"
+        for medicine in report_data['expiring_soon_medicines'][:3]:  # Show first 3
+            try:
+                expiry_date = datetime.fromisoformat(medicine["expiry_date"].replace("Z", "+00:00"))
+                days_until_expiry = (expiry_date - datetime.utcnow()).days
+                report_message += f"\n├─ {medicine['name']}: {days_until_expiry} days ({expiry_date.strftime('%Y-%m-%d')})"
+            except:
+                report_message += f"\n├─ {medicine['name']}: Date parsing error"
+    
+    if expired_count == 0 and expiring_count == 0:
+        report_message += "\n✅ No expiry concerns!"
 
+    if is_test:
         report_message += f"""
 
 🧪 **This is a test report**
 ✅ Daily reports will be sent automatically at {telegram_config.get('daily_report_time', '18:00')}
 📋 Configure alerts in Settings → Telegram"""
+    
+    return report_message
+
+@api_router.post("/send-test-daily-report")
+async def send_test_daily_report():
+    """Send a comprehensive test daily report"""
+    # Get settings
+    telegram = await settings_service.telegram()
+    if not telegram.enabled:
+        raise HTTPException(status_code=400, detail="Telegram notifications not enabled")
+    
+    telegram_config = (await settings_service.document()).get("telegram", {})
+    bot_token = telegram.bot_token
+    chat_id = telegram.chat_id
+    
+    if not bot_token or not chat_id:
+        raise HTTPException(status_code=400, detail="Telegram bot token or chat ID not configured")
+    
+    try:
+        # Generate comprehensive report data
+        report_data = await generate_comprehensive_report()
         
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": report_message,
-            "parse_mode": "Markdown"
-        }
+        # Create comprehensive report message
+        report_message = build_daily_report_message(report_data, telegram_config, is_test=True)
         
-        response = requests.post(url, json=payload, timeout=10)
+        response = send_telegram_message(bot_token, chat_id, report_message)
         
         if response.status_code == 200:
             return {"success": True, "message": "Comprehensive test daily report sent successfully"}
@@ -2568,25 +4966,510 @@ async def export_custom_template(template_id: str):
     return export_data
 
 
-# Backup & Restore Models and APIs
-class BackupStatus(str, Enum):
-    CREATING = "creating"
-    COMPLETED = "completed"
-    FAILED = "failed"
-    RESTORING = "restoring"
-    CORRUPTED = "corrupted"
+# Document Rendering
+RENDER_CACHE_MAX_ENTRIES = int(os.environ.get("RENDER_CACHE_MAX_ENTRIES", "512"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+COMPILED_TEMPLATE_CACHE_SIZE = 128
+TEMPLATE_PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
 
-class BackupType(str, Enum):
-    MANUAL = "manual"
-    SCHEDULED = "scheduled"
-    AUTOMATIC = "automatic"
+class RenderFormat(str, Enum):
+    HTML = "html"
+    PDF = "pdf"
 
-@api_router.get("/backup/directory-info")
-async def get_backup_directory_info():
-    """Get backup directory path information"""
-    try:
-        backup_dir = Path.cwd() / "backups"
-        return {
+class CompiledTemplate:
+    """A {{key}} template split once into literal text and placeholder names.
+
+    Rendering is a single join; placeholders without a value render empty.
+    Values are inserted as given, so callers escape them.
+    """
+    __slots__ = ("literals", "keys")
+    
+    def __init__(self, source: str):
+        pieces = TEMPLATE_PLACEHOLDER.split(source or "")
+        self.literals = pieces[0::2]
+        self.keys = pieces[1::2]
+    
+    def render(self, values: dict) -> str:
+        parts = [self.literals[0]]
+        for key, literal in zip(self.keys, self.literals[1:]):
+            parts.append(str(values.get(key, "")))
+            parts.append(literal)
+        return "".join(parts)
+
+class TemplateCompiler:
+    """LRU of compiled (html, css) template pairs keyed by template id and version.
+
+    A new updated_at (custom templates) or settings version (opd_paper HTML) is a
+    new key, so edited templates are recompiled and stale entries age out.
+    """
+    
+    def __init__(self, max_entries: int):
+        from collections import OrderedDict
+        
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self.compiled = 0
+    
+    def get(self, key: tuple, html_source: str, css_source: str) -> tuple:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = (CompiledTemplate(html_source), CompiledTemplate(css_source))
+            self._entries[key] = entry
+            self.compiled += 1
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+@dataclass(frozen=True)
+class RenderedDocument:
+    content: bytes
+    media_type: str
+    fingerprint: tuple
+
+class RenderCache:
+    """LRU of rendered documents with a total byte cap.
+
+    Entries are stored with a fingerprint of their inputs: the source document,
+    the write generations of the collections it is rendered with, and the
+    settings version. A reprint whose fingerprint still matches is served as is.
+    """
+    
+    def __init__(self, max_entries: int, max_bytes: int):
+        from collections import OrderedDict
+        
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: tuple, fingerprint: tuple) -> Optional[RenderedDocument]:
+        entry = self._entries.get(key)
+        if entry is None or entry.fingerprint != fingerprint:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def set(self, key: tuple, entry: RenderedDocument):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous.content)
+        if len(entry.content) > self._max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += len(entry.content)
+        while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.content)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+template_compiler = TemplateCompiler(COMPILED_TEMPLATE_CACHE_SIZE)
+render_cache = RenderCache(RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES)
+
+# Same layout and placeholders as the browser renderer's defaults
+DEFAULT_PRESCRIPTION_HTML = """
+<div class="prescription-document">
+  <header class="header">
+    <div class="clinic-name">{{clinic_name}}</div>
+    <div class="clinic-address">{{clinic_address}}</div>
+    <div class="clinic-contact">{{clinic_phone}} | {{clinic_email}}</div>
+  </header>
+  <section class="doctor-info">
+    <strong>Dr. {{doctor_name}}</strong><br>
+    {{doctor_specialization}}<br>
+    {{doctor_qualification}}<br>
+    License: {{doctor_license}}
+  </section>
+  <section class="patient-info">
+    <strong>Patient:</strong> {{patient_name}}<br>
+    <strong>Date:</strong> {{prescription_date}}<br>
+    <strong>Age:</strong> {{patient_age}} | <strong>Gender:</strong> {{patient_gender}}
+    {{patient_phone_line}}
+  </section>
+  {{medical_history_section}}
+  <section class="prescription-area">
+    <strong>℞ Prescription</strong><br><br>
+    <pre>{{prescription_notes}}</pre>
+  </section>
+  <footer class="footer">
+    <p>{{print_instructions}}</p>
+    <br>
+    <p>Doctor's Signature: _________________</p>
+  </footer>
+</div>
+"""
+
+DEFAULT_PRESCRIPTION_CSS = """
+.header { text-align: center; margin-bottom: 30px; border-bottom: 2px solid #333; padding-bottom: 15px; }
+.clinic-name { font-size: {{clinic_name_size}}px; font-weight: bold; color: #2c5282; margin-bottom: 5px; }
+.clinic-contact { font-size: 12px; color: #666; }
+.doctor-info { background-color: #f7fafc; padding: 15px; border-left: 4px solid #4299e1; margin: 20px 0; }
+.patient-info { background-color: #f0fff4; padding: 15px; border-left: 4px solid #48bb78; margin: 20px 0; }
+.medical-history { background-color: #fffbf0; padding: 15px; border-left: 4px solid #f6ad55; margin: 20px 0; }
+.prescription-area { background-color: #fffaf0; border: 1px solid #ccc; border-radius: 8px; padding: 20px; margin: 20px 0; min-height: 300px; }
+.prescription-area pre { white-space: pre-wrap; font-family: inherit; margin: 10px 0; }
+.footer { margin-top: 40px; text-align: center; font-size: 12px; color: #666; }
+"""
+
+DEFAULT_RECEIPT_HTML = """
+<div class="receipt">
+  <div class="center">
+    <div class="shop-name">{{shop_name}}</div>
+    <div>{{shop_address}}</div>
+    <div>{{shop_phone}}</div>
+    {{gst_line}}
+    <div>{{receipt_header}}</div>
+  </div>
+  <hr>
+  <div>Receipt: {{receipt_number}}</div>
+  <div>Date: {{sale_date}} {{sale_time}}</div>
+  <div>Customer: {{customer_name}}</div>
+  <hr>
+  <table>
+    <thead><tr><th class="left">Item</th><th>Qty</th><th>Price</th><th>Total</th></tr></thead>
+    <tbody>{{items_rows}}</tbody>
+  </table>
+  <hr>
+  <table class="totals">
+    <tr><td class="left">Subtotal</td><td>{{subtotal}}</td></tr>
+    <tr><td class="left">Tax</td><td>{{tax_amount}}</td></tr>
+    <tr><td class="left">Discount</td><td>{{discount_amount}}</td></tr>
+    <tr class="grand"><td class="left">Total</td><td>{{total_amount}}</td></tr>
+    <tr><td class="left">Paid by</td><td>{{payment_method}}</td></tr>
+  </table>
+  <hr>
+  <div class="center">{{receipt_footer}}</div>
+</div>
+"""
+
+DEFAULT_RECEIPT_CSS = """
+.receipt { width: {{receipt_width}}mm; font-size: {{receipt_font_size}}px; }
+.center { text-align: center; }
+.shop-name { font-weight: bold; font-size: 1.3em; }
+table { width: 100%; border-collapse: collapse; }
+th, td { text-align: right; padding: 1px 0; }
+.left { text-align: left; }
+.grand td { font-weight: bold; }
+hr { border: none; border-top: 1px dashed #000; }
+"""
+
+PRESCRIPTION_TEMPLATE = (CompiledTemplate(DEFAULT_PRESCRIPTION_HTML), CompiledTemplate(DEFAULT_PRESCRIPTION_CSS))
+RECEIPT_TEMPLATE = (CompiledTemplate(DEFAULT_RECEIPT_HTML), CompiledTemplate(DEFAULT_RECEIPT_CSS))
+
+DOCUMENT_PAGE = CompiledTemplate("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8">
+<title>{{title}}</title>
+<style>
+body { margin: 0; padding: {{page_padding}}; font-family: {{font_family}}, sans-serif; font-size: {{font_size}}px; line-height: 1.6; background: white; color: #333; }
+@media print { body { margin: {{page_padding}}; padding: 0; } @page { size: {{paper_size}}; margin: 0; } .print-hidden { display: none !important; } }
+.watermark { position: fixed; top: 50%; left: 50%; transform: translate(-50%, -50%) rotate(-45deg); font-size: 48px; color: rgba(0,0,0,0.1); z-index: -1; pointer-events: none; }
+{{css}}
+</style>
+</head>
+<body>
+{{watermark}}
+{{body}}
+</body>
+</html>
+""")
+
+DOCUMENT_STRIP = re.compile(r"<html.*?>|</html>|<head.*?>.*?</head>|<body.*?>|</body>", re.IGNORECASE | re.DOTALL)
+
+def escape_values(values: dict) -> dict:
+    return {key: html.escape(str(value)) if value is not None else "" for key, value in values.items()}
+
+def format_date(value, pattern: str = "%Y-%m-%d") -> str:
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return value
+    return value.strftime(pattern) if value else ""
+
+def age_in_years(date_of_birth) -> str:
+    if isinstance(date_of_birth, str):
+        try:
+            date_of_birth = datetime.fromisoformat(date_of_birth.replace("Z", "+00:00"))
+        except ValueError:
+            return ""
+    if not date_of_birth:
+        return ""
+    today = datetime.utcnow().date()
+    born = date_of_birth.date()
+    return str(today.year - born.year - ((today.month, today.day) < (born.month, born.day)))
+
+def prescription_template_values(prescription: dict, doctor: dict, patient: dict, general: GeneralSettings, opd_paper: OPDPaperSettings) -> dict:
+    """Placeholder values for prescription templates, HTML escaped"""
+    fee = prescription.get("consultation_fee")
+    values = escape_values({
+        "clinic_name": general.shop_name,
+        "clinic_address": general.shop_address,
+        "clinic_phone": general.shop_phone,
+        "clinic_email": general.shop_email,
+        "clinic_website": general.shop_website,
+        "doctor_name": doctor.get("name") or "Unknown",
+        "doctor_specialization": doctor.get("specialization", ""),
+        "doctor_qualification": doctor.get("qualification", ""),
+        "doctor_license": doctor.get("license_number") or "N/A",
+        "doctor_phone": doctor.get("phone", ""),
+        "doctor_email": doctor.get("email", ""),
+        "patient_name": patient.get("name") or "Unknown Patient",
+        "patient_age": age_in_years(patient.get("date_of_birth")),
+        "patient_gender": patient.get("gender") or "Not specified",
+        "patient_phone": patient.get("phone", ""),
+        "patient_address": patient.get("address", ""),
+        "medical_history": patient.get("medical_history", ""),
+        "prescription_date": format_date(prescription.get("date")),
+        "prescription_time": format_date(prescription.get("date"), "%H:%M"),
+        "prescription_id": prescription["id"][-8:].upper(),
+        "prescription_notes": prescription.get("prescription_notes", ""),
+        "symptoms": prescription.get("symptoms", ""),
+        "diagnosis": prescription.get("diagnosis", ""),
+        "consultation_fee": f"{general.currency_symbol}{fee:.{general.decimal_places}f}" if fee else "",
+        "next_visit_date": format_date(prescription.get("next_visit_date")),
+        "print_instructions": opd_paper.print_instructions,
+        "watermark_text": opd_paper.watermark_text,
+        "clinic_name_size": opd_paper.clinic_name_size
+    })
+    # Optional blocks of the default template, built from already escaped values
+    values["patient_phone_line"] = f"<br><strong>Phone:</strong> {values['patient_phone']}" if values["patient_phone"] else ""
+    values["medical_history_section"] = (
+        f'<section class="medical-history"><strong>Medical History:</strong> {values["medical_history"]}</section>'
+        if values["medical_history"] and opd_paper.show_medical_history else ""
+    )
+    return values
+
+def receipt_template_values(sale: dict, general: GeneralSettings, printer: PrinterSettings) -> dict:
+    """Placeholder values for receipt templates, HTML escaped; items_rows is ready-made table rows"""
+    def money(amount) -> str:
+        return f"{general.currency_symbol}{(amount or 0):.{general.decimal_places}f}"
+    
+    values = escape_values({
+        "shop_name": general.shop_name,
+        "shop_address": general.shop_address,
+        "shop_phone": general.shop_phone,
+        "shop_email": general.shop_email,
+        "gst_number": general.gst_number,
+        "receipt_header": printer.receipt_header,
+        "receipt_footer": printer.receipt_footer,
+        "receipt_number": sale["id"][-8:].upper(),
+        "sale_date": format_date(sale.get("created_at")),
+        "sale_time": format_date(sale.get("created_at"), "%H:%M"),
+        "customer_name": sale.get("patient_name") or "Walk-in Customer",
+        "subtotal": money(sale.get("subtotal")),
+        "tax_amount": money(sale.get("tax_amount")),
+        "discount_amount": money(sale.get("discount_amount")),
+        "total_amount": money(sale.get("total_amount")),
+        "payment_method": str(sale.get("payment_method", "")).upper(),
+        "receipt_width": printer.receipt_width,
+        "receipt_font_size": printer.receipt_font_size
+    })
+    values["gst_line"] = f"<div>GST: {values['gst_number']}</div>" if values["gst_number"] else ""
+    values["items_rows"] = "".join(
+        f'<tr><td class="left">{html.escape(item.get("medicine_name", ""))}</td><td>{item.get("quantity", 0)}</td>'
+        f'<td>{html.escape(money(item.get("unit_price")))}</td><td>{html.escape(money(item.get("total_price")))}</td></tr>'
+        for item in sale.get("items", [])
+    )
+    return values
+
+def html_to_pdf(document: str) -> bytes:
+    """Runs on the render thread: WeasyPrint is CPU bound and not thread safe"""
+    from weasyprint import HTML
+    return HTML(string=document).write_pdf()
+
+_render_executor: Optional[ThreadPoolExecutor] = None
+
+def get_render_executor() -> ThreadPoolExecutor:
+    """Single thread used for PDF rendering.
+
+    A thread rather than processes, which on Windows would each re-import this
+    module, database client included. One thread, because WeasyPrint is not
+    thread safe; repeat prints are served from the render cache.
+    """
+    global _render_executor
+    if _render_executor is None:
+        _render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+    return _render_executor
+
+def require_weasyprint():
+    from importlib.util import find_spec
+    if find_spec("weasyprint") is None:
+        raise HTTPException(status_code=501, detail="PDF rendering requires the weasyprint package")
+
+async def select_template(template_id: Optional[str], default: tuple, opd_paper: Optional[OPDPaperSettings] = None) -> tuple:
+    """Compiled (html, css) for a custom template, the opd_paper custom HTML, or the built-in default"""
+    if template_id:
+        template = await db.custom_templates.find_one({"id": template_id}, {"_id": 0, "html": 1, "css": 1, "updated_at": 1})
+        if not template:
+            raise HTTPException(status_code=404, detail="Template not found")
+        return template_compiler.get(("custom", template_id, str(template.get("updated_at"))), template["html"], template["css"])
+    if opd_paper and opd_paper.custom_html_enabled and opd_paper.custom_html:
+        return template_compiler.get(("opd_paper", await settings_service.version()), opd_paper.custom_html, opd_paper.custom_css)
+    return default
+
+async def render_document(
+    cache_key: tuple,
+    fingerprint: tuple,
+    output_format: RenderFormat,
+    compiled: tuple,
+    values: dict,
+    page: dict
+) -> RenderedDocument:
+    body_template, css_template = compiled
+    body = DOCUMENT_STRIP.sub("", body_template.render(values))
+    watermark = page.pop("watermark_text", "")
+    document = DOCUMENT_PAGE.render({
+        **page,
+        "css": css_template.render(values),
+        "watermark": f'<div class="watermark">{watermark}</div>' if watermark else "",
+        "body": body
+    })
+    if output_format == RenderFormat.PDF:
+        loop = asyncio.get_running_loop()
+        entry = RenderedDocument(
+            content=await loop.run_in_executor(get_render_executor(), html_to_pdf, document),
+            media_type="application/pdf",
+            fingerprint=fingerprint
+        )
+    else:
+        entry = RenderedDocument(content=document.encode(), media_type="text/html; charset=utf-8", fingerprint=fingerprint)
+    render_cache.set(cache_key, entry)
+    return entry
+
+def rendered_response(entry: RenderedDocument, cache_status: str):
+    from fastapi.responses import Response
+    return Response(entry.content, media_type=entry.media_type, headers={"X-Cache": cache_status})
+
+def document_digest(document: dict) -> str:
+    return hashlib.blake2b(dump_json(document), digest_size=16).hexdigest()
+
+# Collections whose writes change how a prescription or receipt renders
+PRESCRIPTION_RENDER_COLLECTIONS = ("doctors", "patients", "custom_templates")
+RECEIPT_RENDER_COLLECTIONS = ("custom_templates",)
+response_cache.track(PRESCRIPTION_RENDER_COLLECTIONS + RECEIPT_RENDER_COLLECTIONS)
+
+@api_router.get("/opd-prescriptions/{prescription_id}/render")
+async def render_prescription(
+    prescription_id: str,
+    format: RenderFormat = RenderFormat.HTML,
+    template_id: Optional[str] = None
+):
+    """Printable prescription using the template_id custom template, the opd_paper
+    custom HTML when enabled, or the default layout. Reprints are served from cache.
+    """
+    if format == RenderFormat.PDF:
+        require_weasyprint()
+    prescription = await db.opd_prescriptions.find_one({"id": prescription_id}, {"_id": 0})
+    if not prescription:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    
+    cache_key = ("prescription", prescription_id, format.value, template_id)
+    fingerprint = (
+        document_digest(prescription),
+        response_cache.generations(PRESCRIPTION_RENDER_COLLECTIONS),
+        await settings_service.version()
+    )
+    cached = render_cache.get(cache_key, fingerprint)
+    if cached is not None:
+        return rendered_response(cached, "HIT")
+    
+    doctor, patient = await asyncio.gather(
+        db.doctors.find_one({"id": prescription["doctor_id"]}, {"_id": 0}),
+        db.patients.find_one({"id": prescription["patient_id"]}, {"_id": 0})
+    )
+    if not doctor or not patient:
+        raise HTTPException(status_code=404, detail="Doctor or Patient not found")
+    
+    general, opd_paper = await asyncio.gather(settings_service.general(), settings_service.opd_paper())
+    compiled = await select_template(template_id, PRESCRIPTION_TEMPLATE, opd_paper)
+    entry = await render_document(
+        cache_key, fingerprint, format, compiled,
+        prescription_template_values(prescription, doctor, patient, general, opd_paper),
+        {
+            "title": "OPD Prescription",
+            "page_padding": f"{opd_paper.margin_top}mm {opd_paper.margin_right}mm {opd_paper.margin_bottom}mm {opd_paper.margin_left}mm",
+            "font_family": html.escape(opd_paper.font_family),
+            "font_size": opd_paper.font_size,
+            "paper_size": html.escape(opd_paper.paper_size),
+            "watermark_text": html.escape(opd_paper.watermark_text)
+        }
+    )
+    return rendered_response(entry, "MISS")
+
+@api_router.get("/sales/{sale_id}/receipt")
+async def render_sale_receipt(
+    sale_id: str,
+    format: RenderFormat = RenderFormat.HTML,
+    template_id: Optional[str] = None
+):
+    """Printable receipt for a sale, from the template_id custom template or the default layout"""
+    if format == RenderFormat.PDF:
+        require_weasyprint()
+    sale = await db.sales.find_one({"id": sale_id}, {"_id": 0})
+    if not sale:
+        raise HTTPException(status_code=404, detail="Sale not found")
+    
+    cache_key = ("receipt", sale_id, format.value, template_id)
+    fingerprint = (
+        document_digest(sale),
+        response_cache.generations(RECEIPT_RENDER_COLLECTIONS),
+        await settings_service.version()
+    )
+    cached = render_cache.get(cache_key, fingerprint)
+    if cached is not None:
+        return rendered_response(cached, "HIT")
+    
+    general, printer = await asyncio.gather(settings_service.general(), settings_service.printer())
+    compiled = await select_template(template_id, RECEIPT_TEMPLATE)
+    entry = await render_document(
+        cache_key, fingerprint, format, compiled,
+        receipt_template_values(sale, general, printer),
+        {
+            "title": f"Receipt {sale_id[-8:].upper()}",
+            "page_padding": "4mm",
+            "font_family": "monospace",
+            "font_size": printer.receipt_font_size,
+            "paper_size": f"{printer.receipt_width}mm auto"
+        }
+    )
+    return rendered_response(entry, "MISS")
+
+
+# Backup & Restore Models and APIs
+class BackupStatus(str, Enum):
+    CREATING = "creating"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    RESTORING = "restoring"
+    CORRUPTED = "corrupted"
+
+class BackupType(str, Enum):
+    MANUAL = "manual"
+    SCHEDULED = "scheduled"
+    AUTOMATIC = "automatic"
+
+@api_router.get("/backup/directory-info")
+async def get_backup_directory_info():
+    """Get backup directory path information"""
+    try:
+        backup_dir = Path.cwd() / "backups"
+        return {
             "backup_directory": str(backup_dir.absolute()),
             "exists": backup_dir.exists(),
             "platform": "Windows" if os.name == 'nt' else "Unix",
@@ -2605,6 +5488,7 @@ class BackupInfo(BaseModel):
     file_path: Optional[str] = None
     file_size: Optional[int] = None
     checksum: Optional[str] = None
+    checksum_algorithm: Optional[str] = None  # None means legacy MD5 checksum
     created_at: datetime = Field(default_factory=datetime.utcnow)
     completed_at: Optional[datetime] = None
     database_collections: Optional[dict] = None
@@ -2626,10 +5510,213 @@ class RestoreRequest(BaseModel):
     restore_settings: bool = True
     force_restore: bool = False
 
+# Collections written to database backups (one JSON file per collection)
+BACKUP_COLLECTIONS = [
+    "medicines", "patients", "doctors", "sales",
+    "opd_prescriptions", "stock_movements", "returns", "custom_templates"
+]
+
+BACKUP_COLLECTION_MODELS = {
+    "medicines": Medicine,
+    "patients": Patient,
+    "doctors": Doctor,
+    "sales": Sale,
+    "opd_prescriptions": OPDPrescription,
+    "stock_movements": StockMovement,
+    "returns": Return,
+    "custom_templates": CustomTemplate
+}
+
+def restorable_documents(collection_name: str, documents: list, backfill=None) -> list:
+    """Backup documents ready to insert into `collection_name`.
+
+    Backups are JSON written with default=str, so datetimes come back as strings.
+    `backfill` first fills fields that older backups lack from what they do hold,
+    so model defaults never stand in for real values. Documents that then validate
+    against the collection's model are stored as the model dumps them, with real
+    datetimes, and stamped as trusted. Anything else is stored as read without the
+    stamp, so it is validated whenever it is served and migrated after the restore.
+    """
+    model = BACKUP_COLLECTION_MODELS[collection_name]
+    restored = []
+    for document in documents:
+        document.pop("_id", None)
+        if backfill is not None:
+            backfill(document)
+        try:
+            restored.append(to_document(model(**document)))
+        except ValidationError:
+            document.pop("schema_version", None)
+            restored.append(document)
+    return restored
+
+def backfill_stock_movement(document: dict):
+    """Movements from before recorded_at existed changed stock when they were created"""
+    if "recorded_at" not in document and document.get("created_at"):
+        document["recorded_at"] = document["created_at"]
+
+def sale_backfill(medicines: dict, returned_per_sale: dict):
+    """Backfill for restored sales, filling line fields the way migrations 0001 and 0002 do:
+    returned_quantity from the restored returns, unit_cost and the medicine snapshot
+    from `medicines` (id -> medicine)
+    """
+    def backfill(document: dict):
+        items = document.get("items")
+        if not isinstance(items, list) or not all(isinstance(item, dict) and "medicine_id" in item for item in items):
+            return
+        if any("returned_quantity" not in item for item in items):
+            allocated = allocate_returned_quantities(items, returned_per_sale.get(document.get("id"), {}))
+            for line_index, item in enumerate(items):
+                item.setdefault("returned_quantity", allocated.get(line_index, 0))
+        for item in items:
+            if "unit_cost" not in item:
+                medicine = medicines.get(item["medicine_id"], {})
+                item["unit_cost"] = medicine.get("purchase_price") or 0
+                item.setdefault("manufacturer", medicine.get("manufacturer"))
+                item.setdefault("generic_name", medicine.get("generic_name"))
+    return backfill
+
+async def sale_restore_backfill(backup_folder: Path):
+    """sale_backfill from the backup's medicines and returns; the current medicines when none were backed up"""
+    medicines_file = backup_folder / "medicines.json"
+    if medicines_file.exists():
+        with open(medicines_file, "r") as f:
+            medicines = json.load(f)
+    else:
+        medicines = await db.medicines.find({}, {"_id": 0, "id": 1, **SALE_COST_FIELDS}).to_list(None)
+    
+    returned_per_sale = defaultdict(lambda: defaultdict(int))
+    returns_file = backup_folder / "returns.json"
+    if returns_file.exists():
+        with open(returns_file, "r") as f:
+            for return_record in json.load(f):
+                for item in return_record.get("items", []):
+                    returned_per_sale[return_record.get("original_sale_id")][item.get("medicine_id")] += item.get("quantity", 0)
+    
+    return sale_backfill({medicine.get("id"): medicine for medicine in medicines}, returned_per_sale)
+
+BACKUP_METADATA_FILE = "backup_metadata.json"
+BACKUP_CHECKSUM_ALGORITHM = "blake2b"
+LEGACY_CHECKSUM_ALGORITHM = "md5"
+CHECKSUM_CHUNK_SIZE = 1024 * 1024  # 1 MiB reads instead of 4 KiB
+
+_backup_hash_executor: Optional[ThreadPoolExecutor] = None
+
+def get_backup_hash_executor() -> ThreadPoolExecutor:
+    """Threads used for hashing and verifying backup files.
+
+    BLAKE2 and gzip release the GIL on large buffers, so threads hash in parallel
+    without the per-worker module import a process pool costs on Windows.
+    """
+    global _backup_hash_executor
+    if _backup_hash_executor is None:
+        workers = int(os.environ.get("BACKUP_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+        _backup_hash_executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="backup-hash")
+    return _backup_hash_executor
+
+def hash_file(file_path: str, algorithm: str = BACKUP_CHECKSUM_ALGORITHM) -> str:
+    """Hash a file using large buffered reads"""
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(CHECKSUM_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+def archive_has_metadata(archive_path: str) -> bool:
+    """Check for the metadata file, stopping at the first match instead of listing every member"""
+    with tarfile.open(archive_path, "r:gz") as tar:
+        for member in tar:
+            if Path(member.name).name == BACKUP_METADATA_FILE:
+                return True
+    return False
+
+def deep_verify_backup(backup_path: str) -> dict:
+    """Validate every collection file and its document count against the backup metadata.
+
+    Archive members are streamed and hashed in memory, nothing is extracted to disk.
+    """
+    path = Path(backup_path)
+    found_files = {}
+    metadata = None
+
+    def inspect_file(name: str, data: bytes):
+        nonlocal metadata
+        if name == BACKUP_METADATA_FILE:
+            metadata = json.loads(data)
+        elif name.endswith(".json"):
+            documents = json.loads(data)
+            found_files[name] = {
+                "checksum": hashlib.new(BACKUP_CHECKSUM_ALGORITHM, data).hexdigest(),
+                "documents": len(documents) if isinstance(documents, list) else 1
+            }
+
+    if path.is_file():
+        with tarfile.open(path, "r:gz") as tar:
+            for member in tar:
+                if member.isfile():
+                    inspect_file(Path(member.name).name, tar.extractfile(member).read())
+    else:
+        for file_path in path.glob("*.json"):
+            inspect_file(file_path.name, file_path.read_bytes())
+
+    if metadata is None:
+        return {"success": False, "error": "Backup metadata file not found", "collections": {}}
+
+    collection_checksums = metadata.get("collection_checksums", {})
+    expected_counts = metadata.get("collections", {})
+    results = {}
+    errors = []
+
+    for collection_name, expected_documents in expected_counts.items():
+        expected = collection_checksums.get(collection_name, {})
+        file_name = expected.get("file", f"{collection_name}.json")
+        actual = found_files.get(file_name)
+        result = {"file": file_name, "expected_documents": expected_documents}
+
+        if actual is None:
+            result["status"] = "missing"
+            errors.append(f"{collection_name}: file {file_name} missing")
+        else:
+            result["documents"] = actual["documents"]
+            checksum_ok = None
+            if expected.get("checksum"):
+                checksum_ok = actual["checksum"] == expected["checksum"]
+            result["checksum_verified"] = checksum_ok
+
+            if actual["documents"] != expected_documents:
+                result["status"] = "count_mismatch"
+                errors.append(f"{collection_name}: expected {expected_documents} documents, found {actual['documents']}")
+            elif checksum_ok is False:
+                result["status"] = "checksum_mismatch"
+                errors.append(f"{collection_name}: checksum mismatch")
+            else:
+                result["status"] = "verified"
+        results[collection_name] = result
+
+    return {
+        "success": not errors,
+        "errors": errors,
+        "collections": results,
+        "per_collection_checksums": bool(collection_checksums)
+    }
+
+async def run_in_hash_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_backup_hash_executor(), func, *args)
+
 # Backup Management APIs
 @api_router.post("/backup/create")
 async def create_backup(backup_request: BackupCreate):
     """Create a new backup"""
+    return await run_backup(backup_request, BackupType.MANUAL)
+
+async def run_backup(backup_request: BackupCreate, backup_type: BackupType = BackupType.MANUAL):
+    """Write the requested collections to a backup folder or archive and record it"""
     try:
         # Create backup directory relative to current working directory (works on both Windows and Unix)
         backup_dir = Path.cwd() / "backups"
@@ -2639,7 +5726,7 @@ async def create_backup(backup_request: BackupCreate):
         backup_info = BackupInfo(
             name=backup_request.name,
             description=backup_request.description,
-            backup_type=BackupType.MANUAL,
+            backup_type=backup_type,
             status=BackupStatus.CREATING,
             app_version="1.0.0",
             created_by="system"
@@ -2666,61 +5753,27 @@ async def create_backup(backup_request: BackupCreate):
             if backup_request.include_database:
                 collections_info = {}
                 
-                # Backup medicines
-                medicines = await db.medicines.find().to_list(10000)
-                if medicines:
-                    with open(backup_folder / "medicines.json", "w") as f:
-                        json.dump(medicines, f, default=str, indent=2)
-                    collections_info["medicines"] = len(medicines)
-                
-                # Backup patients
-                patients = await db.patients.find().to_list(10000)
-                if patients:
-                    with open(backup_folder / "patients.json", "w") as f:
-                        json.dump(patients, f, default=str, indent=2)
-                    collections_info["patients"] = len(patients)
+                for collection_name in BACKUP_COLLECTIONS:
+                    documents = await db[collection_name].find().to_list(10000)
+                    if documents:
+                        with open(backup_folder / f"{collection_name}.json", "w") as f:
+                            json.dump(documents, f, default=str, indent=2)
+                        collections_info[collection_name] = len(documents)
                 
-                # Backup doctors
-                doctors = await db.doctors.find().to_list(10000)
-                if doctors:
-                    with open(backup_folder / "doctors.json", "w") as f:
-                        json.dump(doctors, f, default=str, indent=2)
-                    collections_info["doctors"] = len(doctors)
-                
-                # Backup sales
-                sales = await db.sales.find().to_list(10000)
-                if sales:
-                    with open(backup_folder / "sales.json", "w") as f:
-                        json.dump(sales, f, default=str, indent=2)
-                    collections_info["sales"] = len(sales)
-                
-                # Backup OPD prescriptions
-                prescriptions = await db.opd_prescriptions.find().to_list(10000)
-                if prescriptions:
-                    with open(backup_folder / "opd_prescriptions.json", "w") as f:
-                        json.dump(prescriptions, f, default=str, indent=2)
-                    collections_info["opd_prescriptions"] = len(prescriptions)
-                
-                # Backup stock movements
-                stock_movements = await db.stock_movements.find().to_list(10000)
-                if stock_movements:
-                    with open(backup_folder / "stock_movements.json", "w") as f:
-                        json.dump(stock_movements, f, default=str, indent=2)
-                    collections_info["stock_movements"] = len(stock_movements)
-                
-                # Backup returns
-                returns = await db.returns.find().to_list(10000)
-                if returns:
-                    with open(backup_folder / "returns.json", "w") as f:
-                        json.dump(returns, f, default=str, indent=2)
-                    collections_info["returns"] = len(returns)
-                
-                # Backup custom templates
-                templates = await db.custom_templates.find().to_list(10000)
-                if templates:
-                    with open(backup_folder / "custom_templates.json", "w") as f:
-                        json.dump(templates, f, default=str, indent=2)
-                    collections_info["custom_templates"] = len(templates)
+                # Per-collection checksums let a deep verify validate files without extracting
+                checksums = await asyncio.gather(*[
+                    run_in_hash_pool(hash_file, str(backup_folder / f"{collection_name}.json"))
+                    for collection_name in collections_info
+                ])
+                backup_data["checksum_algorithm"] = BACKUP_CHECKSUM_ALGORITHM
+                backup_data["collection_checksums"] = {
+                    collection_name: {
+                        "file": f"{collection_name}.json",
+                        "documents": count,
+                        "checksum": checksum
+                    }
+                    for (collection_name, count), checksum in zip(collections_info.items(), checksums)
+                }
                 
                 backup_data["collections"] = collections_info
             
@@ -2735,7 +5788,7 @@ async def create_backup(backup_request: BackupCreate):
                         json.dump(settings, f, default=str, indent=2)
             
             # Create backup metadata
-            with open(backup_folder / "backup_metadata.json", "w") as f:
+            with open(backup_folder / BACKUP_METADATA_FILE, "w") as f:
                 json.dump(backup_data, f, default=str, indent=2)
             
             # Create archive if requested
@@ -2746,18 +5799,20 @@ async def create_backup(backup_request: BackupCreate):
             if backup_request.create_archive:
                 archive_path = backup_dir / f"backup_{timestamp}_{backup_info.id[:8]}.tar.gz"
                 
-                # Create tar archive
+                # Create tar archive with the metadata as the first member so verification
+                # can find it without decompressing the whole archive
                 with tarfile.open(archive_path, "w:gz") as tar:
-                    tar.add(backup_folder, arcname=f"backup_{timestamp}")
+                    tar.add(backup_folder / BACKUP_METADATA_FILE, arcname=f"backup_{timestamp}/{BACKUP_METADATA_FILE}")
+                    tar.add(
+                        backup_folder,
+                        arcname=f"backup_{timestamp}",
+                        filter=lambda member: None if member.name.endswith(f"/{BACKUP_METADATA_FILE}") else member
+                    )
                 
                 file_size = archive_path.stat().st_size
                 
                 # Calculate checksum
-                hash_md5 = hashlib.md5()
-                with open(archive_path, "rb") as f:
-                    for chunk in iter(lambda: f.read(4096), b""):
-                        hash_md5.update(chunk)
-                checksum = hash_md5.hexdigest()
+                checksum = await run_in_hash_pool(hash_file, str(archive_path), BACKUP_CHECKSUM_ALGORITHM)
                 
                 # Remove the folder since we have the archive
                 shutil.rmtree(backup_folder)
@@ -2775,6 +5830,7 @@ async def create_backup(backup_request: BackupCreate):
                     "file_path": str(archive_path),
                     "file_size": file_size,
                     "checksum": checksum,
+                    "checksum_algorithm": BACKUP_CHECKSUM_ALGORITHM if checksum else None,
                     "completed_at": completed_at.isoformat(),
                     "database_collections": collections_info if backup_request.include_database else {}
                 }}
@@ -2872,7 +5928,7 @@ async def restore_backup(restore_request: RestoreRequest):
                     if medicines_data:
                         if not restore_request.force_restore:
                             await db.medicines.delete_many({})
-                        await db.medicines.insert_many(medicines_data)
+                        await db.medicines.insert_many(await asyncio.to_thread(restorable_documents, "medicines", medicines_data))
                         restored_collections["medicines"] = len(medicines_data)
                 
                 # Restore patients
@@ -2883,7 +5939,7 @@ async def restore_backup(restore_request: RestoreRequest):
                     if patients_data:
                         if not restore_request.force_restore:
                             await db.patients.delete_many({})
-                        await db.patients.insert_many(patients_data)
+                        await db.patients.insert_many(await asyncio.to_thread(restorable_documents, "patients", patients_data))
                         restored_collections["patients"] = len(patients_data)
                 
                 # Restore doctors
@@ -2894,7 +5950,7 @@ async def restore_backup(restore_request: RestoreRequest):
                     if doctors_data:
                         if not restore_request.force_restore:
                             await db.doctors.delete_many({})
-                        await db.doctors.insert_many(doctors_data)
+                        await db.doctors.insert_many(await asyncio.to_thread(restorable_documents, "doctors", doctors_data))
                         restored_collections["doctors"] = len(doctors_data)
                 
                 # Restore sales
@@ -2903,9 +5959,12 @@ async def restore_backup(restore_request: RestoreRequest):
                     with open(sales_file, "r") as f:
                         sales_data = json.load(f)
                     if sales_data:
+                        # Before the sales change, so no worker's cube refreshes onto the old data afterwards
+                        await sales_cube.reset()
                         if not restore_request.force_restore:
                             await db.sales.delete_many({})
-                        await db.sales.insert_many(sales_data)
+                        backfill = await sale_restore_backfill(backup_folder)
+                        await db.sales.insert_many(await asyncio.to_thread(restorable_documents, "sales", sales_data, backfill))
                         restored_collections["sales"] = len(sales_data)
                 
                 # Restore OPD prescriptions
@@ -2916,7 +5975,7 @@ async def restore_backup(restore_request: RestoreRequest):
                     if prescriptions_data:
                         if not restore_request.force_restore:
                             await db.opd_prescriptions.delete_many({})
-                        await db.opd_prescriptions.insert_many(prescriptions_data)
+                        await db.opd_prescriptions.insert_many(await asyncio.to_thread(restorable_documents, "opd_prescriptions", prescriptions_data))
                         restored_collections["opd_prescriptions"] = len(prescriptions_data)
                 
                 # Restore stock movements
@@ -2927,7 +5986,9 @@ async def restore_backup(restore_request: RestoreRequest):
                     if stock_movements_data:
                         if not restore_request.force_restore:
                             await db.stock_movements.delete_many({})
-                        await db.stock_movements.insert_many(stock_movements_data)
+                        await db.stock_movements.insert_many(
+                            await asyncio.to_thread(restorable_documents, "stock_movements", stock_movements_data, backfill_stock_movement)
+                        )
                         restored_collections["stock_movements"] = len(stock_movements_data)
                 
                 # Restore returns
@@ -2938,7 +5999,7 @@ async def restore_backup(restore_request: RestoreRequest):
                     if returns_data:
                         if not restore_request.force_restore:
                             await db.returns.delete_many({})
-                        await db.returns.insert_many(returns_data)
+                        await db.returns.insert_many(await asyncio.to_thread(restorable_documents, "returns", returns_data))
                         restored_collections["returns"] = len(returns_data)
                 
                 # Restore custom templates
@@ -2949,8 +6010,17 @@ async def restore_backup(restore_request: RestoreRequest):
                     if templates_data:
                         if not restore_request.force_restore:
                             await db.custom_templates.delete_many({})
-                        await db.custom_templates.insert_many(templates_data)
+                        await db.custom_templates.insert_many(await asyncio.to_thread(restorable_documents, "custom_templates", templates_data))
                         restored_collections["custom_templates"] = len(templates_data)
+                
+                if restored_collections:
+                    # Bring anything the backfills could not fill up to the current schema
+                    await run_data_migrations(rerun=True)
+                
+                if "medicines" in restored_collections or "stock_movements" in restored_collections:
+                    # Earlier checkpoints describe the replaced data; start the ledger over from the restored stock
+                    await db.stock_checkpoints.delete_many({})
+                    await write_stock_checkpoint()
             
             # Restore settings
             if restore_request.restore_settings:
@@ -2959,9 +6029,12 @@ async def restore_backup(restore_request: RestoreRequest):
                     with open(settings_file, "r") as f:
                         settings_data = json.load(f)
                     if settings_data:
-                        # Remove existing settings and insert restored one
+                        # Remove existing settings and insert restored one; a new version tells other workers to reload
+                        current_settings = await db.settings.find_one({}, {"version": 1}) or {}
+                        settings_data["version"] = current_settings.get("version", 0) + 1
                         await db.settings.delete_many({})
                         await db.settings.insert_one(settings_data)
+                        settings_service.invalidate()
                         restored_collections["settings"] = 1
             
             # Update backup status back to completed
@@ -3029,8 +6102,8 @@ async def delete_backup(backup_id: str):
         raise HTTPException(status_code=500, detail=f"Failed to delete backup: {str(e)}")
 
 @api_router.get("/backup/{backup_id}/verify")
-async def verify_backup(backup_id: str):
-    """Verify backup integrity"""
+async def verify_backup(backup_id: str, deep: bool = False):
+    """Verify backup integrity (deep=true also validates every collection file)"""
     try:
         backup = await db.backups.find_one({"id": backup_id})
         if not backup:
@@ -3054,58 +6127,89 @@ async def verify_backup(backup_id: str):
                 "status": "corrupted"
             }
         
-        # Verify checksum if available
+        checksum_algorithm = backup_info.checksum_algorithm or LEGACY_CHECKSUM_ALGORITHM
+        is_archive = backup_path.is_file() and backup_path.suffix == '.gz'
+        
+        # Checksum, metadata and deep checks read the file independently, so run them in parallel
+        checksum_task = None
         if backup_info.checksum and backup_path.is_file():
-            hash_md5 = hashlib.md5()
-            with open(backup_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            calculated_checksum = hash_md5.hexdigest()
-            
-            if calculated_checksum != backup_info.checksum:
-                await db.backups.update_one(
-                    {"id": backup_id},
-                    {"$set": {"status": BackupStatus.CORRUPTED.value}}
-                )
-                return {
-                    "success": False,
-                    "error": "Checksum mismatch - backup may be corrupted",
-                    "status": "corrupted",
-                    "expected_checksum": backup_info.checksum,
-                    "calculated_checksum": calculated_checksum
-                }
+            checksum_task = run_in_hash_pool(hash_file, str(backup_path), checksum_algorithm)
+        metadata_task = run_in_hash_pool(archive_has_metadata, str(backup_path)) if is_archive and not deep else None
+        deep_task = run_in_hash_pool(deep_verify_backup, str(backup_path)) if deep else None
         
-        # Basic file structure verification for archives
-        if backup_path.suffix == '.gz':
-            try:
-                with tarfile.open(backup_path, "r:gz") as tar:
-                    members = tar.getnames()
-                    # Check if required files exist
-                    has_metadata = any("backup_metadata.json" in member for member in members)
-                    if not has_metadata:
-                        return {
-                            "success": False,
-                            "error": "Backup metadata file not found",
-                            "status": "corrupted"
-                        }
-            except Exception as e:
-                await db.backups.update_one(
-                    {"id": backup_id},
-                    {"$set": {"status": BackupStatus.CORRUPTED.value}}
-                )
-                return {
-                    "success": False,
-                    "error": f"Cannot read backup archive: {str(e)}",
-                    "status": "corrupted"
-                }
+        results = await asyncio.gather(
+            *[task for task in (checksum_task, metadata_task, deep_task) if task is not None],
+            return_exceptions=True
+        )
+        results = iter(results)
+        calculated_checksum = next(results) if checksum_task else None
+        has_metadata = next(results) if metadata_task else None
+        deep_result = next(results) if deep_task else None
         
-        return {
+        # Verify checksum if available
+        if isinstance(calculated_checksum, Exception):
+            raise calculated_checksum
+        if calculated_checksum is not None and calculated_checksum != backup_info.checksum:
+            await db.backups.update_one(
+                {"id": backup_id},
+                {"$set": {"status": BackupStatus.CORRUPTED.value}}
+            )
+            return {
+                "success": False,
+                "error": "Checksum mismatch - backup may be corrupted",
+                "status": "corrupted",
+                "checksum_algorithm": checksum_algorithm,
+                "expected_checksum": backup_info.checksum,
+                "calculated_checksum": calculated_checksum
+            }
+        
+        # Archive structure verification
+        archive_error = next(
+            (result for result in (has_metadata, deep_result) if isinstance(result, Exception)),
+            None
+        )
+        if archive_error is not None:
+            await db.backups.update_one(
+                {"id": backup_id},
+                {"$set": {"status": BackupStatus.CORRUPTED.value}}
+            )
+            return {
+                "success": False,
+                "error": f"Cannot read backup archive: {str(archive_error)}",
+                "status": "corrupted"
+            }
+        
+        if has_metadata is False:
+            return {
+                "success": False,
+                "error": "Backup metadata file not found",
+                "status": "corrupted"
+            }
+        
+        if deep_result is not None and not deep_result["success"]:
+            await db.backups.update_one(
+                {"id": backup_id},
+                {"$set": {"status": BackupStatus.CORRUPTED.value}}
+            )
+            return {
+                "success": False,
+                "error": deep_result.get("error") or "; ".join(deep_result["errors"]),
+                "status": "corrupted",
+                "collections": deep_result["collections"]
+            }
+        
+        response = {
             "success": True,
             "message": "Backup verification successful",
             "status": "verified",
             "file_size": backup_path.stat().st_size,
-            "checksum_verified": backup_info.checksum is not None
+            "checksum_verified": calculated_checksum is not None,
+            "checksum_algorithm": checksum_algorithm if backup_info.checksum else None
         }
+        if deep_result is not None:
+            response["collections"] = deep_result["collections"]
+            response["per_collection_checksums"] = deep_result["per_collection_checksums"]
+        return response
         
     except HTTPException:
         raise
@@ -3151,11 +6255,470 @@ async def cleanup_old_backups(days_to_keep: int = 30):
         raise HTTPException(status_code=500, detail=f"Cleanup failed: {str(e)}")
 
 
+# Scheduled Jobs
+class CronExpression:
+    """Five-field cron expression (minute hour day-of-month month day-of-week) read as wall-clock time"""
+    
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]  # 0 and 7 are both Sunday
+    
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse_field(field, low, high, is_weekday=(index == 4))
+            for index, (field, (low, high)) in enumerate(zip(fields, self.FIELD_RANGES))
+        ]
+        # Standard cron semantics: when both day fields are restricted either may match
+        self.day_restricted = fields[2] != "*"
+        self.weekday_restricted = fields[4] != "*"
+    
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int, is_weekday: bool = False) -> set:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_str = part.split("/", 1)
+                step = int(step_str)
+                if step < 1:
+                    raise ValueError(f"Invalid cron step: {field}")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start_str, end_str = part.split("-", 1)
+                start, end = int(start_str), int(end_str)
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end:
+                raise ValueError(f"Cron field out of range: {field}")
+            values.update(range(start, end + 1, step))
+        if is_weekday and 7 in values:
+            values.discard(7)
+            values.add(0)
+        return values
+    
+    def _day_matches(self, dt: datetime) -> bool:
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.day_restricted and self.weekday_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+    
+    def next_after(self, after: datetime, zone=None) -> datetime:
+        """Return the first matching minute strictly after `after` (naive UTC), as naive UTC.
+
+        The fields are read as wall-clock time in `zone` (a tzinfo; UTC when None).
+        A time skipped by a DST change runs at the shifted instant; a repeated one runs once.
+        """
+        if zone is None:
+            return self._next_wall_clock(after)
+        local = after.replace(tzinfo=timezone.utc).astimezone(zone).replace(tzinfo=None)
+        while True:
+            local = self._next_wall_clock(local)
+            candidate = local.replace(tzinfo=zone).astimezone(timezone.utc).replace(tzinfo=None)
+            if candidate > after:
+                return candidate
+    
+    def _next_wall_clock(self, after: datetime) -> datetime:
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * 5)
+        while dt <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+                continue
+            if dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+                continue
+            return dt
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+class JobStatus(str, Enum):
+    SUCCESS = "success"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    RUNNING = "running"
+
+class ScheduledJob(BaseModel):
+    id: str
+    name: str
+    description: Optional[str] = None
+    cron: str
+    enabled: bool = True
+    follow_settings: bool = False  # Cron is derived from settings until edited by hand
+    timezone: Optional[str] = None  # Zone the cron is read in; None follows general.timezone
+    jitter_seconds: int = 0
+    next_run_at: Optional[datetime] = None
+    last_run_at: Optional[datetime] = None
+    last_status: Optional[JobStatus] = None
+    last_message: Optional[str] = None
+    last_duration_seconds: Optional[float] = None
+
+class ScheduledJobUpdate(BaseModel):
+    cron: Optional[str] = None
+    enabled: Optional[bool] = None
+    timezone: Optional[str] = None
+    jitter_seconds: Optional[int] = None
+
+BACKUP_FREQUENCY_CRON = {
+    "hourly": "30 * * * *",
+    "daily": "30 2 * * *",
+    "weekly": "30 2 * * 0",
+    "monthly": "30 2 1 * *"
+}
+
+# Off-peak defaults in the shop's timezone; jobs flagged follow_settings are re-derived from settings on save
+DEFAULT_SCHEDULED_JOBS = [
+    ScheduledJob(
+        id="auto_backup",
+        name="Automatic backup",
+        description="Full database and settings backup when general.auto_backup is enabled",
+        cron=BACKUP_FREQUENCY_CRON["daily"],
+        follow_settings=True,
+        jitter_seconds=300
+    ),
+    ScheduledJob(
+        id="backup_cleanup",
+        name="Backup cleanup",
+        description="Delete backups older than 30 days",
+        cron="15 3 * * *",
+        jitter_seconds=300
+    ),
+    ScheduledJob(
+        id="stock_checkpoint",
+        name="Stock checkpoint",
+        description="Snapshot stock levels as a starting point for point-in-time stock queries",
+        cron="5 0 * * *",
+        jitter_seconds=60
+    ),
+    ScheduledJob(
+        id="demand_classification",
+        name="Demand classification",
+        description="Roll up yesterday's sales per medicine and update ABC/XYZ classes",
+        cron="20 0 * * *",
+        timezone="UTC",  # rolls up UTC days
+        jitter_seconds=60
+    ),
+    ScheduledJob(
+        id="anomaly_detection",
+        name="Revenue anomaly detection",
+        description="Roll up yesterday's revenue and refunds and flag unusual days, hours and payment mixes",
+        cron="25 0 * * *",
+        timezone="UTC",  # rolls up UTC days
+        jitter_seconds=60
+    ),
+    ScheduledJob(
+        id="daily_report",
+        name="Telegram daily report",
+        description="Send the comprehensive daily report at telegram.daily_report_time",
+        cron="0 18 * * *",
+        follow_settings=True,
+        jitter_seconds=60
+    )
+]
+
+SCHEDULER_POLL_SECONDS = int(os.environ.get("SCHEDULER_POLL_SECONDS", 30))
+SCHEDULER_LOCK_TTL_SECONDS = SCHEDULER_POLL_SECONDS * 3
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").lower() == "true"
+
+def schedule_zone(name: str):
+    """tzinfo for an IANA zone name, falling back to UTC for unknown names"""
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Unknown timezone {name!r}; scheduling in UTC")
+        return timezone.utc
+
+def settings_job_timezone(job: ScheduledJob, settings: dict) -> str:
+    """Zone a job's cron is read in: its own, else the report or shop timezone from settings"""
+    if job.timezone:
+        return job.timezone
+    if job.id == "daily_report":
+        # telegram.timezone overrides the shop timezone once moved off its UTC default
+        report_timezone = settings.get("telegram", {}).get("timezone")
+        if report_timezone and report_timezone != "UTC":
+            return report_timezone
+    return settings.get("general", {}).get("timezone") or "UTC"
+
+async def compute_next_run(job: ScheduledJob, after: Optional[datetime] = None) -> datetime:
+    import random
+    
+    zone_name = settings_job_timezone(job, await settings_service.document())
+    next_run = CronExpression(job.cron).next_after(after or datetime.utcnow(), schedule_zone(zone_name))
+    if job.jitter_seconds > 0:
+        next_run += timedelta(seconds=random.uniform(0, job.jitter_seconds))
+    return next_run
+
+def settings_job_cron(job_id: str, settings: dict) -> Optional[str]:
+    """Derive the cron expression for settings-driven jobs"""
+    if job_id == "auto_backup":
+        frequency = settings.get("general", {}).get("backup_frequency", "daily")
+        return BACKUP_FREQUENCY_CRON.get(frequency, BACKUP_FREQUENCY_CRON["daily"])
+    if job_id == "daily_report":
+        report_time = settings.get("telegram", {}).get("daily_report_time", "18:00")
+        try:
+            hour, minute = (int(part) for part in report_time.split(":")[:2])
+            return f"{minute} {hour} * * *"
+        except (ValueError, AttributeError):
+            return "0 18 * * *"
+    return None
+
+async def job_auto_backup() -> str:
+    if not (await settings_service.general()).auto_backup:
+        return "skipped: automatic backups are disabled"
+    
+    result = await run_backup(
+        BackupCreate(name=f"Automatic backup {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"),
+        BackupType.AUTOMATIC
+    )
+    await db.settings.update_one(
+        {},
+        {"$set": {"general.last_backup": datetime.utcnow().isoformat()}, "$inc": {"version": 1}}
+    )
+    settings_service.invalidate()
+    return f"backup {result['backup_id']} created ({result['file_size']} bytes)"
+
+async def job_backup_cleanup() -> str:
+    result = await cleanup_old_backups(days_to_keep=30)
+    return result["message"]
+
+async def job_stock_checkpoint() -> str:
+    checkpoint = await write_stock_checkpoint()
+    return f"stock checkpoint of {checkpoint.medicine_count} medicines as of {checkpoint.as_of.isoformat()}"
+
+async def job_demand_classification() -> str:
+    return await run_demand_classification()
+
+async def job_anomaly_detection() -> str:
+    return await run_anomaly_detection()
+
+async def job_daily_report() -> str:
+    telegram = await settings_service.telegram()
+    if not telegram.enabled:
+        return "skipped: Telegram notifications not enabled"
+    if not telegram.bot_token or not telegram.chat_id:
+        return "skipped: Telegram bot token or chat ID not configured"
+    telegram_config = (await settings_service.document()).get("telegram", {})
+    
+    report_data = await generate_comprehensive_report()
+    report_message = build_daily_report_message(report_data, telegram_config)
+    response = await asyncio.to_thread(
+        send_telegram_message, telegram.bot_token, telegram.chat_id, report_message
+    )
+    if response.status_code != 200:
+        raise RuntimeError(response.json().get("description", "Failed to send message"))
+    return "daily report sent"
+
+SCHEDULED_JOB_HANDLERS = {
+    "auto_backup": job_auto_backup,
+    "backup_cleanup": job_backup_cleanup,
+    "stock_checkpoint": job_stock_checkpoint,
+    "demand_classification": job_demand_classification,
+    "anomaly_detection": job_anomaly_detection,
+    "daily_report": job_daily_report
+}
+
+class JobScheduler:
+    """In-process async scheduler backed by the scheduled_jobs collection.
+
+    Only the worker holding the Mongo lock runs due jobs, and every run is claimed
+    with a conditional update on next_run_at so a job never fires twice.
+    """
+    
+    def __init__(self):
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._task: Optional[asyncio.Task] = None
+        self._running_jobs = set()
+        self._job_tasks = set()
+    
+    async def ensure_jobs(self):
+        """Insert default jobs and align settings-driven schedules"""
+        for job in DEFAULT_SCHEDULED_JOBS:
+            job_doc = job.dict()
+            job_doc["next_run_at"] = await compute_next_run(job)
+            await db.scheduled_jobs.update_one({"id": job.id}, {"$setOnInsert": job_doc}, upsert=True)
+            if job.timezone:
+                # Jobs seeded before they had a timezone
+                await db.scheduled_jobs.update_one(
+                    {"id": job.id, "timezone": {"$exists": False}},
+                    {"$set": {"timezone": job.timezone}}
+                )
+        await self.sync_settings_jobs()
+    
+    async def sync_settings_jobs(self):
+        """Re-derive settings-driven crons, and reschedule jobs whose timezone changed"""
+        settings = await settings_service.document()
+        jobs = await db.scheduled_jobs.find().to_list(100)
+        for job_doc in jobs:
+            update = {}
+            cron = settings_job_cron(job_doc["id"], settings) if job_doc.get("follow_settings") else None
+            if cron and cron != job_doc.get("cron"):
+                update["cron"] = cron
+            zone_name = settings_job_timezone(ScheduledJob(**job_doc), settings)
+            if job_doc.get("scheduled_timezone") != zone_name:
+                update["scheduled_timezone"] = zone_name
+            if update:
+                job = ScheduledJob(**{**job_doc, **update})
+                update["next_run_at"] = await compute_next_run(job)
+                await db.scheduled_jobs.update_one({"id": job.id}, {"$set": update})
+    
+    async def acquire_lock(self) -> bool:
+        from pymongo.errors import DuplicateKeyError
+        
+        now = datetime.utcnow()
+        try:
+            await db.scheduler_locks.find_one_and_update(
+                {"_id": "scheduler", "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=SCHEDULER_LOCK_TTL_SECONDS)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Another worker holds an unexpired lock
+            return False
+    
+    async def release_lock(self):
+        await db.scheduler_locks.delete_one({"_id": "scheduler", "owner": self.owner})
+    
+    async def run_job(self, job: ScheduledJob, manual: bool = False) -> dict:
+        handler = SCHEDULED_JOB_HANDLERS.get(job.id)
+        started = datetime.utcnow()
+        
+        if not manual:
+            # Claim this run; another worker that already advanced next_run_at wins
+            claimed = await db.scheduled_jobs.update_one(
+                {"id": job.id, "next_run_at": job.next_run_at},
+                {"$set": {"next_run_at": await compute_next_run(job, started), "last_status": JobStatus.RUNNING.value}}
+            )
+            if claimed.modified_count == 0:
+                return {"job_id": job.id, "status": JobStatus.SKIPPED.value, "message": "claimed by another worker"}
+        
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for job {job.id}")
+            message = await handler()
+            status = JobStatus.SKIPPED if message.startswith("skipped") else JobStatus.SUCCESS
+        except Exception as e:
+            message = str(e)
+            status = JobStatus.FAILED
+            logger.error(f"Scheduled job {job.id} failed: {message}")
+        
+        duration = (datetime.utcnow() - started).total_seconds()
+        await db.scheduled_jobs.update_one(
+            {"id": job.id},
+            {"$set": {
+                "last_run_at": started,
+                "last_status": status.value,
+                "last_message": message,
+                "last_duration_seconds": duration
+            }}
+        )
+        return {"job_id": job.id, "status": status.value, "message": message, "duration_seconds": duration}
+    
+    async def _run_tracked(self, job: ScheduledJob):
+        self._running_jobs.add(job.id)
+        try:
+            await self.run_job(job)
+        finally:
+            self._running_jobs.discard(job.id)
+    
+    async def tick(self):
+        if not await self.acquire_lock():
+            return
+        due_jobs = await db.scheduled_jobs.find({
+            "enabled": True,
+            "next_run_at": {"$lte": datetime.utcnow()}
+        }).to_list(100)
+        for job_doc in due_jobs:
+            job = ScheduledJob(**job_doc)
+            if job.id not in self._running_jobs:
+                task = asyncio.create_task(self._run_tracked(job))
+                self._job_tasks.add(task)
+                task.add_done_callback(self._job_tasks.discard)
+    
+    async def _loop(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {str(e)}")
+            await asyncio.sleep(SCHEDULER_POLL_SECONDS)
+    
+    async def start(self):
+        await self.ensure_jobs()
+        self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.release_lock()
+        except Exception:
+            pass
+
+scheduler = JobScheduler()
+
+@api_router.get("/scheduler/jobs", response_model=List[ScheduledJob])
+async def get_scheduled_jobs():
+    """List scheduled jobs with their last and next runs"""
+    jobs = await db.scheduled_jobs.find().to_list(100)
+    return [ScheduledJob(**job) for job in jobs]
+
+@api_router.put("/scheduler/jobs/{job_id}", response_model=ScheduledJob)
+async def update_scheduled_job(job_id: str, job_update: ScheduledJobUpdate):
+    """Change a job's schedule, timezone, jitter or enabled flag"""
+    job_doc = await db.scheduled_jobs.find_one({"id": job_id})
+    if not job_doc:
+        raise HTTPException(status_code=404, detail="Scheduled job not found")
+    
+    update_data = {k: v for k, v in job_update.dict().items() if v is not None}
+    if "cron" in update_data:
+        try:
+            CronExpression(update_data["cron"])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid cron expression: {str(e)}")
+        # A hand-edited schedule no longer follows settings
+        update_data["follow_settings"] = False
+    if "timezone" in update_data:
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+        
+        try:
+            ZoneInfo(update_data["timezone"])
+        except (ZoneInfoNotFoundError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Unknown timezone: {update_data['timezone']}")
+    
+    job = ScheduledJob(**{**job_doc, **update_data})
+    update_data["scheduled_timezone"] = settings_job_timezone(job, await settings_service.document())
+    update_data["next_run_at"] = await compute_next_run(job)
+    await db.scheduled_jobs.update_one({"id": job_id}, {"$set": update_data})
+    return ScheduledJob(**{**job_doc, **update_data})
+
+@api_router.post("/scheduler/jobs/{job_id}/run")
+async def run_scheduled_job(job_id: str):
+    """Run a scheduled job immediately without changing its schedule"""
+    job_doc = await db.scheduled_jobs.find_one({"id": job_id})
+    if not job_doc:
+        raise HTTPException(status_code=404, detail="Scheduled job not found")
+    return await scheduler.run_job(ScheduledJob(**job_doc), manual=True)
+
+
 # XLS Export/Import Models and APIs
 from openpyxl import Workbook, load_workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
 from io import BytesIO
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
 from fastapi import UploadFile, File
 from typing import Dict, Any
 
@@ -3165,12 +6728,19 @@ class XLSExportRequest(BaseModel):
     date_range_end: Optional[datetime] = None
     include_system_data: bool = True
 
+class TableExportRequest(BaseModel):
+    date_range_start: Optional[datetime] = None
+    date_range_end: Optional[datetime] = None
+
 class XLSImportResult(BaseModel):
     success: bool
     message: str
     imported_counts: Dict[str, int] = {}
     errors: List[str] = []
     warnings: List[str] = []
+    rows_processed: int = 0
+    duration_seconds: float = 0.0
+    rows_per_second: float = 0.0
 
 def convert_datetime_for_excel(obj):
     """Convert datetime objects to Excel-compatible format"""
@@ -3182,448 +6752,1001 @@ def convert_datetime_for_excel(obj):
         return [convert_datetime_for_excel(item) for item in obj]
     return obj
 
+def format_items_summary(items: list) -> str:
+    return "; ".join([f"{item.get('medicine_name', '')} ({item.get('quantity', 0)}x{item.get('unit_price', 0)})" 
+                      for item in items])
+
+def medicine_export_row(medicine: dict) -> list:
+    return [
+        medicine.get("id", ""),
+        medicine.get("name", ""),
+        medicine.get("generic_name", ""),
+        medicine.get("manufacturer", ""),
+        medicine.get("batch_number", ""),
+        medicine.get("expiry_date", ""),
+        medicine.get("purchase_price", 0),
+        medicine.get("selling_price", 0),
+        medicine.get("stock_quantity", 0),
+        medicine.get("minimum_stock_level", 0),
+        medicine.get("description", ""),
+        medicine.get("created_at", ""),
+        medicine.get("updated_at", "")
+    ]
+
+def patient_export_row(patient: dict) -> list:
+    return [
+        patient.get("id", ""),
+        patient.get("name", ""),
+        patient.get("phone", ""),
+        patient.get("email", ""),
+        patient.get("address", ""),
+        patient.get("date_of_birth", ""),
+        patient.get("gender", ""),
+        patient.get("emergency_contact", ""),
+        patient.get("medical_history", ""),
+        patient.get("created_at", ""),
+        patient.get("updated_at", "")
+    ]
+
+def sale_export_row(sale: dict) -> list:
+    return [
+        sale.get("id", ""),
+        sale.get("patient_id", ""),
+        sale.get("patient_name", ""),
+        format_items_summary(sale.get("items", [])),
+        sale.get("subtotal", 0),
+        sale.get("tax_amount", 0),
+        sale.get("discount_amount", 0),
+        sale.get("total_amount", 0),
+        sale.get("payment_method", ""),
+        sale.get("created_at", "")
+    ]
+
+def doctor_export_row(doctor: dict) -> list:
+    return [
+        doctor.get("id", ""),
+        doctor.get("name", ""),
+        doctor.get("specialization", ""),
+        doctor.get("qualification", ""),
+        doctor.get("license_number", ""),
+        doctor.get("phone", ""),
+        doctor.get("email", ""),
+        doctor.get("clinic_name", ""),
+        doctor.get("clinic_address", ""),
+        doctor.get("consultation_fee", 0),
+        doctor.get("is_active", True),
+        doctor.get("created_at", ""),
+        doctor.get("updated_at", "")
+    ]
+
+def prescription_export_row(prescription: dict) -> list:
+    return [
+        prescription.get("id", ""),
+        prescription.get("doctor_id", ""),
+        prescription.get("patient_id", ""),
+        prescription.get("date", ""),
+        prescription.get("consultation_fee", 0),
+        prescription.get("prescription_notes", ""),
+        prescription.get("next_visit_date", ""),
+        prescription.get("created_at", "")
+    ]
+
+def return_export_row(return_item: dict) -> list:
+    return [
+        return_item.get("id", ""),
+        return_item.get("original_sale_id", ""),
+        return_item.get("patient_id", ""),
+        return_item.get("patient_name", ""),
+        format_items_summary(return_item.get("items", [])),
+        return_item.get("subtotal", 0),
+        return_item.get("tax_amount", 0),
+        return_item.get("discount_amount", 0),
+        return_item.get("total_amount", 0),
+        return_item.get("reason", ""),
+        return_item.get("refund_method", ""),
+        return_item.get("created_at", "")
+    ]
+
+def settings_export_row(setting: dict) -> list:
+    return [
+        setting.get("id", ""),
+        str(setting.get("general", {})),
+        str(setting.get("opd_paper", {})),
+        str(setting.get("printer", {})),
+        str(setting.get("telegram", {})),
+        str(setting.get("alerts", {})),
+        str(setting.get("custom_templates", {})),
+        setting.get("created_at", ""),
+        setting.get("updated_at", "")
+    ]
+
+def sale_item_export_rows(sale: dict) -> list:
+    """Explode a sale into one normalized row per line item"""
+    return [
+        [
+            sale.get("id", ""),
+            line_number,
+            sale.get("created_at", ""),
+            sale.get("payment_method", ""),
+            sale.get("patient_id", ""),
+            item.get("medicine_id", ""),
+            item.get("medicine_name", ""),
+            item.get("quantity", 0),
+            item.get("unit_price", 0),
+            item.get("total_price", 0)
+        ]
+        for line_number, item in enumerate(sale.get("items", []), start=1)
+    ]
+
+# Exportable collections in sheet order. "types" drive typed Parquet columns;
+# "source"/"explode" build a derived table from another collection.
+EXPORT_COLLECTIONS = {
+    "medicines": {
+        "sheet": "Medicines",
+        "headers": ["ID", "Name", "Generic Name", "Manufacturer", "Batch Number", 
+                    "Expiry Date", "Purchase Price", "Selling Price", "Stock Quantity", 
+                    "Minimum Stock Level", "Description", "Created At", "Updated At"],
+        "row": medicine_export_row,
+        "types": ["string", "string", "string", "string", "string", "timestamp", "float", "float", "int", "int", "string", "timestamp", "timestamp"],
+        "date_filtered": False
+    },
+    "patients": {
+        "sheet": "Patients",
+        "headers": ["ID", "Name", "Phone", "Email", "Address", "Date of Birth", 
+                    "Gender", "Emergency Contact", "Medical History", "Created At", "Updated At"],
+        "row": patient_export_row,
+        "types": ["string", "string", "string", "string", "string", "timestamp", "string", "string", "string", "timestamp", "timestamp"],
+        "date_filtered": False
+    },
+    "sales": {
+        "sheet": "Sales",
+        "headers": ["ID", "Patient ID", "Patient Name", "Items", "Subtotal", 
+                    "Tax Amount", "Discount Amount", "Total Amount", "Payment Method", "Created At"],
+        "row": sale_export_row,
+        "types": ["string", "string", "string", "string", "float", "float", "float", "float", "string", "timestamp"],
+        "date_filtered": True
+    },
+    "doctors": {
+        "sheet": "Doctors",
+        "headers": ["ID", "Name", "Specialization", "Qualification", "License Number", 
+                    "Phone", "Email", "Clinic Name", "Clinic Address", "Consultation Fee", 
+                    "Is Active", "Created At", "Updated At"],
+        "row": doctor_export_row,
+        "types": ["string", "string", "string", "string", "string", "string", "string", "string", "string", "float", "bool", "timestamp", "timestamp"],
+        "date_filtered": False
+    },
+    "opd_prescriptions": {
+        "sheet": "OPD_Prescriptions",
+        "headers": ["ID", "Doctor ID", "Patient ID", "Date", "Consultation Fee", 
+                    "Prescription Notes", "Next Visit Date", "Created At"],
+        "row": prescription_export_row,
+        "types": ["string", "string", "string", "timestamp", "float", "string", "timestamp", "timestamp"],
+        "date_filtered": True
+    },
+    "returns": {
+        "sheet": "Returns",
+        "headers": ["ID", "Original Sale ID", "Patient ID", "Patient Name", "Items", 
+                    "Subtotal", "Tax Amount", "Discount Amount", "Total Amount", 
+                    "Reason", "Refund Method", "Created At"],
+        "row": return_export_row,
+        "types": ["string", "string", "string", "string", "string", "float", "float", "float", "float", "string", "string", "timestamp"],
+        "date_filtered": False
+    },
+    "settings": {
+        "sheet": "Settings",
+        "headers": ["ID", "General", "OPD Paper", "Printer", "Telegram", "Alerts", 
+                    "Custom Templates", "Created At", "Updated At"],
+        "row": settings_export_row,
+        "types": ["string", "string", "string", "string", "string", "string", "string", "timestamp", "timestamp"],
+        "date_filtered": False
+    },
+    "sale_items": {
+        "sheet": "Sale_Items",
+        "source": "sales",
+        "headers": ["Sale ID", "Line Number", "Created At", "Payment Method", "Patient ID",
+                    "Medicine ID", "Medicine Name", "Quantity", "Unit Price", "Total Price"],
+        "explode": sale_item_export_rows,
+        "types": ["string", "int", "timestamp", "string", "string", "string", "string", "int", "float", "float"],
+        "date_filtered": True
+    }
+}
+
+EXPORT_BATCH_SIZE = 2000
+
+def selected_export_collections(export_request: XLSExportRequest) -> List[str]:
+    return [
+        name for name in EXPORT_COLLECTIONS
+        if name in export_request.collections
+        and (name != "settings" or export_request.include_system_data)
+    ]
+
+def export_query(collection_name: str, export_request: Union[XLSExportRequest, "TableExportRequest"]) -> dict:
+    query = {}
+    if EXPORT_COLLECTIONS[collection_name]["date_filtered"] and (
+        export_request.date_range_start or export_request.date_range_end
+    ):
+        date_filter = {}
+        if export_request.date_range_start:
+            date_filter["$gte"] = export_request.date_range_start
+        if export_request.date_range_end:
+            date_filter["$lte"] = export_request.date_range_end
+        query["created_at"] = date_filter
+    return query
+
+async def iter_export_batches(collection_name: str, export_request: Union[XLSExportRequest, "TableExportRequest"]):
+    """Yield documents from a Motor cursor in fixed-size batches"""
+    source = EXPORT_COLLECTIONS[collection_name].get("source", collection_name)
+    cursor = db[source].find(
+        export_query(collection_name, export_request),
+        {"_id": 0},
+        batch_size=EXPORT_BATCH_SIZE
+    )
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def export_document_rows(spec: dict, document: dict) -> list:
+    if "explode" in spec:
+        return spec["explode"](document)
+    return [spec["row"](document)]
+
+def append_export_rows(sheet, spec: dict, documents: list):
+    for document in documents:
+        for row in export_document_rows(spec, document):
+            sheet.append(row)
+
+def remove_file(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
 @api_router.post("/export/xls")
 async def export_data_to_xls(export_request: XLSExportRequest):
-    """Export selected data collections to XLS format"""
+    """Export selected data collections to XLS format.
+
+    Rows are streamed from Motor cursors into a write-only workbook; sheet serialization
+    runs in a worker thread while the next batch is fetched.
+    """
+    temp_path = None
     try:
-        workbook = Workbook()
-        # Keep the default sheet initially, we'll remove it at the end if we have other sheets
-        default_sheet = workbook.active
-        default_sheet.title = "Export_Info"
+        workbook = Workbook(write_only=True)
+        # Summary sheet stays first; write-only sheets can be filled in any order
+        info_sheet = workbook.create_sheet("Export_Info")
         
         exported_collections = {}
-        sheets_created = 0
-        
-        # Export Medicines
-        if "medicines" in export_request.collections:
-            medicines = await db.medicines.find().to_list(10000)
-            if medicines:
-                sheet = workbook.create_sheet("Medicines")
-                
-                # Headers
-                headers = ["ID", "Name", "Generic Name", "Manufacturer", "Batch Number", 
-                          "Expiry Date", "Purchase Price", "Selling Price", "Stock Quantity", 
-                          "Minimum Stock Level", "Description", "Created At", "Updated At"]
-                sheet.append(headers)
-                
-                # Data
-                for medicine in medicines:
-                    row = [
-                        medicine.get("id", ""),
-                        medicine.get("name", ""),
-                        medicine.get("generic_name", ""),
-                        medicine.get("manufacturer", ""),
-                        medicine.get("batch_number", ""),
-                        medicine.get("expiry_date", ""),
-                        medicine.get("purchase_price", 0),
-                        medicine.get("selling_price", 0),
-                        medicine.get("stock_quantity", 0),
-                        medicine.get("minimum_stock_level", 0),
-                        medicine.get("description", ""),
-                        medicine.get("created_at", ""),
-                        medicine.get("updated_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["medicines"] = len(medicines)
-                sheets_created += 1
-        
-        # Export Patients
-        if "patients" in export_request.collections:
-            patients = await db.patients.find().to_list(10000)
-            if patients:
-                sheet = workbook.create_sheet("Patients")
-                
-                headers = ["ID", "Name", "Phone", "Email", "Address", "Date of Birth", 
-                          "Gender", "Emergency Contact", "Medical History", "Created At", "Updated At"]
-                sheet.append(headers)
-                
-                for patient in patients:
-                    row = [
-                        patient.get("id", ""),
-                        patient.get("name", ""),
-                        patient.get("phone", ""),
-                        patient.get("email", ""),
-                        patient.get("address", ""),
-                        patient.get("date_of_birth", ""),
-                        patient.get("gender", ""),
-                        patient.get("emergency_contact", ""),
-                        patient.get("medical_history", ""),
-                        patient.get("created_at", ""),
-                        patient.get("updated_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["patients"] = len(patients)
-                sheets_created += 1
         
-        # Export Sales
-        if "sales" in export_request.collections:
-            query = {}
-            if export_request.date_range_start or export_request.date_range_end:
-                date_filter = {}
-                if export_request.date_range_start:
-                    date_filter["$gte"] = export_request.date_range_start
-                if export_request.date_range_end:
-                    date_filter["$lte"] = export_request.date_range_end
-                query["created_at"] = date_filter
+        for collection_name in selected_export_collections(export_request):
+            spec = EXPORT_COLLECTIONS[collection_name]
+            sheet = None
+            pending_write = None
+            count = 0
             
-            sales = await db.sales.find(query).to_list(10000)
-            if sales:
-                sheet = workbook.create_sheet("Sales")
-                
-                headers = ["ID", "Patient ID", "Patient Name", "Items", "Subtotal", 
-                          "Tax Amount", "Discount Amount", "Total Amount", "Payment Method", "Created At"]
-                sheet.append(headers)
-                
-                for sale in sales:
-                    items_str = "; ".join([f"{item.get('medicine_name', '')} ({item.get('quantity', 0)}x{item.get('unit_price', 0)})" 
-                                         for item in sale.get("items", [])])
-                    row = [
-                        sale.get("id", ""),
-                        sale.get("patient_id", ""),
-                        sale.get("patient_name", ""),
-                        items_str,
-                        sale.get("subtotal", 0),
-                        sale.get("tax_amount", 0),
-                        sale.get("discount_amount", 0),
-                        sale.get("total_amount", 0),
-                        sale.get("payment_method", ""),
-                        sale.get("created_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["sales"] = len(sales)
-                sheets_created += 1
-        
-        # Export Doctors
-        if "doctors" in export_request.collections:
-            doctors = await db.doctors.find().to_list(1000)
-            if doctors:
-                sheet = workbook.create_sheet("Doctors")
-                
-                headers = ["ID", "Name", "Specialization", "Qualification", "License Number", 
-                          "Phone", "Email", "Clinic Name", "Clinic Address", "Consultation Fee", 
-                          "Is Active", "Created At", "Updated At"]
-                sheet.append(headers)
-                
-                for doctor in doctors:
-                    row = [
-                        doctor.get("id", ""),
-                        doctor.get("name", ""),
-                        doctor.get("specialization", ""),
-                        doctor.get("qualification", ""),
-                        doctor.get("license_number", ""),
-                        doctor.get("phone", ""),
-                        doctor.get("email", ""),
-                        doctor.get("clinic_name", ""),
-                        doctor.get("clinic_address", ""),
-                        doctor.get("consultation_fee", 0),
-                        doctor.get("is_active", True),
-                        doctor.get("created_at", ""),
-                        doctor.get("updated_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["doctors"] = len(doctors)
-                sheets_created += 1
-        
-        # Export OPD Prescriptions
-        if "opd_prescriptions" in export_request.collections:
-            query = {}
-            if export_request.date_range_start or export_request.date_range_end:
-                date_filter = {}
-                if export_request.date_range_start:
-                    date_filter["$gte"] = export_request.date_range_start
-                if export_request.date_range_end:
-                    date_filter["$lte"] = export_request.date_range_end
-                query["created_at"] = date_filter
+            async for batch in iter_export_batches(collection_name, export_request):
+                if sheet is None:
+                    sheet = workbook.create_sheet(spec["sheet"])
+                    sheet.append(spec["headers"])
+                if pending_write is not None:
+                    await pending_write
+                pending_write = asyncio.ensure_future(
+                    asyncio.to_thread(append_export_rows, sheet, spec, batch)
+                )
+                count += len(batch)
             
-            prescriptions = await db.opd_prescriptions.find(query).to_list(10000)
-            if prescriptions:
-                sheet = workbook.create_sheet("OPD_Prescriptions")
-                
-                headers = ["ID", "Doctor ID", "Patient ID", "Date", "Consultation Fee", 
-                          "Prescription Notes", "Next Visit Date", "Created At"]
-                sheet.append(headers)
-                
-                for prescription in prescriptions:
-                    row = [
-                        prescription.get("id", ""),
-                        prescription.get("doctor_id", ""),
-                        prescription.get("patient_id", ""),
-                        prescription.get("date", ""),
-                        prescription.get("consultation_fee", 0),
-                        prescription.get("prescription_notes", ""),
-                        prescription.get("next_visit_date", ""),
-                        prescription.get("created_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["opd_prescriptions"] = len(prescriptions)
-                sheets_created += 1
-        
-        # Export Returns
-        if "returns" in export_request.collections:
-            returns = await db.returns.find().to_list(10000)
-            if returns:
-                sheet = workbook.create_sheet("Returns")
-                
-                headers = ["ID", "Original Sale ID", "Patient ID", "Patient Name", "Items", 
-                          "Subtotal", "Tax Amount", "Discount Amount", "Total Amount", 
-                          "Reason", "Refund Method", "Created At"]
-                sheet.append(headers)
-                
-                for return_item in returns:
-                    items_str = "; ".join([f"{item.get('medicine_name', '')} ({item.get('quantity', 0)}x{item.get('unit_price', 0)})" 
-                                         for item in return_item.get("items", [])])
-                    row = [
-                        return_item.get("id", ""),
-                        return_item.get("original_sale_id", ""),
-                        return_item.get("patient_id", ""),
-                        return_item.get("patient_name", ""),
-                        items_str,
-                        return_item.get("subtotal", 0),
-                        return_item.get("tax_amount", 0),
-                        return_item.get("discount_amount", 0),
-                        return_item.get("total_amount", 0),
-                        return_item.get("reason", ""),
-                        return_item.get("refund_method", ""),
-                        return_item.get("created_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["returns"] = len(returns)
-                sheets_created += 1
-        
-        # Export Settings
-        if "settings" in export_request.collections and export_request.include_system_data:
-            settings = await db.settings.find().to_list(100)
-            if settings:
-                sheet = workbook.create_sheet("Settings")
-                
-                headers = ["ID", "General", "OPD Paper", "Printer", "Telegram", "Alerts", 
-                          "Custom Templates", "Created At", "Updated At"]
-                sheet.append(headers)
-                
-                for setting in settings:
-                    row = [
-                        setting.get("id", ""),
-                        str(setting.get("general", {})),
-                        str(setting.get("opd_paper", {})),
-                        str(setting.get("printer", {})),
-                        str(setting.get("telegram", {})),
-                        str(setting.get("alerts", {})),
-                        str(setting.get("custom_templates", {})),
-                        setting.get("created_at", ""),
-                        setting.get("updated_at", "")
-                    ]
-                    sheet.append(row)
-                
-                exported_collections["settings"] = len(settings)
-                sheets_created += 1
-        
-        # Add export information to the default sheet
-        if sheets_created > 0:
-            # Add export summary to the info sheet
-            default_sheet.append(["MediPOS Data Export Summary"])
-            default_sheet.append(["Export Date:", datetime.utcnow().isoformat()])
-            default_sheet.append([""])
-            default_sheet.append(["Exported Collections:"])
+            if pending_write is not None:
+                await pending_write
+            if count:
+                exported_collections[collection_name] = count
+        
+        # Add export information to the summary sheet
+        if exported_collections:
+            info_sheet.append(["MediPOS Data Export Summary"])
+            info_sheet.append(["Export Date:", datetime.utcnow().isoformat()])
+            info_sheet.append([""])
+            info_sheet.append(["Exported Collections:"])
             for collection, count in exported_collections.items():
-                default_sheet.append([collection.replace('_', ' ').title(), count])
+                info_sheet.append([collection.replace('_', ' ').title(), count])
         else:
             # If no data sheets were created, add a message
-            default_sheet.append(["No data found for the selected collections"])
-            default_sheet.append(["Export Date:", datetime.utcnow().isoformat()])
+            info_sheet.append(["No data found for the selected collections"])
+            info_sheet.append(["Export Date:", datetime.utcnow().isoformat()])
         
-        # Save to BytesIO
-        output = BytesIO()
-        workbook.save(output)
-        output.seek(0)
+        # Save to a temporary file and stream it back in chunks
+        with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as temp_file:
+            temp_path = temp_file.name
+        await asyncio.to_thread(workbook.save, temp_path)
         
         # Generate filename
         timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
         filename = f"medipos_export_{timestamp}.xlsx"
         
-        return StreamingResponse(
-            BytesIO(output.read()),
+        return FileResponse(
+            temp_path,
             media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
+            filename=filename,
+            background=BackgroundTask(remove_file, temp_path)
         )
         
     except Exception as e:
+        if temp_path:
+            remove_file(temp_path)
         raise HTTPException(status_code=500, detail=f"Export failed: {str(e)}")
 
+def parse_import_bool(value, default: bool = True) -> bool:
+    """Spreadsheets give real booleans; CSV gives strings such as "False" """
+    if value is None or value == "":
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ("false", "0", "no", "n")
+    return bool(value)
+
+def parse_medicine_import_row(row: tuple) -> Optional[dict]:
+    if not row[0] or not row[1]:  # Skip if no ID or Name
+        return None
+    return {
+        "id": row[0],
+        "name": row[1],
+        "generic_name": row[2] or None,
+        "manufacturer": row[3] or None,
+        "batch_number": row[4] or None,
+        "expiry_date": row[5] or None,
+        "purchase_price": float(row[6]) if row[6] else 0,
+        "selling_price": float(row[7]) if row[7] else 0,
+        "stock_quantity": int(row[8]) if row[8] else 0,
+        "minimum_stock_level": int(row[9]) if row[9] else 10,
+        "description": row[10] or None
+    }
+
+def parse_patient_import_row(row: tuple) -> Optional[dict]:
+    if not row[0] or not row[1]:  # Skip if no ID or Name
+        return None
+    return {
+        "id": row[0],
+        "name": row[1],
+        "phone": row[2] or None,
+        "email": row[3] or None,
+        "address": row[4] or None,
+        "date_of_birth": row[5] or None,
+        "gender": row[6] or None,
+        "emergency_contact": row[7] or None,
+        "medical_history": row[8] or None
+    }
+
+def parse_doctor_import_row(row: tuple) -> Optional[dict]:
+    if not row[0] or not row[1]:  # Skip if no ID or Name
+        return None
+    return {
+        "id": row[0],
+        "name": row[1],
+        "specialization": row[2] or "",
+        "qualification": row[3] or "",
+        "license_number": row[4] or "",
+        "phone": row[5] or None,
+        "email": row[6] or None,
+        "clinic_name": row[7] or None,
+        "clinic_address": row[8] or None,
+        "consultation_fee": float(row[9]) if row[9] else None,
+        "is_active": parse_import_bool(row[10], default=True)
+    }
+
+# Importable collections; sales, returns and OPD prescriptions are historical
+# transactions and are not imported
+IMPORT_COLLECTIONS = {
+    "medicines": {"sheet": "Medicines", "label": "Medicine", "parse": parse_medicine_import_row},
+    "patients": {"sheet": "Patients", "label": "Patient", "parse": parse_patient_import_row},
+    "doctors": {"sheet": "Doctors", "label": "Doctor", "parse": parse_doctor_import_row}
+}
+
+IMPORT_BATCH_SIZE = 1000
+
+def parse_import_chunk(rows, parse_row, label: str):
+    """Validate up to IMPORT_BATCH_SIZE rows; returns parsed rows, row errors and rows consumed"""
+    import itertools
+    
+    parsed = []
+    errors = []
+    consumed = 0
+    for row_number, row in itertools.islice(rows, IMPORT_BATCH_SIZE):
+        consumed += 1
+        try:
+            document = parse_row(tuple(row) + (None,) * 16)
+            if document:
+                parsed.append((row_number, document))
+        except Exception as e:
+            errors.append(f"{label} row {row_number}: {str(e)}")
+    return parsed, errors, consumed
+
+async def bulk_upsert_rows(collection_name: str, label: str, parsed_rows: list, warnings: List[str], errors: List[str]) -> int:
+    """Upsert a chunk of parsed rows by id with one bulk_write; returns rows written.
+
+    Medicine chunks also read the stock they replace and write the difference to the ledger.
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+    
+    if not parsed_rows:
+        return 0
+    
+    now = datetime.utcnow()
+    if collection_name == "medicines":
+        previous_stock = {
+            medicine["id"]: medicine.get("stock_quantity", 0)
+            for medicine in await db.medicines.find(
+                {"id": {"$in": [document["id"] for _, document in parsed_rows]}},
+                {"_id": 0, "id": 1, "stock_quantity": 1}
+            ).to_list(None)
+        }
+    operations = [
+        UpdateOne(
+            {"id": document["id"]},
+            # Imported rows are not trusted for hydration until re-validated
+            {"$set": {**document, "updated_at": now}, "$setOnInsert": {"created_at": now}, "$unset": {"schema_version": ""}},
+            upsert=True
+        )
+        for _, document in parsed_rows
+    ]
+    
+    failed_indexes = set()
+    try:
+        result = await db[collection_name].bulk_write(operations, ordered=False)
+        upserted_indexes = set(result.upserted_ids.keys())
+    except BulkWriteError as e:
+        details = e.details
+        for write_error in details.get("writeErrors", []):
+            index = write_error["index"]
+            failed_indexes.add(index)
+            errors.append(f"{label} row {parsed_rows[index][0]}: {write_error.get('errmsg', 'write failed')}")
+        upserted_indexes = {upsert["index"] for upsert in details.get("upserted", [])}
+    
+    for index, (_, document) in enumerate(parsed_rows):
+        if index not in failed_indexes and index not in upserted_indexes:
+            warnings.append(f"Updated existing {label.lower()}: {document['name']}")
+    
+    if collection_name == "medicines":
+        # Record the stock the import set as ledger adjustments so point-in-time stock stays right
+        adjustments = []
+        for index, (_, document) in enumerate(parsed_rows):
+            change = document["stock_quantity"] - previous_stock.get(document["id"], 0)
+            if index in failed_indexes or change == 0:
+                continue
+            adjustments.append(to_document(StockMovement(
+                medicine_id=document["id"],
+                medicine_name=document["name"],
+                transaction_type=TransactionType.ADJUSTMENT,
+                quantity=change,
+                unit_price=document["purchase_price"],
+                total_value=change * document["purchase_price"],
+                notes="Stock set by import"
+            )))
+        if adjustments:
+            await db.stock_movements.insert_many(adjustments)
+    
+    return len(parsed_rows) - len(failed_indexes)
+
+async def import_rows(collection_name: str, rows, warnings: List[str], errors: List[str]) -> tuple:
+    """Validate rows in chunks in a worker thread and bulk upsert each chunk.
+
+    rows yields (row_number, row_values) in spreadsheet column order.
+    Returns (rows imported, rows processed).
+    """
+    spec = IMPORT_COLLECTIONS[collection_name]
+    imported = 0
+    processed = 0
+    while True:
+        parsed_rows, row_errors, consumed = await asyncio.to_thread(
+            parse_import_chunk, rows, spec["parse"], spec["label"]
+        )
+        if consumed == 0:
+            break
+        processed += consumed
+        errors.extend(row_errors)
+        imported += await bulk_upsert_rows(collection_name, spec["label"], parsed_rows, warnings, errors)
+    return imported, processed
+
+def build_import_result(imported_counts: Dict[str, int], errors: List[str], warnings: List[str],
+                        rows_processed: int, started: float) -> XLSImportResult:
+    import time
+    
+    duration = time.perf_counter() - started
+    return XLSImportResult(
+        success=len(errors) == 0,
+        message=f"Import completed. Imported: {sum(imported_counts.values())} records",
+        imported_counts=imported_counts,
+        errors=errors,
+        warnings=warnings,
+        rows_processed=rows_processed,
+        duration_seconds=round(duration, 3),
+        rows_per_second=round(rows_processed / duration, 1) if duration > 0 else 0.0
+    )
+
 @api_router.post("/import/xls", response_model=XLSImportResult)
 async def import_data_from_xls(file: UploadFile = File(...)):
-    """Import data from XLS file with merge capability"""
+    """Import data from XLS file with merge capability.
+
+    Sheets are read in read-only mode, validated in chunks and upserted with bulk_write;
+    bad rows are reported individually without aborting the import.
+    """
+    import time
+    
     try:
         if not file.filename.endswith(('.xlsx', '.xls')):
             raise HTTPException(status_code=400, detail="File must be an Excel file (.xlsx or .xls)")
         
+        started = time.perf_counter()
+        
         # Read file content
         content = await file.read()
         try:
-            workbook = load_workbook(BytesIO(content))
+            workbook = await asyncio.to_thread(load_workbook, BytesIO(content), read_only=True)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid Excel file format: {str(e)}")
         
         imported_counts = {}
         errors = []
         warnings = []
+        rows_processed = 0
         
-        # Import Medicines
-        if "Medicines" in workbook.sheetnames:
-            sheet = workbook["Medicines"]
-            medicines_imported = 0
-            
-            # Skip header row
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                try:
-                    if not row[0] or not row[1]:  # Skip if no ID or Name
-                        continue
-                    
-                    # Check if medicine exists
-                    existing = await db.medicines.find_one({"id": row[0]})
-                    
-                    medicine_data = {
-                        "id": row[0],
-                        "name": row[1],
-                        "generic_name": row[2] or None,
-                        "manufacturer": row[3] or None,
-                        "batch_number": row[4] or None,
-                        "expiry_date": row[5] or None,
-                        "purchase_price": float(row[6]) if row[6] else 0,
-                        "selling_price": float(row[7]) if row[7] else 0,
-                        "stock_quantity": int(row[8]) if row[8] else 0,
-                        "minimum_stock_level": int(row[9]) if row[9] else 10,
-                        "description": row[10] or None,
-                        "updated_at": datetime.utcnow()
-                    }
-                    
-                    if existing:
-                        # Update existing (merge)
-                        await db.medicines.update_one(
-                            {"id": row[0]}, 
-                            {"$set": medicine_data}
-                        )
-                        warnings.append(f"Updated existing medicine: {row[1]}")
-                    else:
-                        # Create new
-                        medicine_data["created_at"] = datetime.utcnow()
-                        await db.medicines.insert_one(medicine_data)
-                    
-                    medicines_imported += 1
-                    
-                except Exception as e:
-                    errors.append(f"Medicine row error: {str(e)}")
-            
-            imported_counts["medicines"] = medicines_imported
-        
-        # Import Patients
-        if "Patients" in workbook.sheetnames:
-            sheet = workbook["Patients"]
-            patients_imported = 0
-            
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                try:
-                    if not row[0] or not row[1]:  # Skip if no ID or Name
-                        continue
-                    
-                    existing = await db.patients.find_one({"id": row[0]})
-                    
-                    patient_data = {
-                        "id": row[0],
-                        "name": row[1],
-                        "phone": row[2] or None,
-                        "email": row[3] or None,
-                        "address": row[4] or None,
-                        "date_of_birth": row[5] or None,
-                        "gender": row[6] or None,
-                        "emergency_contact": row[7] or None,
-                        "medical_history": row[8] or None,
-                        "updated_at": datetime.utcnow()
-                    }
-                    
-                    if existing:
-                        await db.patients.update_one(
-                            {"id": row[0]}, 
-                            {"$set": patient_data}
-                        )
-                        warnings.append(f"Updated existing patient: {row[1]}")
-                    else:
-                        patient_data["created_at"] = datetime.utcnow()
-                        await db.patients.insert_one(patient_data)
-                    
-                    patients_imported += 1
-                    
-                except Exception as e:
-                    errors.append(f"Patient row error: {str(e)}")
-            
-            imported_counts["patients"] = patients_imported
-        
-        # Import Doctors
-        if "Doctors" in workbook.sheetnames:
-            sheet = workbook["Doctors"]
-            doctors_imported = 0
-            
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                try:
-                    if not row[0] or not row[1]:  # Skip if no ID or Name
-                        continue
-                    
-                    existing = await db.doctors.find_one({"id": row[0]})
-                    
-                    doctor_data = {
-                        "id": row[0],
-                        "name": row[1],
-                        "specialization": row[2] or "",
-                        "qualification": row[3] or "",
-                        "license_number": row[4] or "",
-                        "phone": row[5] or None,
-                        "email": row[6] or None,
-                        "clinic_name": row[7] or None,
-                        "clinic_address": row[8] or None,
-                        "consultation_fee": float(row[9]) if row[9] else None,
-                        "is_active": bool(row[10]) if row[10] is not None else True,
-                        "updated_at": datetime.utcnow()
-                    }
-                    
-                    if existing:
-                        await db.doctors.update_one(
-                            {"id": row[0]}, 
-                            {"$set": doctor_data}
-                        )
-                        warnings.append(f"Updated existing doctor: {row[1]}")
-                    else:
-                        doctor_data["created_at"] = datetime.utcnow()
-                        await db.doctors.insert_one(doctor_data)
-                    
-                    doctors_imported += 1
-                    
-                except Exception as e:
-                    errors.append(f"Doctor row error: {str(e)}")
-            
-            imported_counts["doctors"] = doctors_imported
+        try:
+            for collection_name, spec in IMPORT_COLLECTIONS.items():
+                if spec["sheet"] not in workbook.sheetnames:
+                    continue
+                # Skip header row
+                rows = enumerate(workbook[spec["sheet"]].iter_rows(min_row=2, values_only=True), start=2)
+                imported, processed = await import_rows(collection_name, rows, warnings, errors)
+                imported_counts[collection_name] = imported
+                rows_processed += processed
+        finally:
+            workbook.close()
         
-        # Note: Sales, Returns, and OPD Prescriptions are typically not imported
-        # as they represent historical transactions, but we can add them if needed
+        return build_import_result(imported_counts, errors, warnings, rows_processed, started)
         
-        result = XLSImportResult(
-            success=len(errors) == 0,
-            message=f"Import completed. Imported: {sum(imported_counts.values())} records",
-            imported_counts=imported_counts,
-            errors=errors,
-            warnings=warnings
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
+
+# CSV and Parquet Export/Import APIs
+PARQUET_COMPRESSION = "zstd"
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Parquet support requires the pyarrow package")
+    return pyarrow, pyarrow.parquet
+
+def column_name(header: str) -> str:
+    return header.strip().lower().replace(" ", "_")
+
+def coerce_export_value(value, value_type: str):
+    """Convert a stored value to the Parquet column type (None when it does not fit)"""
+    from datetime import timezone
+    
+    if value is None or value == "":
+        return None
+    try:
+        if value_type == "timestamp":
+            if not isinstance(value, datetime):
+                value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            return value
+        if value_type == "float":
+            return float(value)
+        if value_type == "int":
+            return int(value)
+        if value_type == "bool":
+            return parse_import_bool(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+def parquet_schema(spec: dict):
+    pa, _ = require_pyarrow()
+    arrow_types = {
+        "string": pa.string(),
+        "float": pa.float64(),
+        "int": pa.int64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("ms")
+    }
+    return pa.schema([
+        (column_name(header), arrow_types[value_type])
+        for header, value_type in zip(spec["headers"], spec["types"])
+    ])
+
+def documents_to_record_batch(spec: dict, schema, documents: list):
+    """Build one Parquet row group worth of typed columns from a cursor batch"""
+    pa, _ = require_pyarrow()
+    rows = [row for document in documents for row in export_document_rows(spec, document)]
+    columns = [
+        pa.array([coerce_export_value(row[index], value_type) for row in rows], type=schema.field(index).type)
+        for index, value_type in enumerate(spec["types"])
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def get_export_spec(collection: str) -> dict:
+    if collection not in EXPORT_COLLECTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown collection '{collection}'. Available: {', '.join(EXPORT_COLLECTIONS)}"
         )
+    return EXPORT_COLLECTIONS[collection]
+
+@api_router.post("/export/csv/{collection}")
+async def export_data_to_csv(collection: str, export_request: Optional[TableExportRequest] = None):
+    """Stream one collection (or the exploded sale_items table) as CSV"""
+    import csv
+    import io
+    
+    spec = get_export_spec(collection)
+    export_request = export_request or TableExportRequest()
+    
+    async def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(spec["headers"])
+        async for batch in iter_export_batches(collection, export_request):
+            for document in batch:
+                for row in export_document_rows(spec, document):
+                    writer.writerow(convert_datetime_for_excel(row))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    filename = f"medipos_{collection}_{timestamp}.csv"
+    return StreamingResponse(
+        generate_csv(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@api_router.post("/export/parquet/{collection}")
+async def export_data_to_parquet(collection: str, export_request: Optional[TableExportRequest] = None):
+    """Export one collection (or the exploded sale_items table) as a typed, compressed Parquet file.
+
+    Each cursor batch becomes one row group.
+    """
+    spec = get_export_spec(collection)
+    _, pq = require_pyarrow()
+    export_request = export_request or TableExportRequest()
+    schema = parquet_schema(spec)
+    
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".parquet", delete=False) as temp_file:
+            temp_path = temp_file.name
         
-        return result
+        writer = pq.ParquetWriter(temp_path, schema, compression=PARQUET_COMPRESSION)
+        try:
+            async for batch in iter_export_batches(collection, export_request):
+                record_batch = await asyncio.to_thread(documents_to_record_batch, spec, schema, batch)
+                await asyncio.to_thread(writer.write_batch, record_batch)
+        finally:
+            await asyncio.to_thread(writer.close)
         
+        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        return FileResponse(
+            temp_path,
+            media_type="application/vnd.apache.parquet",
+            filename=f"medipos_{collection}_{timestamp}.parquet",
+            background=BackgroundTask(remove_file, temp_path)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        if temp_path:
+            remove_file(temp_path)
+        raise HTTPException(status_code=500, detail=f"Export failed: {str(e)}")
+
+def get_import_spec(collection: str) -> dict:
+    if collection not in IMPORT_COLLECTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Collection '{collection}' cannot be imported. Available: {', '.join(IMPORT_COLLECTIONS)}"
+        )
+    return EXPORT_COLLECTIONS[collection]
+
+def order_columns(spec: dict, column_names: list) -> list:
+    """Map export column positions to positions in the uploaded file (None when absent)"""
+    positions = {column_name(name): index for index, name in enumerate(column_names)}
+    return [positions.get(column_name(header)) for header in spec["headers"]]
+
+@api_router.post("/import/csv/{collection}", response_model=XLSImportResult)
+async def import_data_from_csv(collection: str, file: UploadFile = File(...)):
+    """Import medicines, patients or doctors from CSV using the bulk upsert pipeline"""
+    import csv
+    import io
+    import time
+    
+    spec = get_import_spec(collection)
+    started = time.perf_counter()
+    
+    try:
+        content = (await file.read()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV file must be UTF-8 encoded")
+    
+    reader = csv.reader(io.StringIO(content))
+    header = next(reader, None)
+    if not header:
+        raise HTTPException(status_code=400, detail="CSV file is empty")
+    positions = order_columns(spec, header)
+    
+    def rows():
+        for row_number, values in enumerate(reader, start=2):
+            yield row_number, tuple(
+                values[position] if position is not None and position < len(values) else None
+                for position in positions
+            )
+    
+    errors = []
+    warnings = []
+    try:
+        imported, processed = await import_rows(collection, rows(), warnings, errors)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
+    return build_import_result({collection: imported}, errors, warnings, processed, started)
+
+@api_router.post("/import/parquet/{collection}", response_model=XLSImportResult)
+async def import_data_from_parquet(collection: str, file: UploadFile = File(...)):
+    """Import medicines, patients or doctors from Parquet, reading one record batch at a time"""
+    import time
+    
+    spec = get_import_spec(collection)
+    _, pq = require_pyarrow()
+    started = time.perf_counter()
+    
+    content = await file.read()
+    try:
+        parquet_file = pq.ParquetFile(BytesIO(content))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid Parquet file: {str(e)}")
+    positions = order_columns(spec, parquet_file.schema_arrow.names)
+    
+    def rows():
+        row_number = 0
+        for record_batch in parquet_file.iter_batches(batch_size=IMPORT_BATCH_SIZE):
+            for values in zip(*[column.to_pylist() for column in record_batch.columns]):
+                row_number += 1
+                # Timestamps round-trip as ISO strings, matching the XLS import
+                yield row_number, tuple(
+                    convert_datetime_for_excel(values[position]) if position is not None else None
+                    for position in positions
+                )
+    
+    errors = []
+    warnings = []
+    try:
+        imported, processed = await import_rows(collection, rows(), warnings, errors)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
+    return build_import_result({collection: imported}, errors, warnings, processed, started)
 
 # Startup event to create default admin user
+async def ensure_indexes():
+    """Create indexes the application relies on"""
+    # Every API and import addresses documents by id; batch sale ingestion also relies on
+    # sales.id being unique. Created one by one so duplicate ids in one collection only skip its index
+    for collection_name in ("sales", "medicines", "patients", "doctors", "opd_prescriptions"):
+        try:
+            await db[collection_name].create_index("id", unique=True)
+        except Exception as e:
+            logger.error(f"❌ Failed to create unique id index on {collection_name}: {str(e)}")
+    try:
+        await db.returns.create_index("original_sale_id")
+        # Point-in-time stock replays a time window of the ledger from a checkpoint
+        await db.stock_movements.create_index("recorded_at")
+        await db.stock_movements.create_index("created_at")
+        await db.stock_checkpoints.create_index("as_of")
+        # Daily rollups are upserted per day and re-read per medicine
+        await db.medicine_daily_sales.create_index([("day", 1), ("medicine_id", 1)], unique=True)
+        await db.medicine_daily_sales.create_index([("medicine_id", 1), ("day", 1)])
+        await db.medicine_demand_stats.create_index("medicine_id", unique=True)
+        # Day rollups, analytics date ranges and the sales cube read sales by time
+        await db.sales.create_index("created_at")
+        await db.store_daily_rollups.create_index("day", unique=True)
+        # Store rollups read each day's refunds alongside its sales
+        await db.returns.create_index("created_at")
+        await db.revenue_anomalies.create_index([("day", 1), ("kind", 1), ("key", 1)], unique=True)
+    except Exception as e:
+        logger.error(f"❌ Failed to create indexes: {str(e)}")
+
+# Data Migrations
+MIGRATION_BATCH_SIZE = 500
+
+def allocate_returned_quantities(items: list, returned_by_medicine: dict) -> dict:
+    """Spread returned quantities over a sale's lines for each medicine: line index -> quantity"""
+    allocated = {}
+    remaining = dict(returned_by_medicine)
+    for line_index, item in enumerate(items):
+        quantity = min(remaining.get(item["medicine_id"], 0), item["quantity"])
+        if quantity > 0:
+            allocated[line_index] = quantity
+            remaining[item["medicine_id"]] -= quantity
+    return allocated
+
+async def migrate_sale_returned_quantities() -> str:
+    """Backfill items.returned_quantity from recorded returns and re-stamp sales at schema version 2"""
+    from pymongo import UpdateOne
+    
+    await db.sales.update_many(
+        {"items": {"$elemMatch": {"returned_quantity": {"$exists": False}}}},
+        {"$set": {"items.$[line].returned_quantity": 0}},
+        array_filters=[{"line.returned_quantity": {"$exists": False}}]
+    )
+    
+    returned_per_sale = db.returns.aggregate([
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {"sale": "$original_sale_id", "medicine": "$items.medicine_id"},
+            "quantity": {"$sum": "$items.quantity"}
+        }},
+        {"$group": {
+            "_id": "$_id.sale",
+            "medicines": {"$push": {"k": "$_id.medicine", "v": "$quantity"}}
+        }}
+    ])
+    
+    updated = 0
+    
+    async def apply(chunk: dict):
+        sales = await db.sales.find({"id": {"$in": list(chunk)}}, {"_id": 0, "id": 1, "items": 1}).to_list(None)
+        operations = []
+        for sale in sales:
+            allocated = allocate_returned_quantities(sale["items"], chunk[sale["id"]])
+            if allocated:
+                operations.append(UpdateOne(
+                    {"id": sale["id"]},
+                    {"$set": {f"items.{line_index}.returned_quantity": quantity for line_index, quantity in allocated.items()}}
+                ))
+        if operations:
+            await db.sales.bulk_write(operations, ordered=False)
+        return len(operations)
+    
+    chunk = {}
+    async for returned in returned_per_sale:
+        chunk[returned["_id"]] = {entry["k"]: entry["v"] for entry in returned["medicines"]}
+        if len(chunk) >= MIGRATION_BATCH_SIZE:
+            updated += await apply(chunk)
+            chunk = {}
+    if chunk:
+        updated += await apply(chunk)
+    
+    await db.sales.update_many({"schema_version": 1}, {"$set": {"schema_version": 2}})
+    return f"returned quantities set on {updated} sales"
+
+async def migrate_sale_line_costs() -> str:
+    """Backfill items.unit_cost, manufacturer and generic_name and re-stamp sales at schema version 3.
+
+    Sales made before costs were snapshotted only have the medicine's current
+    purchase price to go by, which is what profit analytics used for them before.
+    Lines of since deleted medicines get a cost of 0.
+    """
+    from pymongo import UpdateOne
+    
+    medicines = {
+        medicine["id"]: medicine
+        for medicine in await db.medicines.find({}, {"_id": 0, "id": 1, **SALE_COST_FIELDS}).to_list(None)
+    }
+    
+    updated = 0
+    
+    async def apply(sales: list):
+        operations = []
+        for sale in sales:
+            fields = {}
+            for line_index, item in enumerate(sale["items"]):
+                if "unit_cost" in item:
+                    continue
+                medicine = medicines.get(item["medicine_id"], {})
+                fields[f"items.{line_index}.unit_cost"] = medicine.get("purchase_price", 0)
+                fields[f"items.{line_index}.manufacturer"] = medicine.get("manufacturer")
+                fields[f"items.{line_index}.generic_name"] = medicine.get("generic_name")
+            if fields:
+                operations.append(UpdateOne({"id": sale["id"]}, {"$set": fields}))
+        if operations:
+            await db.sales.bulk_write(operations, ordered=False)
+        return len(operations)
+    
+    chunk = []
+    async for sale in db.sales.find(
+        {"items": {"$elemMatch": {"unit_cost": {"$exists": False}}}},
+        {"_id": 0, "id": 1, "items.medicine_id": 1, "items.unit_cost": 1}
+    ):
+        chunk.append(sale)
+        if len(chunk) >= MIGRATION_BATCH_SIZE:
+            updated += await apply(chunk)
+            chunk = []
+    if chunk:
+        updated += await apply(chunk)
+    
+    await db.sales.update_many({"schema_version": 2}, {"$set": {"schema_version": Sale.schema_version}})
+    return f"line costs set on {updated} sales"
+
+async def migrate_stock_movement_recorded_at() -> str:
+    """Backfill recorded_at from created_at and re-stamp stock movements at schema version 2"""
+    result = await db.stock_movements.update_many(
+        {"recorded_at": {"$exists": False}},
+        [{"$set": {"recorded_at": "$created_at"}}]
+    )
+    await db.stock_movements.update_many({"schema_version": 1}, {"$set": {"schema_version": StockMovement.schema_version}})
+    return f"recorded_at set on {result.modified_count} stock movements"
+
+# Restores used to insert datetimes from JSON backups as text, which time-range queries never match
+STORED_DATETIME_FIELDS = [
+    ("sales", "created_at"),
+    ("returns", "created_at"),
+    ("stock_movements", "created_at"),
+    ("stock_movements", "recorded_at")
+]
+
+async def migrate_text_datetimes() -> str:
+    """Convert datetimes stored as text back to dates on the fields queried by time"""
+    from pymongo import UpdateOne
+    
+    converted = 0
+    for collection_name, field in STORED_DATETIME_FIELDS:
+        collection = db[collection_name]
+        operations = []
+        async for document in collection.find({field: {"$type": "string"}}, {"_id": 1, field: 1}):
+            parsed = parse_stored_datetime(document[field])
+            if parsed is not None:
+                operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {field: parsed}}))
+            if len(operations) >= MIGRATION_BATCH_SIZE:
+                converted += (await collection.bulk_write(operations, ordered=False)).modified_count
+                operations = []
+        if operations:
+            converted += (await collection.bulk_write(operations, ordered=False)).modified_count
+    return f"converted {converted} text datetimes"
+
+# Applied once per database, in order; append new migrations with a new id
+DATA_MIGRATIONS = [
+    ("0001_sale_returned_quantity", migrate_sale_returned_quantities),
+    ("0002_sale_line_cost", migrate_sale_line_costs),
+    ("0003_stock_movement_recorded_at", migrate_stock_movement_recorded_at),
+    ("0004_text_datetimes", migrate_text_datetimes),
+]
+
+async def run_data_migrations(rerun: bool = False):
+    """Apply pending data migrations; a claim document keeps workers from running one twice.
+
+    With rerun every migration is applied again, for documents a restore brought
+    back at an older schema. Every migration is safe to apply more than once.
+    """
+    from pymongo.errors import DuplicateKeyError
+    
+    if rerun:
+        await db.migrations.delete_many({"_id": {"$in": [migration_id for migration_id, _ in DATA_MIGRATIONS]}})
+    for migration_id, migration in DATA_MIGRATIONS:
+        try:
+            await db.migrations.insert_one({"_id": migration_id, "status": "running", "started_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            continue
+        
+        try:
+            logger.info(f"🔧 Applying data migration {migration_id}...")
+            message = await migration()
+            await db.migrations.update_one(
+                {"_id": migration_id},
+                {"$set": {"status": "applied", "applied_at": datetime.utcnow(), "message": message}}
+            )
+            logger.info(f"✅ Data migration {migration_id}: {message}")
+        except Exception as e:
+            # Release the claim so the next startup retries; later migrations may depend on this one
+            await db.migrations.delete_one({"_id": migration_id})
+            logger.error(f"❌ Data migration {migration_id} failed: {str(e)}")
+            break
+
 async def create_default_admin():
     """Create default admin user if no admin exists"""
     try:
@@ -3681,6 +7804,22 @@ async def startup_event():
         # Create default admin user
         await create_default_admin()
         
+        await ensure_indexes()
+        await run_data_migrations()
+        
+        # Start background jobs (backups, cleanup, daily reports)
+        if SCHEDULER_ENABLED:
+            await scheduler.start()
+            logger.info("⏰ Job scheduler started")
+        
+        if CACHE_SHARED_GENERATIONS:
+            response_cache.start_shared_sync()
+            logger.info("🔁 Sharing response cache invalidations across workers")
+        
+        if DASHBOARD_CHANGE_STREAMS:
+            dashboard_broker.start_bridge()
+            logger.info("📡 Dashboard change stream bridge started")
+        
         # Log startup completion
         logger.info("🎉 MediPOS Backend Server started successfully!")
         logger.info("📚 API Documentation available at: /docs")
@@ -3699,6 +7838,29 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if DB_COMMAND_BUDGETS in ("report", "enforce"):
+    app.add_middleware(DBCommandBudgetMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus scrape endpoint (metrics are per worker process)"""
+    from fastapi.responses import PlainTextResponse
+    
+    lines = []
+    request_metrics.render(lines)
+    mongo_command_metrics.render(lines)
+    cache_stats = response_cache.stats()
+    for name in ("hits", "misses", "not_modified", "evictions"):
+        lines.append(f"# TYPE medipos_response_cache_{name}_total counter")
+        lines.append(f"medipos_response_cache_{name}_total {cache_stats[name]}")
+    lines.append("# TYPE medipos_response_cache_bytes gauge")
+    lines.append(f"medipos_response_cache_bytes {cache_stats['size_bytes']}")
+    flight_stats = analytics_flights.stats()
+    for name in ("executed", "coalesced"):
+        lines.append(f"# TYPE medipos_single_flight_{name}_total counter")
+        lines.append(f"medipos_single_flight_{name}_total {flight_stats[name]}")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 # Configure logging
 logging.basicConfig(
@@ -3709,13 +7871,54 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await scheduler.stop()
+    await dashboard_broker.stop()
+    response_cache.stop_shared_sync()
     client.close()
-
-if __name__ == "__main__":
+    if _backup_hash_executor is not None:
+        _backup_hash_executor.shutdown(wait=False)
+    if _render_executor is not None:
+        _render_executor.shutdown(wait=False)
+
+def run_server(argv=None):
+    """Command-line launcher: production settings by default, --dev for the auto-reloading server"""
+    import argparse
+    import importlib.util
     import uvicorn
+    
+    parser = argparse.ArgumentParser(description="MediPOS backend server")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8001)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)),
+                        help="Worker processes (default: WEB_CONCURRENCY or 1)")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.environ.get("GRACEFUL_TIMEOUT", 30)),
+                        help="Seconds in-flight requests may take to finish on shutdown")
+    parser.add_argument("--access-log", action="store_true", help="Log every request")
+    parser.add_argument("--dev", action="store_true", help="Single process with auto-reload, for development")
+    args = parser.parse_args(argv)
+    
+    if args.dev:
+        uvicorn.run("server:app", host=args.host, port=args.port, reload=True)
+        return
+    
+    # uvloop is not available on Windows; fall back to the standard event loop and parser
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    if args.workers > 1:
+        # Workers are separate processes; keep their response caches consistent through Mongo
+        os.environ.setdefault("CACHE_SHARED_GENERATIONS", "true")
+    logger.info(f"Starting {args.workers} worker(s) on {args.host}:{args.port} (loop={loop}, http={http})")
+    
     uvicorn.run(
         "server:app",
-        host=os.environ.get("HOST", "0.0.0.0"),
-        port=int(os.environ.get("PORT", 8001)),
-        reload=True
-    )
\ No newline at end of file
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=loop,
+        http=http,
+        access_log=args.access_log,
+        timeout_graceful_shutdown=args.graceful_timeout
+    )
+
+if __name__ == "__main__":
+    run_server()
@@ -0,0 +1,437 @@
+"""Test fixtures: an in-memory stand-in for the Motor database.
+
+The fake implements the subset of the collection API the endpoints under test
+use and reports every call as one database command, the way the PyMongo command
+listener does against a real server, so record_db_commands() counts round-trips.
+"""
+import asyncio
+import copy
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "medipos_test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from pymongo.errors import BulkWriteError, DuplicateKeyError  # noqa: E402
+
+# Collections with a unique index on id (see ensure_indexes)
+UNIQUE_ID_COLLECTIONS = {"sales", "medicines", "patients", "doctors", "opd_prescriptions"}
+
+def resolve(document, path: str):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+def matches_condition(value, condition) -> bool:
+    if not isinstance(condition, dict) or not any(key.startswith("$") for key in condition):
+        return value == condition
+    for operator, operand in condition.items():
+        if operator == "$in" and value not in operand:
+            return False
+        if operator == "$nin" and value in operand:
+            return False
+        if operator == "$ne" and value == operand:
+            return False
+        if operator == "$exists" and (value is not None) != operand:
+            return False
+        if operator == "$type" and operand == "string" and not isinstance(value, str):
+            return False
+        if operator == "$elemMatch" and not (isinstance(value, list) and any(matches(element, operand) for element in value)):
+            return False
+        if operator in ("$lt", "$lte", "$gt", "$gte"):
+            if value is None:
+                return False
+            if operator == "$lt" and not value < operand:
+                return False
+            if operator == "$lte" and not value <= operand:
+                return False
+            if operator == "$gt" and not value > operand:
+                return False
+            if operator == "$gte" and not value >= operand:
+                return False
+    return True
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$expr":
+            continue  # evaluated by the server only; tests do not rely on it
+        if key == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+            continue
+        if not matches_condition(resolve(document, key), condition):
+            return False
+    return True
+
+def set_path(document: dict, path: str, value):
+    parts = path.split(".")
+    target = document
+    for part in parts[:-1]:
+        target = target[int(part)] if isinstance(target, list) else target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+def unset_path(document: dict, path: str):
+    parts = path.split(".")
+    target = document
+    for part in parts[:-1]:
+        target = target[int(part)] if isinstance(target, list) else target.get(part, {})
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+
+def apply_update(document: dict, update, inserting: bool = False):
+    if isinstance(update, list):
+        # Update pipeline: only $set stages
+        for stage in update:
+            for path, expression in stage["$set"].items():
+                set_path(document, path, copy.deepcopy(evaluate(document, expression)))
+        return
+    for path, value in update.get("$set", {}).items():
+        set_path(document, path, copy.deepcopy(value))
+    if inserting:
+        for path, value in update.get("$setOnInsert", {}).items():
+            set_path(document, path, copy.deepcopy(value))
+    for path in update.get("$unset", {}):
+        unset_path(document, path)
+    for path, amount in update.get("$inc", {}).items():
+        set_path(document, path, (resolve(document, path) or 0) + amount)
+
+def evaluate(document: dict, expression):
+    """Value of an aggregation expression: "$path", a document of expressions, or a literal"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return resolve(document, expression[1:])
+    if isinstance(expression, dict):
+        return {key: evaluate(document, value) for key, value in expression.items()}
+    return expression
+
+def run_pipeline(documents: list, pipeline: list) -> list:
+    """The aggregation stages the endpoints under test use: $match, $unwind, $group ($sum, $push), $sort, $limit"""
+    for stage in pipeline:
+        (operator, spec), = stage.items()
+        if operator == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif operator == "$unwind":
+            path = spec[1:]
+            documents = [{**document, path: element} for document in documents for element in resolve(document, path) or []]
+        elif operator == "$group":
+            groups = {}
+            for document in documents:
+                key = evaluate(document, spec["_id"])
+                group = groups.setdefault(repr(key), {"_id": key})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (kind, argument), = accumulator.items()
+                    value = evaluate(document, argument)
+                    if kind == "$sum":
+                        group[field] = group.get(field, 0) + (value or 0)
+                    elif kind == "$push":
+                        group.setdefault(field, []).append(value)
+            documents = list(groups.values())
+        elif operator == "$sort":
+            for key, direction in reversed(list(spec.items())):
+                documents.sort(key=lambda document: resolve(document, key), reverse=direction < 0)
+        elif operator == "$limit":
+            documents = documents[:spec]
+        else:
+            raise NotImplementedError(f"fake aggregate does not support {operator}")
+    return documents
+
+class AggregateCursor:
+    def __init__(self, collection, pipeline: list):
+        self._collection = collection
+        self._pipeline = pipeline
+
+    def _documents(self) -> list:
+        self._collection.command("aggregate")
+        return run_pipeline(copy.deepcopy(self._collection.documents), self._pipeline)
+
+    async def to_list(self, length=None):
+        documents = self._documents()
+        return documents[:length] if length else documents
+
+    def __aiter__(self):
+        self._iterator = iter(self._documents())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class UpdateResult:
+    def __init__(self, matched_count: int, modified_count: int, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+class BulkResult:
+    def __init__(self, modified_count: int, upserted_ids: dict):
+        self.modified_count = modified_count
+        self.upserted_ids = upserted_ids
+
+class DeleteResult:
+    def __init__(self, deleted_count: int):
+        self.deleted_count = deleted_count
+
+class FakeCursor:
+    def __init__(self, collection, query: dict, projection: dict):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self._sort = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, _):
+        return self
+
+    def _documents(self) -> list:
+        self._collection.command("find")
+        documents = [document for document in self._collection.documents if matches(document, self._query)]
+        for key, direction in reversed(self._sort or []):
+            documents.sort(key=lambda document: (resolve(document, key) is not None, resolve(document, key)), reverse=direction < 0)
+        documents = documents[self._skip:]
+        if self._limit:
+            documents = documents[:self._limit]
+        return [self._collection.project(document, self._projection) for document in documents]
+
+    async def to_list(self, length=None):
+        documents = self._documents()
+        return documents[:length] if length else documents
+
+    def __aiter__(self):
+        self._iterator = iter(self._documents())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FakeCollection:
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.documents = []
+        self._next_id = 0
+
+    def command(self, command_name: str):
+        recorder = server.db_command_recorder.get()
+        if recorder is not None:
+            recorder.record(command_name, self.name)
+        self.database.commands.append((command_name, self.name))
+        if command_name in server.MONGO_WRITE_COMMANDS:
+            for listener in server.mongo_command_metrics.write_listeners:
+                listener(self.name)
+
+    @staticmethod
+    def project(document: dict, projection) -> dict:
+        document = copy.deepcopy(document)
+        if projection and projection.get("_id") == 0:
+            document.pop("_id", None)
+        return document
+
+    def _store(self, document: dict) -> dict:
+        document = copy.deepcopy(document)
+        if "_id" not in document:
+            self._next_id += 1
+            document["_id"] = f"{self.name}-{self._next_id}"
+        self.documents.append(document)
+        return document
+
+    def _duplicate(self, document: dict) -> bool:
+        return (
+            self.name in UNIQUE_ID_COLLECTIONS
+            and "id" in document
+            and any(existing.get("id") == document["id"] for existing in self.documents)
+        )
+
+    # Reads
+    def find(self, query: dict = None, projection: dict = None, **_):
+        return FakeCursor(self, query or {}, projection)
+
+    async def find_one(self, query: dict = None, projection: dict = None, sort=None, **_):
+        cursor = self.find(query, projection)
+        if sort:
+            cursor.sort(sort)
+        documents = await cursor.limit(1).to_list(1)
+        return documents[0] if documents else None
+
+    def aggregate(self, pipeline: list, **_):
+        return AggregateCursor(self, pipeline)
+
+    async def count_documents(self, query: dict = None):
+        self.command("aggregate")
+        return sum(matches(document, query or {}) for document in self.documents)
+
+    async def distinct(self, key: str, query: dict = None):
+        self.command("distinct")
+        return sorted({resolve(document, key) for document in self.documents if matches(document, query or {})})
+
+    # Writes
+    async def insert_one(self, document: dict):
+        self.command("insert")
+        if "_id" in document and any(existing["_id"] == document["_id"] for existing in self.documents):
+            raise DuplicateKeyError("E11000 duplicate key error")
+        if self._duplicate(document):
+            raise server.HTTPException(status_code=500, detail="duplicate key")
+        self._store(document)
+
+    async def insert_many(self, documents: list, ordered: bool = True):
+        self.command("insert")
+        write_errors = []
+        for index, document in enumerate(documents):
+            if self._duplicate(document):
+                write_errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key error"})
+                if ordered:
+                    break
+                continue
+            self._store(document)
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "upserted": [], "nInserted": len(documents) - len(write_errors)})
+
+    def _update(self, query: dict, update: dict, upsert: bool, many: bool) -> UpdateResult:
+        matched = [document for document in self.documents if matches(document, query)]
+        if not many:
+            matched = matched[:1]
+        for document in matched:
+            apply_update(document, update)
+        if not matched and upsert:
+            document = {key: value for key, value in query.items() if not key.startswith("$")}
+            apply_update(document, update, inserting=True)
+            stored = self._store(document)
+            return UpdateResult(0, 0, upserted_id=stored["_id"])
+        return UpdateResult(len(matched), len(matched))
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False, **_):
+        self.command("update")
+        return self._update(query, update, upsert, many=False)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False, **_):
+        self.command("update")
+        return self._update(query, update, upsert, many=True)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: dict = None, return_document=False, **_):
+        self.command("findAndModify")
+        matched = [document for document in self.documents if matches(document, query)][:1]
+        if not matched:
+            return None
+        before = self.project(matched[0], projection)
+        apply_update(matched[0], update)
+        return self.project(matched[0], projection) if return_document else before
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        self.command("update")
+        modified = 0
+        upserted_ids = {}
+        for index, operation in enumerate(operations):
+            result = self._update(
+                operation._filter, operation._doc, operation._upsert,
+                many=type(operation).__name__ == "UpdateMany"
+            )
+            modified += result.modified_count
+            if result.upserted_id is not None:
+                upserted_ids[index] = result.upserted_id
+        return BulkResult(modified, upserted_ids)
+
+    async def delete_one(self, query: dict):
+        self.command("delete")
+        for document in self.documents:
+            if matches(document, query):
+                self.documents.remove(document)
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+    async def delete_many(self, query: dict):
+        self.command("delete")
+        kept = [document for document in self.documents if not matches(document, query)]
+        deleted = len(self.documents) - len(kept)
+        self.documents = kept
+        return DeleteResult(deleted)
+
+class FakeDatabase:
+    def __init__(self):
+        self._collections = {}
+        self.commands = []
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    server.settings_service.invalidate()
+    yield database
+    server.settings_service.invalidate()
+
+@pytest.fixture
+def call_api():
+    """Send a request to the app in the caller's context, so record_db_commands() sees its commands"""
+    import httpx
+
+    def call(method: str, path: str, app=None, **kwargs):
+        async def send():
+            transport = httpx.ASGITransport(app=app or server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.request(method, path, **kwargs)
+        return asyncio.run(send())
+    return call
+
+def seed_medicines(database: FakeDatabase, count: int, stock: int = 1000) -> list:
+    medicines = [
+        server.to_document(server.Medicine(
+            id=f"med-{index}", name=f"Medicine {index}", purchase_price=2.0, selling_price=3.0, stock_quantity=stock
+        ))
+        for index in range(count)
+    ]
+    database.medicines.documents.extend(copy.deepcopy(medicines))
+    return medicines
+
+def sale_payload(medicines: list, quantity: int = 1, **fields) -> dict:
+    items = [
+        {
+            "medicine_id": medicine["id"],
+            "medicine_name": medicine["name"],
+            "quantity": quantity,
+            "unit_price": medicine["selling_price"],
+            "total_price": medicine["selling_price"] * quantity
+        }
+        for medicine in medicines
+    ]
+    subtotal = sum(item["total_price"] for item in items)
+    return {"items": items, "subtotal": subtotal, "total_amount": subtotal, "payment_method": "cash", **fields}
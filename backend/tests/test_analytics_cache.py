@@ -0,0 +1,71 @@
+"""Analytics responses are cached under the date range they resolve to, not the raw query"""
+import asyncio
+
+import server
+
+def test_custom_dates_resolve_to_naive_utc():
+    written_in_utc = server.resolve_date_range("2026-01-31T18:30:00Z", "2026-02-28T18:29:59Z", "custom")
+    written_in_ist = server.resolve_date_range("2026-02-01T00:00:00+05:30", "2026-02-28T23:59:59+05:30", "custom")
+
+    assert written_in_utc == written_in_ist
+    assert written_in_utc[0].tzinfo is None
+
+def test_incomplete_custom_range_falls_back_to_this_month():
+    assert server.resolve_date_range(None, None, "custom") == server.resolve_date_range(None, None, None)
+    assert server.resolve_date_range(None, None, "custom")[2] == "this_month"
+
+def test_same_range_written_differently_shares_one_cache_entry(fake_db, call_api, monkeypatch):
+    computed = []
+
+    async def compute(start_dt, end_dt, date_range):
+        computed.append((start_dt, end_dt))
+        return {"period": {"date_range": date_range}, "summary": {}, "medicine_analysis": []}
+    monkeypatch.setattr(server, "compute_comprehensive_analytics", compute)
+
+    first = call_api("GET", "/api/analytics/comprehensive", params={
+        "date_range": "custom", "start_date": "2025-03-01T00:00:00+05:30", "end_date": "2025-03-31T23:59:59+05:30"
+    })
+    second = call_api("GET", "/api/analytics/comprehensive", params={
+        "date_range": "custom", "start_date": "2025-02-28T18:30:00Z", "end_date": "2025-03-31T18:29:59Z"
+    })
+    export = call_api("GET", "/api/analytics/export-data", params={
+        "date_range": "custom", "start_date": "2025-02-28T18:30:00", "end_date": "2025-03-31T18:29:59",
+        "export_type": "medicine_analysis"
+    })
+
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "HIT")
+    assert len(computed) == 1
+    assert export.status_code == 200, export.text
+    assert export.json()["data"] == []
+
+def test_malformed_custom_date_is_a_bad_request(fake_db, call_api):
+    response = call_api("GET", "/api/analytics/kpis", params={
+        "date_range": "custom", "start_date": "last tuesday", "end_date": "2025-03-31"
+    })
+
+    assert response.status_code == 400
+
+def test_matching_if_none_match_is_not_modified(fake_db, call_api, monkeypatch):
+    async def compute(start_dt, end_dt, date_range):
+        return {"period": {"date_range": date_range}, "summary": {}, "medicine_analysis": []}
+    monkeypatch.setattr(server, "compute_comprehensive_analytics", compute)
+    params = {"date_range": "custom", "start_date": "2025-03-01", "end_date": "2025-03-31"}
+
+    first = call_api("GET", "/api/analytics/comprehensive", params=params)
+    revalidated = call_api(
+        "GET", "/api/analytics/comprehensive", params=params, headers={"If-None-Match": first.headers["etag"]}
+    )
+    stale = call_api("GET", "/api/analytics/comprehensive", params=params, headers={"If-None-Match": '"other"'})
+
+    assert first.status_code == 200
+    assert revalidated.status_code == 304 and revalidated.content == b""
+    assert revalidated.headers["etag"] == first.headers["etag"]
+    assert stale.status_code == 200 and stale.json() == first.json()
+
+def test_only_writes_to_cached_collections_bump_generations(fake_db):
+    before = server.response_cache.stats()["invalidations"]
+    asyncio.run(fake_db.scheduler_locks.update_one({"_id": "backup"}, {"$set": {"heartbeat": 1}}, upsert=True))
+    assert server.response_cache.stats()["invalidations"] == before
+
+    asyncio.run(fake_db.sales.insert_one({"id": "sale-1", "items": []}))
+    assert server.response_cache.stats()["invalidations"] == before + 1
@@ -0,0 +1,30 @@
+"""Revenue anomaly listing: validated dates and paging"""
+import pytest
+
+@pytest.fixture
+def anomalies(fake_db):
+    fake_db.revenue_anomalies.documents.extend(
+        {"day": f"2026-03-{day:02d}", "kind": "daily_revenue", "score": float(day)} for day in range(1, 11)
+    )
+    return fake_db
+
+@pytest.mark.parametrize("params", [{"end_date": "foo"}, {"start_date": "foo"}, {"start_date": "2026-03-01", "end_date": "03/10/2026"}])
+def test_malformed_dates_are_rejected(anomalies, call_api, params):
+    response = call_api("GET", "/api/analytics/anomalies", params=params)
+
+    assert response.status_code == 400
+    assert "ISO date" in response.json()["detail"]
+
+def test_pages_follow_each_other_newest_first(anomalies, call_api):
+    params = {"start_date": "2026-03-01", "end_date": "2026-03-31T12:00:00Z", "limit": 4}
+
+    first = call_api("GET", "/api/analytics/anomalies", params=params).json()
+    last = call_api("GET", "/api/analytics/anomalies", params={**params, "skip": 8}).json()
+
+    assert [anomaly["day"] for anomaly in first["anomalies"]] == ["2026-03-10", "2026-03-09", "2026-03-08", "2026-03-07"]
+    assert first["has_more"] and first["end_date"] == "2026-03-31"
+    assert [anomaly["day"] for anomaly in last["anomalies"]] == ["2026-03-02", "2026-03-01"]
+    assert not last["has_more"]
+
+def test_limit_is_capped(anomalies, call_api):
+    assert call_api("GET", "/api/analytics/anomalies", params={"limit": 5000}).status_code == 400
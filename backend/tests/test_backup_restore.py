@@ -0,0 +1,86 @@
+"""Restoring backups written before sale lines carried costs and returned quantities,
+and before stock movements carried recorded_at"""
+import json
+from datetime import datetime
+
+import pytest
+
+import server
+
+SOLD_AT = "2025-03-01 10:00:00"
+
+def write_backup(folder, collections: dict):
+    folder.mkdir()
+    for name, documents in collections.items():
+        (folder / f"{name}.json").write_text(json.dumps(documents))
+
+def pre_042_backup() -> dict:
+    """Collections as a backup from before returned_quantity, unit_cost and recorded_at existed"""
+    line = {"medicine_id": "med-1", "medicine_name": "Amoxicillin", "quantity": 3, "unit_price": 4.0, "total_price": 12.0}
+    return {
+        "medicines": [{
+            "id": "med-1", "name": "Amoxicillin", "manufacturer": "Acme", "purchase_price": 2.5,
+            "selling_price": 4.0, "stock_quantity": 40, "created_at": SOLD_AT, "updated_at": SOLD_AT
+        }],
+        "sales": [{
+            "id": "sale-1", "items": [line], "subtotal": 12.0, "total_amount": 12.0,
+            "payment_method": "cash", "created_at": SOLD_AT
+        }],
+        "returns": [{
+            "id": "return-1", "original_sale_id": "sale-1", "items": [{**line, "quantity": 2, "total_price": 8.0}],
+            "subtotal": 8.0, "total_amount": 8.0, "refund_method": "cash", "created_at": "2025-03-02 09:00:00"
+        }],
+        "stock_movements": [
+            {
+                "id": "move-1", "medicine_id": "med-1", "medicine_name": "Amoxicillin", "transaction_type": "sale",
+                "quantity": -3, "unit_price": 4.0, "total_value": -12.0, "reference_id": "sale-1", "created_at": SOLD_AT
+            },
+            {
+                # Not a transaction type this version knows, so it is stored unvalidated
+                "id": "move-2", "medicine_id": "med-1", "medicine_name": "Amoxicillin", "transaction_type": "transfer",
+                "quantity": 5, "unit_price": 0, "total_value": 0, "created_at": "2025-03-03 08:00:00"
+            }
+        ]
+    }
+
+@pytest.fixture
+def restored(fake_db, call_api, tmp_path):
+    folder = tmp_path / "backup_2025"
+    write_backup(folder, pre_042_backup())
+    fake_db.backups.documents.append({"id": "backup-1", "name": "March", "status": "completed", "file_path": str(folder)})
+
+    response = call_api("POST", "/api/backup/restore", json={"backup_id": "backup-1", "restore_settings": False})
+    assert response.status_code == 200, response.text
+    return fake_db
+
+def test_restored_sale_lines_get_cost_and_returned_quantity_from_the_backup(restored):
+    sale, = restored.sales.documents
+    line, = sale["items"]
+
+    assert line["unit_cost"] == 2.5 and line["manufacturer"] == "Acme"
+    assert line["returned_quantity"] == 2
+    assert sale["schema_version"] == server.Sale.schema_version
+
+def test_restored_movements_keep_when_they_changed_stock(restored):
+    movements = {movement["id"]: movement for movement in restored.stock_movements.documents}
+
+    assert movements["move-1"]["recorded_at"] == datetime(2025, 3, 1, 10, 0)
+    assert movements["move-1"]["schema_version"] == server.StockMovement.schema_version
+    # The unvalidated movement is brought up to date by the migrations run after the restore
+    assert movements["move-2"]["recorded_at"] == datetime(2025, 3, 3, 8, 0)
+    assert "schema_version" not in movements["move-2"]
+
+def test_items_returned_before_the_backup_cannot_be_returned_again(restored, call_api):
+    line = {"medicine_id": "med-1", "medicine_name": "Amoxicillin", "quantity": 2, "unit_price": 4.0, "total_price": 8.0}
+
+    response = call_api("POST", "/api/returns", json={
+        "original_sale_id": "sale-1", "items": [line], "subtotal": 8.0, "total_amount": 8.0, "refund_method": "cash"
+    })
+
+    assert response.status_code == 400
+    assert "more" in response.json()["detail"]
+
+def test_restore_runs_the_data_migrations_again(restored):
+    applied = {migration["_id"]: migration["status"] for migration in restored.migrations.documents}
+
+    assert applied == {migration_id: "applied" for migration_id, _ in server.DATA_MIGRATIONS}
@@ -0,0 +1,125 @@
+"""Database round-trip caps for write paths: command counts must not grow with basket, batch or file size"""
+import csv
+import io
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from conftest import seed_medicines, sale_payload
+
+def endpoint_budget(path: str, method: str) -> int:
+    for route in server.app.routes:
+        if getattr(route, "path", None) == path and method in getattr(route, "methods", ()):
+            return route.endpoint.db_command_budget
+    raise LookupError(f"{method} {path} is not routed")
+
+@pytest.mark.parametrize("basket_size", [1, 5, 40])
+def test_create_sale_commands_do_not_grow_with_basket(fake_db, call_api, basket_size):
+    medicines = seed_medicines(fake_db, basket_size)
+
+    with server.record_db_commands() as recorder:
+        response = call_api("POST", "/api/sales", json=sale_payload(medicines, quantity=2))
+
+    assert response.status_code == 200, response.text
+    recorder.assert_at_most(4, "POST /sales")
+    assert recorder.count <= endpoint_budget("/api/sales", "POST")
+    assert all(medicine["stock_quantity"] == 998 for medicine in fake_db.medicines.documents)
+
+@pytest.mark.parametrize("batch_size", [1, 20, 200])
+def test_sales_batch_commands_do_not_grow_with_batch(fake_db, call_api, batch_size):
+    medicines = seed_medicines(fake_db, 3)
+    sales = [sale_payload(medicines, id=f"till-1-{index}") for index in range(batch_size)]
+
+    with server.record_db_commands() as recorder:
+        response = call_api("POST", "/api/sales/batch", json={"sales": sales})
+
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == batch_size
+    recorder.assert_at_most(6, "POST /sales/batch")
+    assert recorder.count <= endpoint_budget("/api/sales/batch", "POST")
+    assert {medicine["stock_quantity"] for medicine in fake_db.medicines.documents} == {1000 - batch_size}
+    assert not any("stock_pending_since" in sale for sale in fake_db.sales.documents)
+
+def test_sales_batch_replay_is_a_duplicate_without_stock_change(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 2)
+    batch = {"sales": [sale_payload(medicines, id=f"till-1-{index}") for index in range(10)]}
+    call_api("POST", "/api/sales/batch", json=batch)
+
+    with server.record_db_commands() as recorder:
+        response = call_api("POST", "/api/sales/batch", json=batch)
+
+    assert response.json()["duplicates"] == 10
+    recorder.assert_at_most(2, "POST /sales/batch replay")
+    assert {medicine["stock_quantity"] for medicine in fake_db.medicines.documents} == {990}
+
+def test_sales_batch_replay_applies_stock_of_a_stalled_sale(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 2)
+    payload = sale_payload(medicines, quantity=3, id="till-1-stalled")
+    # Stored by a request that died before decrementing stock
+    sale = server.Sale(**payload)
+    fake_db.sales.documents.append({
+        **server.to_document(sale),
+        "stock_pending_since": datetime.utcnow() - timedelta(seconds=server.SALE_STOCK_RECOVERY_SECONDS + 1)
+    })
+    batch = {"sales": [payload] + [sale_payload(medicines, id=f"till-1-{index}") for index in range(20)]}
+
+    with server.record_db_commands() as recorder:
+        response = call_api("POST", "/api/sales/batch", json=batch)
+
+    body = response.json()
+    assert body["created"] == 20 and body["duplicates"] == 1
+    assert recorder.count <= endpoint_budget("/api/sales/batch", "POST")
+    assert {medicine["stock_quantity"] for medicine in fake_db.medicines.documents} == {1000 - 3 - 20}
+    assert not any("stock_pending_since" in sale for sale in fake_db.sales.documents)
+
+    # A further replay finds nothing left to apply
+    call_api("POST", "/api/sales/batch", json=batch)
+    assert {medicine["stock_quantity"] for medicine in fake_db.medicines.documents} == {1000 - 3 - 20}
+
+def test_sales_batch_leaves_a_recent_pending_sale_to_its_request(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 1)
+    payload = sale_payload(medicines, id="till-1-in-flight")
+    fake_db.sales.documents.append({**server.to_document(server.Sale(**payload)), "stock_pending_since": datetime.utcnow()})
+
+    call_api("POST", "/api/sales/batch", json={"sales": [payload]})
+
+    assert fake_db.medicines.documents[0]["stock_quantity"] == 1000
+
+def medicines_csv(count: int) -> bytes:
+    spec = server.EXPORT_COLLECTIONS["medicines"]
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(spec["headers"])
+    for index in range(count):
+        writer.writerow([f"imp-{index}", f"Imported {index}", "", "", "", "", "2.5", "4", "10", "5", "", "", ""])
+    return output.getvalue().encode()
+
+@pytest.mark.parametrize("rows", [10, server.IMPORT_BATCH_SIZE * 3])
+def test_csv_import_commands_grow_with_chunks_not_rows(fake_db, call_api, rows):
+    chunks = -(-rows // server.IMPORT_BATCH_SIZE)
+
+    with server.record_db_commands() as recorder:
+        response = call_api(
+            "POST", "/api/import/csv/medicines",
+            files={"file": ("medicines.csv", medicines_csv(rows), "text/csv")}
+        )
+
+    assert response.status_code == 200, response.text
+    assert response.json()["imported_counts"] == {"medicines": rows}
+    # Per chunk: read the replaced stock, upsert, record the stock adjustments
+    recorder.assert_at_most(3 * chunks, f"CSV import of {rows} rows")
+    assert len(fake_db.stock_movements.documents) == rows
+
+def test_enforce_mode_replaces_an_over_budget_response(fake_db, call_api, monkeypatch):
+    medicines = seed_medicines(fake_db, 2)
+    monkeypatch.setattr(server, "DB_COMMAND_BUDGETS", "enforce")
+    monkeypatch.setattr(server.create_sale, "db_command_budget", 1)
+
+    response = call_api(
+        "POST", "/api/sales", app=server.DBCommandBudgetMiddleware(server.app), json=sale_payload(medicines)
+    )
+
+    assert response.status_code == 500
+    assert response.headers["x-db-command-budget-exceeded"] == "1"
+    assert "budget 1" in response.json()["detail"]
@@ -0,0 +1,40 @@
+"""Server-side prescription rendering fills every placeholder the template editor advertises"""
+import server
+
+def test_prescription_render_fills_website_symptoms_and_diagnosis(fake_db, call_api):
+    fake_db.settings.documents.append({"general": {"shop_name": "Care & Cure", "shop_website": "care.example"}, "version": 1})
+    fake_db.doctors.documents.append({"id": "doc-1", "name": "Rao", "is_active": True})
+    fake_db.patients.documents.append({"id": "pat-1", "name": "Asha"})
+    fake_db.custom_templates.documents.append({
+        "id": "tpl-1",
+        "html": "<p>{{clinic_name}} {{clinic_website}}</p><p>{{symptoms}}</p><p>{{diagnosis}}</p>",
+        "css": "p { margin: 0; }"
+    })
+
+    created = call_api("POST", "/api/opd-prescriptions", json={
+        "doctor_id": "doc-1", "patient_id": "pat-1", "symptoms": "Fever <3 days>", "diagnosis": "Viral fever"
+    })
+    assert created.status_code == 200, created.text
+
+    response = call_api("GET", f"/api/opd-prescriptions/{created.json()['id']}/render", params={"template_id": "tpl-1"})
+
+    assert response.status_code == 200, response.text
+    assert "Care &amp; Cure care.example" in response.text
+    assert "<p>Fever &lt;3 days&gt;</p>" in response.text
+    assert "<p>Viral fever</p>" in response.text
+    assert "{{" not in response.text
+
+def test_opd_paper_custom_html_needs_no_custom_css(fake_db, call_api):
+    fake_db.settings.documents.append({
+        "opd_paper": {"custom_html_enabled": True, "custom_html": "<h1>Rx for {{patient_name}}</h1>", "custom_css": ""},
+        "version": 1
+    })
+    fake_db.doctors.documents.append({"id": "doc-1", "name": "Rao", "is_active": True})
+    fake_db.patients.documents.append({"id": "pat-1", "name": "Asha"})
+    created = call_api("POST", "/api/opd-prescriptions", json={"doctor_id": "doc-1", "patient_id": "pat-1"})
+
+    response = call_api("GET", f"/api/opd-prescriptions/{created.json()['id']}/render")
+
+    assert response.status_code == 200, response.text
+    assert "<h1>Rx for Asha</h1>" in response.text
+    assert ".print-hidden { display: none !important; }" in response.text
@@ -0,0 +1,71 @@
+"""Reorder suggestions: moving-average forecasts, safety stock and reorder points on known demand"""
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import server
+
+TODAY = int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()) // 86400
+
+def cube_columns(lines: list) -> dict:
+    """Sales cube columns for (medicine code, days before today, quantity) lines"""
+    return {
+        "medicine": np.array([code for code, _, _ in lines], dtype=np.int32),
+        "day": np.array([TODAY - days_ago for _, days_ago, _ in lines], dtype=np.int32),
+        "quantity": np.array([quantity for _, _, quantity in lines], dtype=np.int64)
+    }
+
+def suggestions(method: server.ForecastMethod, alpha: float = 0.5) -> dict:
+    # Medicine 0 sold 2, 4, 6 and 8 units over the last four complete days, and 9 so far today;
+    # medicine 1 last sold before the lookback and medicine 2 never sold
+    columns = cube_columns([(0, 4, 2), (0, 3, 4), (0, 2, 6), (0, 1, 8), (0, 0, 9), (1, 30, 50)])
+    medicines = [
+        {"id": "med-0", "name": "Paracetamol", "stock_quantity": 20},
+        {"id": "med-1", "name": "Cetirizine", "stock_quantity": 5},
+        {"id": "med-2", "name": "Ibuprofen", "stock_quantity": 0}
+    ]
+    rows = server.compute_reorder_suggestions(
+        columns, {"med-0": 0, "med-1": 1}, medicines, lookback_days=4, method=method, window=4, alpha=alpha,
+        lead_time_days=4, cover_days=10, service_level=0.95, only_reorder=False
+    )
+    return {row["medicine_id"]: row for row in rows}
+
+def test_simple_moving_average():
+    paracetamol = suggestions(server.ForecastMethod.SMA)["med-0"]
+
+    # Mean 5, population std sqrt(5); safety stock 1.645 x sqrt(5) x sqrt(4 days of lead time)
+    assert paracetamol["forecast_daily_demand"] == 5.0
+    assert paracetamol["demand_std"] == pytest.approx(2.236)
+    assert paracetamol["safety_stock"] == 7.4
+    assert paracetamol["reorder_point"] == 27.4                 # 5 x 4 + 7.356
+    assert paracetamol["suggested_order_quantity"] == 58        # ceil(27.356 + 5 x 10 - 20)
+    assert paracetamol["days_of_cover"] == 4.0
+    assert paracetamol["needs_reorder"]
+
+def test_exponential_moving_average():
+    paracetamol = suggestions(server.ForecastMethod.EMA)["med-0"]
+
+    # Seeded with 2, then 3, 4.5 and 6.25 at alpha 0.5
+    assert paracetamol["forecast_daily_demand"] == 6.25
+    assert paracetamol["safety_stock"] == 7.4
+    assert paracetamol["reorder_point"] == 32.4                 # 6.25 x 4 + 7.356
+    assert paracetamol["suggested_order_quantity"] == 75        # ceil(32.356 + 6.25 x 10 - 20)
+
+def test_medicines_without_sales_in_the_lookback_are_not_reordered():
+    rows = suggestions(server.ForecastMethod.EMA)
+
+    for medicine_id in ("med-1", "med-2"):
+        assert rows[medicine_id]["forecast_daily_demand"] == 0
+        assert rows[medicine_id]["reorder_point"] == 0
+        assert not rows[medicine_id]["needs_reorder"]
+        assert rows[medicine_id]["days_of_cover"] is None
+
+def test_demand_matrix_holds_only_medicines_sold_in_the_window():
+    columns = cube_columns([(0, 2, 3), (2, 1, 1), (2, 1, 4), (1, 40, 7)])
+
+    sold, demand = server.daily_demand_matrix(columns, np.array([2, -1, 1, 0]), TODAY - 3, 3)
+
+    assert sold.tolist() == [0, 3]
+    assert demand.dtype == np.float32
+    assert demand.tolist() == [[0, 0, 5], [0, 3, 0]]
@@ -0,0 +1,43 @@
+"""Returns are validated before any quantity is recorded against the original sale"""
+import pytest
+
+import server
+from conftest import seed_medicines, sale_payload
+
+def return_payload(sale: dict, items: list) -> dict:
+    total = sum(item["total_price"] for item in items)
+    return {
+        "original_sale_id": sale["id"], "items": items, "subtotal": total,
+        "total_amount": total, "refund_method": "cash"
+    }
+
+@pytest.fixture
+def sale(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 2)
+    response = call_api("POST", "/api/sales", json=sale_payload(medicines, quantity=3))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_empty_return_is_rejected(fake_db, call_api, sale):
+    with server.record_db_commands() as recorder:
+        response = call_api("POST", "/api/returns", json=return_payload(sale, []))
+
+    assert response.status_code == 400
+    assert recorder.count == 0
+
+def test_zero_quantity_return_is_rejected(fake_db, call_api, sale):
+    item = {**sale["items"][0], "quantity": 0, "total_price": 0}
+
+    response = call_api("POST", "/api/returns", json=return_payload(sale, [item]))
+
+    assert response.status_code == 400
+    assert not fake_db.sales.documents[0]["items"][0].get("returned_quantity")
+
+def test_partial_return_restores_stock(fake_db, call_api, sale):
+    item = {**sale["items"][0], "quantity": 2, "total_price": sale["items"][0]["unit_price"] * 2}
+
+    response = call_api("POST", "/api/returns", json=return_payload(sale, [item]))
+
+    assert response.status_code == 200, response.text
+    assert fake_db.sales.documents[0]["items"][0]["returned_quantity"] == 2
+    assert fake_db.medicines.documents[0]["stock_quantity"] == 999
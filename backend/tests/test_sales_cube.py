@@ -0,0 +1,106 @@
+"""Sales cube: incremental loads match a full reload, restores reload every worker, and both
+grouping strategies agree with a plain Python group-by"""
+import asyncio
+import itertools
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+import server
+
+START = datetime(2026, 3, 1, 9, 0)
+object_id_counter = itertools.count()
+
+def object_id_at(moment: datetime) -> ObjectId:
+    """An ObjectId generated at `moment`, unique within the test run"""
+    seconds = int((moment - datetime(1970, 1, 1)).total_seconds())
+    return ObjectId(seconds.to_bytes(4, "big") + next(object_id_counter).to_bytes(8, "big"))
+
+def sale_at(moment: datetime, medicine: int, quantity: int = 1, payment_method: str = "cash") -> dict:
+    return {
+        "_id": object_id_at(moment),
+        "id": f"sale-{moment.isoformat()}-{medicine}-{next(object_id_counter)}",
+        "created_at": moment,
+        "payment_method": payment_method,
+        "items": [{
+            "medicine_id": f"med-{medicine}", "medicine_name": f"Medicine {medicine}", "manufacturer": "Acme",
+            "quantity": quantity, "total_price": 3.0 * quantity, "unit_cost": 2.0
+        }]
+    }
+
+async def grouped(cube: server.SalesCube, group_by: list) -> list:
+    columns, labels, keys, _ = await cube.snapshot()
+    rows = server.query_sales_cube(columns, labels, keys, group_by, None, 10000)
+    return sorted(rows, key=lambda row: tuple(str(row[name]) for name in group_by))
+
+def test_incremental_load_matches_a_full_reload(fake_db):
+    async def scenario():
+        await fake_db.sales.insert_many([sale_at(START + timedelta(seconds=second), second % 7) for second in range(50)])
+        cube = server.SalesCube()
+        await cube.refresh()
+
+        # A sale generated inside the overlap window that reached the server late, plus newer sales
+        await fake_db.sales.insert_many(
+            [sale_at(START + timedelta(seconds=48), 3, quantity=5)]
+            + [sale_at(START + timedelta(seconds=60 + second), second % 4, payment_method="card") for second in range(20)]
+        )
+        await cube.refresh()
+
+        fresh = server.SalesCube()
+        assert cube.sales == len(fake_db.sales.documents) == 71
+        for group_by in (["medicine"], ["payment_method", "hour"], ["day"]):
+            assert await grouped(cube, group_by) == await grouped(fresh, group_by)
+
+    asyncio.run(scenario())
+
+def test_a_reset_in_another_worker_reloads_the_cube(fake_db):
+    async def scenario():
+        await fake_db.sales.insert_many([sale_at(START + timedelta(minutes=minute), 1, quantity=2) for minute in range(10)])
+        cube = server.SalesCube()
+        await cube.refresh()
+
+        # Another worker restores a backup holding different sales
+        await server.SalesCube().reset()
+        await fake_db.sales.delete_many({})
+        await fake_db.sales.insert_many([sale_at(START - timedelta(days=30), 2, quantity=4)])
+
+        rows = await grouped(cube, ["medicine"])
+        assert [(row["medicine_id"], row["quantity"]) for row in rows] == [("med-2", 4)]
+        assert cube.sales == 1
+
+    asyncio.run(scenario())
+
+def python_group_by(columns: dict, group_by: list) -> dict:
+    totals = defaultdict(lambda: [0, 0.0])
+    for index in range(len(columns["quantity"])):
+        key = tuple(int(columns[name][index]) for name in group_by)
+        totals[key][0] += int(columns["quantity"][index])
+        totals[key][1] += float(columns["revenue"][index])
+    return totals
+
+@pytest.mark.parametrize("medicines, days", [(50, 30), (4000, 700)], ids=["bincount", "unique"])
+def test_grouping_matches_a_plain_group_by(medicines, days):
+    # 4000 medicines x 700 days exceeds the dense key space, so rows are grouped with np.unique
+    rng = np.random.default_rng(7)
+    count = 5000
+    first_day = 20000
+    columns = {name: np.zeros(count, dtype=dtype) for name, dtype in server.SALES_CUBE_COLUMNS.items()}
+    columns["medicine"] = rng.integers(0, medicines, count).astype(np.int32)
+    columns["day"] = (first_day + rng.integers(0, days, count)).astype(columns["day"].dtype)
+    columns["quantity"] = rng.integers(1, 5, count).astype(columns["quantity"].dtype)
+    columns["revenue"] = rng.random(count).astype(columns["revenue"].dtype) * 100
+    labels = {"medicine": [f"Medicine {code}" for code in range(medicines)]}
+    keys = {"medicine": [f"med-{code}" for code in range(medicines)]}
+
+    rows = server.query_sales_cube(columns, labels, keys, ["medicine", "day"], None, count)
+
+    expected = python_group_by(columns, ["medicine", "day"])
+    assert len(rows) == len(expected)
+    for row in rows:
+        day = (datetime.fromisoformat(row["day"]) - datetime(1970, 1, 1)).days
+        quantity, revenue = expected[(int(row["medicine_id"][4:]), day)]
+        assert row["quantity"] == quantity
+        assert row["revenue"] == pytest.approx(revenue)
@@ -0,0 +1,57 @@
+"""Job schedules are read in the shop's timezone and slept on in UTC"""
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+def test_cron_fields_are_wall_clock_time_in_the_zone():
+    kolkata = server.schedule_zone("Asia/Kolkata")
+
+    next_run = server.CronExpression("30 2 * * *").next_after(datetime(2026, 3, 1, 12, 0), kolkata)
+
+    assert next_run == datetime(2026, 3, 1, 21, 0)
+
+def test_cron_in_a_skipped_dst_hour_runs_once_after_the_change():
+    new_york = server.schedule_zone("America/New_York")
+    expression = server.CronExpression("30 2 * * *")
+
+    # 02:30 does not exist on 2026-03-08; the job runs at the shifted instant, then daily
+    first = expression.next_after(datetime(2026, 3, 8, 5, 0), new_york)
+    second = expression.next_after(first, new_york)
+
+    assert first == datetime(2026, 3, 8, 7, 30)
+    assert second == datetime(2026, 3, 9, 6, 30)
+
+def test_unknown_zone_falls_back_to_utc():
+    assert server.schedule_zone("Not/AZone") is server.timezone.utc
+
+def test_jobs_follow_the_shop_timezone_unless_pinned(fake_db):
+    fake_db.settings.documents.append({"general": {"timezone": "Asia/Kolkata"}, "telegram": {"daily_report_time": "18:00"}})
+    jobs = {job.id: job for job in server.DEFAULT_SCHEDULED_JOBS}
+    after = datetime(2026, 3, 1, 0, 0)
+
+    def next_run(job_id: str) -> datetime:
+        job = jobs[job_id].copy(update={"jitter_seconds": 0})
+        if job.follow_settings:
+            job.cron = server.settings_job_cron(job.id, fake_db.settings.documents[0])
+        return asyncio.run(server.compute_next_run(job, after))
+
+    assert next_run("daily_report") == datetime(2026, 3, 1, 12, 30)
+    assert next_run("auto_backup") == datetime(2026, 3, 1, 21, 0)
+    assert next_run("demand_classification") == datetime(2026, 3, 1, 0, 20)
+
+def test_changing_the_shop_timezone_reschedules_jobs(fake_db):
+    fake_db.settings.documents.append({"general": {"timezone": "UTC"}})
+    asyncio.run(server.scheduler.ensure_jobs())
+    backup = lambda: next(job for job in fake_db.scheduled_jobs.documents if job["id"] == "backup_cleanup")
+    assert backup()["scheduled_timezone"] == "UTC"
+
+    fake_db.settings.documents[0]["general"]["timezone"] = "Asia/Kolkata"
+    server.settings_service.invalidate()
+    asyncio.run(server.scheduler.sync_settings_jobs())
+
+    assert backup()["scheduled_timezone"] == "Asia/Kolkata"
+    # 03:15 IST is 21:45 UTC, plus up to the job's jitter
+    next_run = backup()["next_run_at"]
+    scheduled = next_run.replace(hour=21, minute=45, second=0, microsecond=0)
+    assert timedelta(0) <= next_run - scheduled <= timedelta(seconds=300)
@@ -0,0 +1,83 @@
+"""Point-in-time stock: a checkpoint plus the movements recorded since, replayed forward or backward"""
+import asyncio
+import csv
+import io
+from datetime import datetime, timedelta
+
+import server
+from conftest import seed_medicines, sale_payload
+
+def checkpoint() -> datetime:
+    return asyncio.run(server.write_stock_checkpoint()).as_of
+
+def stock_as_of(call_api, moment: datetime) -> int:
+    response = call_api("GET", "/api/stock/as-of", params={"date": moment.isoformat(), "medicine_id": "med-0"})
+    assert response.status_code == 200, response.text
+    item, = response.json()["items"]
+    return item["stock_quantity"]
+
+def test_forward_replay_adds_movements_recorded_after_the_checkpoint(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 1)
+    taken_at = checkpoint()
+    call_api("POST", "/api/sales", json=sale_payload(medicines, quantity=3))
+    call_api("POST", "/api/sales", json=sale_payload(medicines, quantity=4))
+
+    assert stock_as_of(call_api, taken_at) == 1000
+    assert stock_as_of(call_api, datetime.utcnow()) == 993
+
+def test_backward_replay_before_the_first_checkpoint_undoes_later_movements(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 1)
+    before_sale = datetime.utcnow()
+    call_api("POST", "/api/sales", json=sale_payload(medicines, quantity=3))
+    checkpoint()
+
+    assert stock_as_of(call_api, before_sale) == 1000
+    assert stock_as_of(call_api, datetime.utcnow()) == 997
+
+def test_back_dated_batch_sale_counts_from_when_it_was_recorded(fake_db, call_api):
+    medicines = seed_medicines(fake_db, 1)
+    taken_at = checkpoint()
+    sold_at = taken_at - timedelta(days=2)
+    call_api("POST", "/api/sales/batch", json={"sales": [
+        sale_payload(medicines, quantity=5, id="till-1-offline", created_at=sold_at.isoformat())
+    ]})
+
+    # The checkpoint already held the stock before the offline sale reached the server
+    assert stock_as_of(call_api, taken_at - timedelta(days=1)) == 1000
+    assert stock_as_of(call_api, datetime.utcnow()) == 995
+
+def test_import_setting_stock_is_an_adjustment_in_the_ledger(fake_db, call_api):
+    seed_medicines(fake_db, 1)
+    taken_at = checkpoint()
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(server.EXPORT_COLLECTIONS["medicines"]["headers"])
+    writer.writerow(["med-0", "Medicine 0", "", "", "", "", "2.0", "3.0", "40", "10", "", "", ""])
+
+    response = call_api(
+        "POST", "/api/import/csv/medicines",
+        files={"file": ("medicines.csv", output.getvalue().encode(), "text/csv")}
+    )
+
+    assert response.status_code == 200, response.text
+    adjustment, = fake_db.stock_movements.documents
+    assert adjustment["transaction_type"] == "adjustment" and adjustment["quantity"] == -960
+    assert stock_as_of(call_api, taken_at) == 1000
+    assert stock_as_of(call_api, datetime.utcnow()) == 40
+
+def test_dates_before_a_restore_replay_the_restored_ledger(fake_db, call_api, tmp_path):
+    from test_backup_restore import pre_042_backup, write_backup
+
+    folder = tmp_path / "backup_2025"
+    write_backup(folder, pre_042_backup())
+    fake_db.backups.documents.append({"id": "backup-1", "name": "March", "status": "completed", "file_path": str(folder)})
+    call_api("POST", "/api/backup/restore", json={"backup_id": "backup-1", "restore_settings": False})
+
+    def restored_stock(moment: datetime) -> int:
+        item, = call_api("GET", "/api/stock/as-of", params={"date": moment.isoformat(), "medicine_id": "med-1"}).json()["items"]
+        return item["stock_quantity"]
+
+    # 40 on hand at the restore; a sale of 3 on March 1 and 5 received on March 3
+    assert restored_stock(datetime(2025, 2, 28)) == 38
+    assert restored_stock(datetime(2025, 3, 2)) == 35
+    assert restored_stock(datetime.utcnow()) == 40
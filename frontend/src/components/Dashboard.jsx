@@ -18,6 +18,7 @@ import axios from "axios";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const DASHBOARD_WS_URL = `${(BACKEND_URL || window.location.origin).replace(/^http/, "ws")}/api/ws/dashboard`;
 
 const Dashboard = () => {
   const [analytics, setAnalytics] = useState(null);
@@ -31,6 +32,49 @@ const Dashboard = () => {
     fetchDailySalesReport();
   }, []);
 
+  // Live updates pushed by the server after sales, returns and stock edits
+  useEffect(() => {
+    let socket;
+    let reconnectTimer;
+    let retryDelay = 1000;
+    let closed = false;
+
+    const connect = () => {
+      socket = new WebSocket(DASHBOARD_WS_URL);
+
+      socket.onopen = () => {
+        retryDelay = 1000;
+      };
+
+      socket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        const { analytics: analyticsUpdate, daily_sales_report: reportUpdate } = message.data || {};
+        if (message.type === "snapshot") {
+          if (analyticsUpdate) setAnalytics(analyticsUpdate);
+          if (reportUpdate) setDailySalesReport(reportUpdate);
+          setLoading(false);
+        } else if (message.type === "delta") {
+          if (analyticsUpdate) setAnalytics((prev) => ({ ...prev, ...analyticsUpdate }));
+          if (reportUpdate) setDailySalesReport((prev) => ({ ...prev, ...reportUpdate }));
+        }
+      };
+
+      socket.onclose = () => {
+        if (closed) return;
+        reconnectTimer = setTimeout(connect, retryDelay);
+        retryDelay = Math.min(retryDelay * 2, 30000);
+      };
+    };
+
+    connect();
+
+    return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
+      if (socket) socket.close();
+    };
+  }, []);
+
   const fetchAnalytics = async () => {
     try {
       const response = await axios.get(`${API}/analytics/dashboard`);
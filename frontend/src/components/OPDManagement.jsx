@@ -46,6 +46,8 @@ const OPDManagement = () => {
     doctor_id: "",
     patient_id: "",
     consultation_fee: "",
+    symptoms: "",
+    diagnosis: "",
     prescription_notes: "",
     next_visit_date: ""
   });
@@ -151,6 +153,8 @@ const OPDManagement = () => {
       doctor_id: "",
       patient_id: "",
       consultation_fee: "",
+      symptoms: "",
+      diagnosis: "",
       prescription_notes: "",
       next_visit_date: ""
     });
@@ -518,6 +522,26 @@ const OPDManagement = () => {
                 />
               </div>
 
+              <div>
+                <Label htmlFor="symptoms">Symptoms</Label>
+                <Input
+                  id="symptoms"
+                  value={formData.symptoms}
+                  onChange={(e) => setFormData({ ...formData, symptoms: e.target.value })}
+                  placeholder="e.g. Fever, headache"
+                />
+              </div>
+
+              <div>
+                <Label htmlFor="diagnosis">Diagnosis</Label>
+                <Input
+                  id="diagnosis"
+                  value={formData.diagnosis}
+                  onChange={(e) => setFormData({ ...formData, diagnosis: e.target.value })}
+                  placeholder="e.g. Viral fever"
+                />
+              </div>
+
               <div className="md:col-span-2">
                 <Label htmlFor="prescription_notes">Prescription Notes</Label>
                 <textarea
@@ -555,13 +555,25 @@ const POSInterface = () => {
     };
   };
 
-  const showPrintReceipt = (responseData, transactionData, totals, type, reason = null) => {
+  const fetchSaleReceipt = async (saleId) => {
+    try {
+      const response = await axios.get(`${API}/sales/${saleId}/receipt`, { responseType: 'text' });
+      return response.data;
+    } catch (error) {
+      console.error("Error fetching receipt:", error);
+      return null;
+    }
+  };
+
+  const showPrintReceipt = async (responseData, transactionData, totals, type, reason = null) => {
     const receiptData = generateReceiptData(cartItems, totals, {
       received: totals.received,
       change: totals.change
     });
 
-    const receiptContent = `
+    // Sale receipts are rendered by the server from the printer settings; returns are built here
+    const serverReceipt = type === 'sale' ? await fetchSaleReceipt(responseData.id) : null;
+    const receiptContent = serverReceipt || `
 <!DOCTYPE html>
 <html>
 <head>
@@ -748,7 +760,7 @@ const POSInterface = () => {
         const response = await axios.post(`${API}/sales`, saleData);
         
         // Show print receipt
-        showPrintReceipt(response.data, saleData, totals, "sale");
+        await showPrintReceipt(response.data, saleData, totals, "sale");
         
         // Refresh medicine quantities in real-time
         await refreshMedicineQuantities();
@@ -787,7 +799,7 @@ const POSInterface = () => {
         const response = await axios.post(`${API}/returns`, returnData);
         
         // Show print receipt
-        showPrintReceipt(response.data, returnData, totals, "return", returnReason);
+        await showPrintReceipt(response.data, returnData, totals, "return", returnReason);
         
         // Refresh medicine quantities in real-time
         await refreshMedicineQuantities();
@@ -48,6 +48,8 @@ const PatientManagement = () => {
   const [opdFormData, setOpdFormData] = useState({
     doctor_id: "",
     consultation_fee: "",
+    symptoms: "",
+    diagnosis: "",
     prescription_notes: "",
     next_visit_date: ""
   });
@@ -153,6 +155,8 @@ const PatientManagement = () => {
     setOpdFormData({
       doctor_id: "",
       consultation_fee: "",
+      symptoms: "",
+      diagnosis: "",
       prescription_notes: "",
       next_visit_date: ""
     });
@@ -166,6 +170,8 @@ const PatientManagement = () => {
         doctor_id: opdFormData.doctor_id,
         patient_id: selectedPatientForOPD.id,
         consultation_fee: parseFloat(opdFormData.consultation_fee) || null,
+        symptoms: opdFormData.symptoms || null,
+        diagnosis: opdFormData.diagnosis || null,
         prescription_notes: opdFormData.prescription_notes || null,
         next_visit_date: opdFormData.next_visit_date ? new Date(opdFormData.next_visit_date).toISOString() : null
       };
@@ -701,6 +707,26 @@ const PatientManagement = () => {
                 />
               </div>
 
+              <div>
+                <Label htmlFor="symptoms">Symptoms</Label>
+                <Input
+                  id="symptoms"
+                  value={opdFormData.symptoms}
+                  onChange={(e) => setOpdFormData({ ...opdFormData, symptoms: e.target.value })}
+                  placeholder="e.g. Fever, headache"
+                />
+              </div>
+
+              <div>
+                <Label htmlFor="diagnosis">Diagnosis</Label>
+                <Input
+                  id="diagnosis"
+                  value={opdFormData.diagnosis}
+                  onChange={(e) => setOpdFormData({ ...opdFormData, diagnosis: e.target.value })}
+                  placeholder="e.g. Viral fever"
+                />
+              </div>
+
               <div>
                 <Label htmlFor="prescription_notes">Prescription Notes</Label>
                 <textarea
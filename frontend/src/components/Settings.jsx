@@ -515,6 +515,16 @@ ${response.data.errors?.length > 3 ? `\n... and ${response.data.errors.length -
                   />
                 </div>
 
+                <div>
+                  <Label htmlFor="shop_website">Website</Label>
+                  <Input
+                    id="shop_website"
+                    value={settings.general.shop_website || ""}
+                    onChange={(e) => updateSetting('general', 'shop_website', e.target.value)}
+                    placeholder="Enter website address"
+                  />
+                </div>
+
                 <div>
                   <Label htmlFor="shop_license">License Number</Label>
                   <Input
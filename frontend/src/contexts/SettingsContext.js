@@ -14,6 +14,7 @@ const DEFAULT_SETTINGS = {
     shop_address: "123 Main Street, City, State, ZIP",
     shop_phone: "+1-234-567-8900",
     shop_email: "info@medipos.com",
+    shop_website: "",
     shop_license: "PH-2024-001",
     owner_name: "Pharmacy Owner",
     gst_number: "",
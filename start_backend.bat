@@ -24,11 +24,14 @@ if not exist "requirements.txt" (
     exit /b 1
 )
 
-echo Starting MediPOS Backend Server...
+if not defined WEB_CONCURRENCY set WEB_CONCURRENCY=1
+
+echo Starting MediPOS Backend Server (%WEB_CONCURRENCY% worker^(s^))...
 echo Backend API will be available at: http://localhost:8001
 echo API Documentation: http://localhost:8001/docs
+echo For development with auto-reload run: python server.py --dev
 echo.
-python server.py
+python server.py --workers %WEB_CONCURRENCY%
 
 if errorlevel 1 (
     echo.